@@ -12,6 +12,10 @@ const char* road = "1";
 const char* mqtt_sub = "traffic_lights/cycles";
 const char* mqtt_pub = "traffic_lights/noti";
 
+// true: gửi frame binary 9 byte thay cho chuỗi CSV (server tự nhận dạng, xem src/mqtt_payload.py)
+// Frame chu kỳ binary từ server luôn được chấp nhận, bất kể cờ này
+const bool compact_payload = false;
+
 // Khai báo thông tin Wi-Fi và MQTT Broker
 const char* ssid = "nv.minh_";
 const char* password = "1234567890";
@@ -160,6 +164,24 @@ void updateTrafficLight() {
 
 // Callback khi nhận được thông điệp từ MQTT
 void mqttCallback(char* topic, byte* payload, unsigned int length) {
+  // Frame chu kỳ binary 15 byte: 0xA6, road (uint16), xanh, vàng, đỏ (uint32, ms), little-endian
+  if (length == 15 && payload[0] == 0xA6) {
+    uint16_t roadId;
+    uint32_t greenTime, yellowTime, redTime;
+    memcpy(&roadId, &payload[1], 2);
+    memcpy(&greenTime, &payload[3], 4);
+    memcpy(&yellowTime, &payload[7], 4);
+    memcpy(&redTime, &payload[11], 4);
+    if (String(topic) == mqtt_sub && roadId == atoi(road)) {
+      NEW_GREEN_TIME = greenTime;
+      NEW_YELLOW_TIME = yellowTime;
+      NEW_RED_TIME = redTime;
+      cycleChanged = true;
+      Serial.println("Đã nhận chu kỳ mới (binary)");
+    }
+    return;
+  }
+
   String message = "";
   for (int i = 0; i < length; i++) {
     message += (char)payload[i];
@@ -216,23 +238,46 @@ void reconnect() {
   }
 }
 
+// Gửi frame telemetry binary 9 byte: 0xA5, road (uint16), màu, thời gian (uint16, s), loại, còn lại (uint16, s)
+// màu: 0 = RED, 1 = YELLOW, 2 = GREEN; loại: 0 = đếm ngược, 1 = ON, 2 = OFF
+void pubCompact(String color, int timeDuration, uint8_t kind, int remaining) {
+  uint8_t frame[9];
+  uint16_t roadId = atoi(road);
+  uint16_t duration = timeDuration;
+  uint16_t remain = remaining;
+  frame[0] = 0xA5;
+  memcpy(&frame[1], &roadId, 2);
+  frame[3] = color == "RED" ? 0 : (color == "YELLOW" ? 1 : 2);
+  memcpy(&frame[4], &duration, 2);
+  frame[6] = kind;
+  memcpy(&frame[7], &remain, 2);
+  client.publish(mqtt_pub, frame, sizeof(frame));
+}
+
 void pubNoti(){
   String colorStr;
   String timeDuration;
+  int durationSec = 0;
   switch (currentState) {
     case RED:
       colorStr = "RED";
-      timeDuration = RED_TIME/1000;
+      durationSec = RED_TIME/1000;
       break;
     case GREEN:
       colorStr = "GREEN";
-      timeDuration = GREEN_TIME/1000;
+      durationSec = GREEN_TIME/1000;
       break;
     case YELLOW:
       colorStr = "YELLOW";
-      timeDuration = YELLOW_TIME/1000;
+      durationSec = YELLOW_TIME/1000;
       break;
   }
+  timeDuration = durationSec;
+
+  if (compact_payload) {
+    pubCompact(colorStr, durationSec, 0, countdown);
+    return;
+  }
 
     String message = String(road) + "," + colorStr + "," + String(timeDuration) + "," + String(countdown);
     client.publish(mqtt_pub, message.c_str());
@@ -251,7 +296,13 @@ void pubStatus(String color, String status){
     timeDuration = YELLOW_TIME / 1000;
   }
 
-  String message = String(road) + "," + color + "," + String(timeDuration) + "," + String(countdown);
+  if (compact_payload) {
+    // loại 1 = ON, 2 = OFF; tin trạng thái không có thời gian còn lại
+    pubCompact(color, timeDuration, status == "ON" ? 1 : 2, 0);
+    return;
+  }
+
+  String message = String(road) + "," + color + "," + String(timeDuration) + "," + status;
   client.publish(mqtt_pub, message.c_str());
   
   Serial.print("Đã publish: ");
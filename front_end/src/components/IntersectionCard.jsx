@@ -21,6 +21,27 @@ const IntersectionCard = ({ feed }) => {
     const [cameras, setCameras] = useState([])
     const [lights, setLights] = useState([])
     const [devicePairs, setDevicePairs] = useState([]);
+    const [now, setNow] = useState(Date.now());
+
+    // Server chỉ gửi sự kiện đổi pha (endsAt, serverTime): tự đếm ngược mỗi giây ở client
+    useEffect(() => {
+        const timer = setInterval(() => setNow(Date.now()), 1000);
+        return () => clearInterval(timer);
+    }, []);
+
+    // Đổi endsAt của server sang giờ máy client (bù lệch đồng hồ bằng serverTime)
+    const withLocalEnd = (value, serverTime) => (
+        value?.endsAt !== undefined && serverTime !== undefined
+            ? { ...value, localEndsAt: Date.now() + (value.endsAt - serverTime) }
+            : value
+    );
+    const withCountdown = (light) => (
+        light?.localEndsAt !== undefined
+            ? { ...light, content: String(Math.max(0, Math.ceil((light.localEndsAt - now) / 1000))) }
+            : light
+    );
+    const light1View = withCountdown(light1);
+    const light2View = withCountdown(light2);
 
     useEffect(() => {
         if (!feed?.devices) return;
@@ -92,8 +113,8 @@ const IntersectionCard = ({ feed }) => {
         };
     }, []);
     useEffect(()=>{
-        const mqttUrl1 = 'http://localhost:8080/ws/mqtt1'
-        const mqttUrl2 = 'http://localhost:8080/ws/mqtt2'
+        const mqttUrl1 = 'http://localhost:8080/ws/lights/1'
+        const mqttUrl2 = 'http://localhost:8080/ws/lights/2'
         const ws1 = new WebSocket(mqttUrl1);
         const ws2 = new WebSocket(mqttUrl2);
         ws1.onopen = () => {
@@ -106,7 +127,8 @@ const IntersectionCard = ({ feed }) => {
                 const {messages} = data;
                 console.log('messages', messages);
                 if (messages) {
-                    messages.forEach(value => {
+                    messages.forEach(message => {
+                        const value = withLocalEnd(message, data.serverTime);
                         if(parseInt(value?.road) === 1){
                             setLight1(value);
                         }
@@ -141,7 +163,8 @@ const IntersectionCard = ({ feed }) => {
                 const {messages} = data;
                 console.log('messages', messages);
                 if (messages) {
-                    messages.forEach(value => {
+                    messages.forEach(message => {
+                        const value = withLocalEnd(message, data.serverTime);
                         if(parseInt(value?.road) === 2){
                             setLight2( value);
                         }
@@ -253,9 +276,9 @@ const IntersectionCard = ({ feed }) => {
                     //     matchedLight = light2;
                     // }
                     if (cameraDirection === 'North' || cameraDirection === 'South') {
-                        matchedLight = light1;
+                        matchedLight = light1View;
                     } else if (cameraDirection === 'East' || cameraDirection === 'West') {
-                        matchedLight = light2;
+                        matchedLight = light2View;
                     }
 
                     return (
@@ -267,7 +290,7 @@ const IntersectionCard = ({ feed }) => {
                         <div className="camera-feed" key={camera.device_id}   style={{ width: '220px', height: '300px' }}>
                         <div className="camera-image-container"     style={{ width: '100%', height: '100%', overflow: 'hidden' }}>
                             <img
-                            src={`${server_url}/api/devices/${camera.device_id}/stream.mjpg`}
+                            src={`${server_url}/api/devices/${camera.device_id}/stream.mjpg?w=320&q=60&fps=5`}
                             alt={`Traffic camera ${camera.device_id}`}
                             className="camera-image"
                                   style={{ width: '100%', height: '100%', objectFit: 'cover' }}
@@ -351,7 +374,7 @@ const IntersectionCard = ({ feed }) => {
                 </div>
                 <div className="feed-detail">Lưu lượng: {totalDown}</div>
                 <div className="feed-detail">FPS: {fps}</div>
-                <div className='feed-detail'>Thời gian: {light1?.content} </div>
+                <div className='feed-detail'>Thời gian: {light1View?.content} </div>
 
                 <Box className="traffic-control" sx={{ mt: 2 }}>
                     <Box sx={{ display: 'flex', alignItems: 'center', mb: 1, justifyContent: 'space-between' }}>
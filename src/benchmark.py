@@ -0,0 +1,164 @@
+"""Offline benchmarks for the video pipeline.
+
+    python benchmark.py stride --video ../video/vehicles.mp4 --strides 1 2 3 4
+    python benchmark.py backends --variants torch:fp32 onnx:fp32 onnx:int8 openvino:fp16
+
+`stride` replays the same video file frame by frame (no real-time pacing)
+and reports throughput plus the counting accuracy against the stride-1
+(full-rate) baseline. `backends` measures per-frame latency and batched
+throughput of each inference backend on the images in image_test/.
+"""
+import argparse
+import glob
+import os
+import time
+
+import cv2
+import numpy as np
+
+from config import settings
+from model_loader import BASE_DIR, get_class_names, load_detector
+from inference_server import VEHICLE_CLASS_NAMES
+from video_processor_v2 import VideoProcessor
+
+IMAGE_TEST_DIR = os.path.join(os.path.dirname(BASE_DIR), "image_test")
+
+
+def _make_processor(stride: int) -> VideoProcessor:
+    processor = VideoProcessor(
+        device_id=f"benchmark-stride-{stride}",
+        input_video_stream=None,
+        direction_from="North",
+        direction_to="South",
+        is_tracking=True,
+        execution_mode="inline",
+    )
+    processor.adaptive_stride = False
+    processor.detection_stride = stride
+    processor.set_counting_line((0, settings.frame_height2 * 4 // 5), (settings.frame_width, settings.frame_height2 * 4 // 5))
+    return processor
+
+
+def run_stride(video_path: str, stride: int, max_frames: int) -> dict:
+    processor = _make_processor(stride)
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise RuntimeError(f"Could not open video: {video_path}")
+
+    frames = 0
+    started = time.perf_counter()
+    while frames < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        processor.process_frame_sync(frame)
+        frames += 1
+    elapsed = time.perf_counter() - started
+    cap.release()
+
+    return {
+        'stride': stride,
+        'frames': frames,
+        'fps': frames / elapsed if elapsed > 0 else 0.0,
+        'total': processor.counts['total_down'],
+        'by_class': dict(processor.counts['down_by_class']),
+    }
+
+
+def benchmark_stride(video_path: str, strides, max_frames: int):
+    strides = sorted(set([1] + list(strides)))
+    results = [run_stride(video_path, stride, max_frames) for stride in strides]
+    baseline = results[0]
+
+    print(f"\n{'stride':>6} {'frames':>7} {'fps':>8} {'total':>6} {'accuracy':>9}")
+    for result in results:
+        if baseline['total'] > 0:
+            accuracy = 1 - abs(result['total'] - baseline['total']) / baseline['total']
+        else:
+            accuracy = 1.0 if result['total'] == 0 else 0.0
+        print(f"{result['stride']:>6} {result['frames']:>7} {result['fps']:>8.1f} {result['total']:>6} {accuracy:>8.1%}")
+        print(f"{'':>6} by class: {result['by_class']}")
+    return results
+
+
+def _load_test_images(image_dir: str):
+    images = []
+    for path in sorted(glob.glob(os.path.join(image_dir, "*"))):
+        image = cv2.imread(path)
+        if image is not None:
+            images.append(cv2.resize(image, (settings.frame_width2, settings.frame_height2)))
+    if not images:
+        raise RuntimeError(f"No images found in {image_dir}")
+    return images
+
+
+def run_backend(backend: str, precision: str, images, repeats: int) -> dict:
+    model = load_detector(backend=backend, precision=precision)
+    class_names = get_class_names(model)
+    classes = [k for k, v in class_names.items() if v in VEHICLE_CLASS_NAMES]
+    kwargs = dict(conf=settings.conf_thresh, iou=settings.iou_thresh, classes=classes, verbose=False)
+
+    model(images[0], **kwargs) # warm-up
+    latencies = []
+    detections = 0
+    for _ in range(repeats):
+        for image in images:
+            started = time.perf_counter()
+            result = model(image, **kwargs)[0]
+            latencies.append(time.perf_counter() - started)
+            detections += len(result.boxes)
+
+    batch = images * max(1, repeats)
+    started = time.perf_counter()
+    model(batch, **kwargs)
+    batch_elapsed = time.perf_counter() - started
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'variant': f"{backend}:{precision}",
+        'mean_ms': float(latencies_ms.mean()),
+        'p95_ms': float(np.percentile(latencies_ms, 95)),
+        'throughput': len(batch) / batch_elapsed if batch_elapsed > 0 else 0.0,
+        'detections': detections / max(1, len(latencies)),
+    }
+
+
+def benchmark_backends(variants, image_dir: str, repeats: int):
+    images = _load_test_images(image_dir)
+    print(f"Benchmarking {len(images)} images from {image_dir} ({repeats} repeats)")
+    results = []
+    for variant in variants:
+        backend, _, precision = variant.partition(":")
+        try:
+            results.append(run_backend(backend, precision or "fp32", images, repeats))
+        except Exception as e:
+            print(f"Skipping {variant}: {e}")
+
+    print(f"\n{'variant':<16} {'mean ms':>8} {'p95 ms':>8} {'img/s':>8} {'det/img':>8}")
+    for result in results:
+        print(f"{result['variant']:<16} {result['mean_ms']:>8.1f} {result['p95_ms']:>8.1f} "
+              f"{result['throughput']:>8.1f} {result['detections']:>8.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Video pipeline benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stride_parser = subparsers.add_parser("stride", help="Counting accuracy/throughput per detection stride")
+    stride_parser.add_argument("--video", default=settings.video_url, help="Video file to replay")
+    stride_parser.add_argument("--strides", type=int, nargs="+", default=[1, 2, 3, 4])
+    stride_parser.add_argument("--max-frames", type=int, default=1500)
+
+    backends_parser = subparsers.add_parser("backends", help="Latency/throughput per inference backend")
+    backends_parser.add_argument("--variants", nargs="+",
+                                 default=["torch:fp32", "onnx:fp32", "onnx:int8", "openvino:fp32", "openvino:fp16", "openvino:int8"],
+                                 help="backend:precision pairs")
+    backends_parser.add_argument("--images", default=IMAGE_TEST_DIR)
+    backends_parser.add_argument("--repeats", type=int, default=10)
+
+    args = parser.parse_args()
+    if args.command == "stride":
+        benchmark_stride(args.video, args.strides, args.max_frames)
+    elif args.command == "backends":
+        benchmark_backends(args.variants, args.images, args.repeats)
@@ -0,0 +1,92 @@
+import copy
+import functools
+import inspect
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+from config import settings
+
+MISSING = object()
+
+
+class TTLCache:
+    """Small in-process cache with per-entry TTL and LRU eviction.
+
+    Keys are tuples whose first element is a namespace (e.g. "road"), so a
+    write can drop every entry of the namespaces it affects. Values are
+    deep-copied on the way in and out so callers cannot mutate the cache.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        self.max_entries = max(1, max_entries or settings.cache_max_entries)
+        self.ttl = settings.cache_ttl_seconds if ttl is None else ttl
+        self._entries: "OrderedDict[Tuple[Hashable, ...], Tuple[float, Any]]" = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key: Tuple[Hashable, ...]) -> Any:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.stats['misses'] += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return copy.deepcopy(entry[1])
+
+    def set(self, key: Tuple[Hashable, ...], value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def invalidate(self, *keys: Tuple[Hashable, ...]):
+        for key in keys:
+            if self._entries.pop(key, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def invalidate_namespace(self, *namespaces: str):
+        for key in [key for key in self._entries if key[0] in namespaces]:
+            del self._entries[key]
+            self.stats['invalidations'] += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self) -> dict:
+        stats = self.stats.copy()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        stats['entries'] = len(self._entries)
+        stats['ttl'] = self.ttl
+        return stats
+
+
+def cached(namespace: str):
+    """Read-through cache for an async method of an object that has a `cache` attribute.
+
+    The key is (namespace, *arguments) after binding, so positional and
+    keyword calls share an entry. None results are not cached.
+    """
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            cache: Optional[TTLCache] = getattr(self, "cache", None)
+            if cache is None:
+                return await method(self, *args, **kwargs)
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            key = (namespace, *list(bound.arguments.values())[1:])
+            value = cache.get(key)
+            if value is not MISSING:
+                return value
+            value = await method(self, *args, **kwargs)
+            if value is not None:
+                cache.set(key, value)
+            return value
+        return wrapper
+    return decorator
@@ -24,18 +24,67 @@ class Settings(BaseSettings):
     model_path: str = os.getenv("YOLO_MODEL_PATH", "yolov8n.pt")
     conf_thresh: float = float(os.getenv("CONFIDENCE_THRESHOLD", "0.5"))
     iou_thresh: float = float(os.getenv("IOU_THRESHOLD", "0.7"))  # Ngưỡng IOU cho NMS
+    inference_backend: str = os.getenv("INFERENCE_BACKEND", "torch")        # torch | onnx | openvino
+    inference_precision: str = os.getenv("INFERENCE_PRECISION", "fp32")     # fp32 | fp16 (openvino) | int8
 
     # Video processing settings
     frame_width: int = int(os.getenv("FRAME_WIDTH", "640"))
     frame_height: int = int(os.getenv("FRAME_HEIGHT", "480"))
     frame_width2: int = int(os.getenv("FRAME_WIDTH2", "480"))
     frame_height2: int = int(os.getenv("FRAME_HEIGHT2", "640"))
+    # MJPEG nhiều mức (?w=&q=&fps=): bậc chiều rộng (px) và số tier encode giữ lại mỗi camera
+    stream_width_step: int = int(os.getenv("STREAM_WIDTH_STEP", "80"))
+    stream_max_tiers: int = int(os.getenv("STREAM_MAX_TIERS", "4"))
     fps: int = int(os.getenv("FPS", "30"))
     video_url: str = os.getenv("VIDEO_URL", "C:\\Users\\PC\\Documents\\Y4\\T8\\Embedding\\src\\Uni-Embedded_System_Development\\video\\vehicles.mp4")
     # ByteTrack settings
     track_thresh: float = float(os.getenv("TRACK_THRESH", "0.5"))  # Detection confidence threshold
     track_buffer: int = int(os.getenv("TRACK_BUFFER", "30"))      # Maximum number of frames to keep lost tracks
     match_thresh: float = float(os.getenv("MATCH_THRESH", "0.8")) # IOU threshold for matching detections to tracks
+
+    # Shared inference settings (một model YOLO dùng chung cho tất cả camera)
+    shared_inference: bool = os.getenv("SHARED_INFERENCE", "true").lower() == "true"
+    inference_batch_size: int = int(os.getenv("INFERENCE_BATCH_SIZE", "8"))        # Số frame tối đa trong một batch
+    inference_max_wait_ms: float = float(os.getenv("INFERENCE_MAX_WAIT_MS", "15"))  # Thời gian chờ tối đa để gom batch
+    # "inline": xử lý trên event loop, "process": mỗi camera chạy trong một process riêng.
+    # Chế độ process load một model YOLO trong mỗi worker (N camera = N model) và bỏ qua SHARED_INFERENCE;
+    # process cha không load model nào.
+    video_execution_mode: str = os.getenv("VIDEO_EXECUTION_MODE", "inline")
+    # Thread đọc frame riêng cho mỗi camera, luôn xử lý frame mới nhất
+    frame_grabber: bool = os.getenv("FRAME_GRABBER", "true").lower() == "true"
+    frame_buffer_size: int = int(os.getenv("FRAME_BUFFER_SIZE", "2"))
+    # Detection stride: chạy YOLO mỗi N frame, các frame giữa dự đoán box theo vận tốc track
+    detection_stride: int = int(os.getenv("DETECTION_STRIDE", "1"))
+    adaptive_stride: bool = os.getenv("ADAPTIVE_STRIDE", "false").lower() == "true"  # Tự tăng/giảm stride theo FPS đo được
+    max_detection_stride: int = int(os.getenv("MAX_DETECTION_STRIDE", "5"))
+    # Motion gate: bỏ qua YOLO khi khung hình đứng yên (ban đêm, đèn đỏ...)
+    motion_gate: bool = os.getenv("MOTION_GATE", "false").lower() == "true"
+    motion_min_changed_ratio: float = float(os.getenv("MOTION_MIN_CHANGED_RATIO", "0.002"))  # Tỷ lệ pixel thay đổi tối thiểu
+    motion_band: int = int(os.getenv("MOTION_BAND", "0"))  # Chỉ xét dải +-N pixel quanh vạch đếm, 0 = cả khung hình
+    # ROI: chỉ đưa dải ảnh quanh vạch đếm vào YOLO
+    roi_enabled: bool = os.getenv("ROI_ENABLED", "false").lower() == "true"
+    roi_band_above: int = int(os.getenv("ROI_BAND_ABOVE", "200"))  # Số pixel phía trên vạch đếm
+    roi_band_below: int = int(os.getenv("ROI_BAND_BELOW", "60"))   # Số pixel phía dưới vạch đếm
+    # Headless: chỉ vẽ annotation khi có client đang xem stream (hoặc khi lấy snapshot)
+    annotate_only_when_viewed: bool = os.getenv("ANNOTATE_ONLY_WHEN_VIEWED", "false").lower() == "true"
+    # Write-behind: gom bản ghi đếm xe rồi ghi MongoDB bằng insert_many
+    persist_batch_size: int = int(os.getenv("PERSIST_BATCH_SIZE", "500"))            # Số bản ghi tối đa mỗi lần insert_many
+    persist_flush_interval: float = float(os.getenv("PERSIST_FLUSH_INTERVAL", "2.0"))  # Giây giữa các lần flush
+    persist_max_buffered: int = int(os.getenv("PERSIST_MAX_BUFFERED", "10000"))      # Giới hạn bộ nhớ đệm
+    persist_max_retries: int = int(os.getenv("PERSIST_MAX_RETRIES", "5"))            # Số lần thử lại khi lỗi tạm thời
+    # Log đếm ngược của đèn: chỉ giữ tick mới nhất mỗi đèn trong mỗi lần flush; false = ghi mọi tick
+    light_log_coalesce: bool = os.getenv("LIGHT_LOG_COALESCE", "true").lower() == "true"
+    # Đèn: WebSocket chỉ nhận sự kiện đổi pha (client tự đếm ngược); false = gửi mọi tick như cũ
+    light_phase_events: bool = os.getenv("LIGHT_PHASE_EVENTS", "true").lower() == "true"
+    light_phase_drift: float = float(os.getenv("LIGHT_PHASE_DRIFT", "1.5"))  # Lệch (giây) coi như pha mới
+    # Lưu trữ dữ liệu đếm: TTL theo ngày (0 = giữ vĩnh viễn)
+    counts_retention_days: int = int(os.getenv("COUNTS_RETENTION_DAYS", "0"))
+    # Tạo collection đếm dạng time-series (chỉ áp dụng khi collection chưa tồn tại)
+    counts_timeseries: bool = os.getenv("COUNTS_TIMESERIES", "false").lower() == "true"
+    # Cache đọc trong process cho roads/devices/trạng thái đèn
+    cache_enabled: bool = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+    cache_ttl_seconds: float = float(os.getenv("CACHE_TTL_SECONDS", "30"))
+    cache_max_entries: int = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
     
     # API settings
     host: str = os.getenv("HOST", "0.0.0.0")
@@ -46,6 +95,21 @@ class Settings(BaseSettings):
     mqtt_port: int = int(os.getenv("MQTT_PORT", "1883"))
     mqtt_topic_pub: str = os.getenv("MQTT_TOPIC_PUB", "traffic_lights/cycles")
     mqtt_topic_sub: str = os.getenv("MQTT_TOPIC_SUB", "traffic_lights/noti")
+    # Payload MQTT của đèn: "auto" (theo định dạng đèn gửi lên), "csv" hoặc "binary"
+    mqtt_payload_format: str = os.getenv("MQTT_PAYLOAD_FORMAT", "auto")
+    mqtt_mode: str = os.getenv("MQTT_MODE", "thread")                 # thread (paho loop_forever) | asyncio
+    mqtt_qos: int = int(os.getenv("MQTT_QOS", "0"))
+    mqtt_queue_size: int = int(os.getenv("MQTT_QUEUE_SIZE", "1000"))   # Hàng đợi message vào (chế độ asyncio)
+    mqtt_reconnect_max_delay: float = float(os.getenv("MQTT_RECONNECT_MAX_DELAY", "30"))
+
+    # WebSocket: hàng đợi gửi riêng cho mỗi client; gửi chậm hơn timeout thì ngắt client đó
+    ws_queue_size: int = int(os.getenv("WS_QUEUE_SIZE", "64"))
+    ws_send_timeout: float = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+
+    # Điều khiển tự động: cửa sổ tính lưu lượng xe/giờ (0 = dùng 60 bản ghi gần nhất mỗi camera)
+    flow_window_minutes: float = float(os.getenv("FLOW_WINDOW_MINUTES", "0"))
+    # Các road có hạn tính lại chu kỳ trong khoảng này (giây) được gom thành một lượt truy vấn
+    scheduler_batch_window: float = float(os.getenv("SCHEDULER_BATCH_WINDOW", "1.0"))
 
     class Config:
         env_file = ".env"
@@ -1,10 +1,24 @@
 import asyncio
 
 from motor.motor_asyncio import AsyncIOMotorClient
-from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from datetime import datetime, timedelta
 from typing import List
 from models import VehicleCount, TrafficLight, TrafficLightLog, AggregatedVehicleCount
 from typing import Optional, Tuple
+from cache import TTLCache, cached
+
+# Hướng camera -> pha đèn
+DIRECTION_TO_PHASE = {
+    "North": "North-South",
+    "South": "North-South",
+    "East": "East-West",
+    "West": "East-West",
+}
+
+# Namespace cache bị xoá khi ghi vào collection tương ứng
+ROAD_CACHE_NAMESPACES = ("roads", "road", "roads_devices")
+DEVICE_CACHE_NAMESPACES = ("devices", "device", "devices_by_road", "cameras", "roads_devices")
 
 class Database:
     def __init__(self, connection_string: str):
@@ -16,9 +30,99 @@ class Database:
         self.aggregated_counts = self.db.aggregated_vehicle_counts
         self.roads = self.db.roads
         self.devices = self.db.devices
+        # Cache đọc cho roads/devices/trạng thái đèn (dữ liệu ít thay đổi)
+        from config import settings
+        self.cache: Optional[TTLCache] = TTLCache() if settings.cache_enabled else None
+
+    def _invalidate(self, *namespaces: str):
+        if self.cache is not None:
+            self.cache.invalidate_namespace(*namespaces)
+
+    def _invalidate_traffic_light(self, color: str, road: str):
+        if self.cache is not None:
+            self.cache.invalidate(("traffic_light", color, road), ("traffic_light_by_road", road))
+
+    def remember_traffic_light(self, light: TrafficLight):
+        """Write-through: cache the new state of a light so the next read does not hit the DB."""
+        if self.cache is not None:
+            self._invalidate_traffic_light(light.color, light.road)
+            self.cache.set(("traffic_light", light.color, light.road), light)
+
+    # Schema: index / time-series cho các truy vấn chính
+    async def ensure_schema(self):
+        """Create the indexes used by the hot queries and set up count retention (idempotent)."""
+        from config import settings
+        retention = settings.counts_retention_days * 86400 if settings.counts_retention_days > 0 else None
+        existing = set(await self.db.list_collection_names())
+
+        # Dữ liệu đếm: time-series chỉ tạo được khi collection chưa tồn tại
+        if not await self._ensure_timeseries(self.counts.name, "timestamp", "vehicle_type", retention, existing):
+            await self._ensure_time_index(self.counts, "timestamp", retention)
+        await self.counts.create_index([("vehicle_type", ASCENDING), ("timestamp", DESCENDING)])
+
+        if not await self._ensure_timeseries(self.aggregated_counts.name, "timefrom", "deviceID", retention, existing):
+            await self._ensure_time_index(self.aggregated_counts, "timefrom", retention)
+        await self.aggregated_counts.create_index([("deviceID", ASCENDING), ("timefrom", DESCENDING)])
+
+        await self.devices.create_index([("road_id", ASCENDING), ("type", ASCENDING)])
+        await self.devices.create_index([("device_id", ASCENDING)])
+        await self.traffic_light.create_index([("road", ASCENDING), ("color", ASCENDING)])
+        await self.traffic_light_log.create_index([("color", ASCENDING), ("timestamp", DESCENDING)])
+        print(f"Database schema ready (retention: {settings.counts_retention_days or 'unlimited'} days)")
+
+    async def _ensure_timeseries(self, name: str, time_field: str, meta_field: str,
+                                 retention: Optional[int], existing: set) -> bool:
+        """Return True if `name` is (or was just created as) a time-series collection."""
+        from config import settings
+        if name not in existing:
+            if not settings.counts_timeseries:
+                return False
+            options = {"timeseries": {"timeField": time_field, "metaField": meta_field, "granularity": "minutes"}}
+            if retention:
+                options["expireAfterSeconds"] = retention
+            await self.db.create_collection(name, **options)
+            print(f"Created time-series collection {name}")
+            return True
+
+        cursor = await self.db.list_collections(filter={"name": name})
+        infos = await cursor.to_list(length=1)
+        if not infos or infos[0].get("type") != "timeseries":
+            return False
+        if infos[0].get("options", {}).get("expireAfterSeconds") != retention:
+            await self.db.command("collMod", name, expireAfterSeconds=retention if retention else "off")
+        return True
+
+    async def _ensure_time_index(self, collection, field: str, retention: Optional[int]):
+        """Index `field` for range queries; with retention it is a TTL index."""
+        ttl_name = f"{field}_ttl"
+        indexes = await collection.index_information()
+        if retention is None:
+            if ttl_name in indexes:
+                await collection.drop_index(ttl_name)
+            await collection.create_index([(field, DESCENDING)])
+            return
+        if ttl_name in indexes:
+            if indexes[ttl_name].get("expireAfterSeconds") != retention:
+                await self.db.command("collMod", collection.name, index={"name": ttl_name, "expireAfterSeconds": retention})
+            return
+        await collection.create_index([(field, ASCENDING)], name=ttl_name, expireAfterSeconds=retention)
+
     async def save_vehicle_count(self, count: VehicleCount):
         await self.counts.insert_one(count.dict())
 
+    async def insert_documents(self, collection_name: str, documents: List[dict]):
+        """Bulk insert already-serialized documents (used by the write-behind queue)."""
+        if documents:
+            await self.db[collection_name].insert_many(documents, ordered=False)
+
+    async def bulk_upsert(self, collection_name: str, operations: List[Tuple[dict, dict]]):
+        """Apply (filter, fields) pairs as `$set` upserts in one bulk_write."""
+        if operations:
+            await self.db[collection_name].bulk_write(
+                [UpdateOne(filter, {"$set": values}, upsert=True) for filter, values in operations],
+                ordered=False
+            )
+
     async def get_vehicle_counts(self, limit: int = 100) -> List[VehicleCount]:
         cursor = self.counts.find().sort("timestamp", -1).limit(limit)
         counts = await cursor.to_list(length=limit)
@@ -51,6 +155,7 @@ class Database:
 
     async def save_traffic_light_status(self, status: TrafficLight):
         await self.traffic_light.insert_one(status.dict())
+        self._invalidate_traffic_light(status.color, status.road)
  
     async def save_traffic_light_log(self, status: TrafficLightLog):
         await self.traffic_light_log.insert_one(status.dict())
@@ -64,6 +169,7 @@ class Database:
             doc.pop("_id", None)
         return TrafficLightLog(**doc) if doc else None
 
+    @cached("traffic_light")
     async def get_traffic_light_status(self, light_color: str, road: str) -> TrafficLight | None:
         doc = await self.traffic_light.find_one(
             {"color": light_color, "road": road}
@@ -73,6 +179,7 @@ class Database:
         print(doc)
         return TrafficLight(**doc) if doc else None
     
+    @cached("traffic_light_by_road")
     async def get_traffic_light_by_device_id(self, road: str) -> TrafficLight | None:
         doc = await self.traffic_light.find_one(
             {"road": road}
@@ -87,30 +194,57 @@ class Database:
             {"color": color, "road": road},
             {"$set": {"status": new_status, "timeDuration": new_time_duration}}
         )
+        if result.matched_count:
+            self.remember_traffic_light(TrafficLight(color=color, road=road, status=new_status, timeDuration=new_time_duration))
+        else:
+            self._invalidate_traffic_light(color, road)
         return result.modified_count > 0
     async def update_device_status(self, device_id, new_status) -> bool:
         result = await self.devices.update_one( 
             { "device_id": device_id},
             {"$set": {"status": new_status}}
         )
+        self._invalidate(*DEVICE_CACHE_NAMESPACES)
         return result.modified_count > 0
 # Road operations
-    async def get_all_roads_and_devices(self) -> List[dict]:
-        cursor = self.roads.find()
-        roads = await cursor.to_list(length=100)
+    @cached("roads_devices")
+    async def get_all_roads_and_devices(self, limit: Optional[int] = None, after: Optional[str] = None) -> List[dict]:
+        """
+        Roads kèm devices trong một aggregation ($lookup) thay vì một query devices cho mỗi road.
+        Phân trang theo cursor: `after` là id của road cuối trang trước, `limit` là số road mỗi trang.
+        """
+        from bson import ObjectId
+        pipeline = []
+        if after:
+            pipeline.append({"$match": {"_id": {"$gt": ObjectId(after)}}})
+        pipeline.append({"$sort": {"_id": 1}})
+        if limit:
+            pipeline.append({"$limit": limit})
+        pipeline += [
+            {"$addFields": {"id": {"$toString": "$_id"}}},
+            # devices.road_id lưu dạng chuỗi -> join theo id, dùng index (road_id, type)
+            {"$lookup": {
+                "from": self.devices.name,
+                "localField": "id",
+                "foreignField": "road_id",
+                "as": "devices",
+            }},
+        ]
+        roads = await self.roads.aggregate(pipeline).to_list(length=None)
         for road in roads:
-            road["id"] = str(road["_id"])
-            devices = await self.get_device_by_road_id(road["id"])
-            road["devices"] = devices
+            for device in road["devices"]:
+                device["id"] = str(device["_id"])
         return roads
 
+    @cached("roads")
     async def get_all_roads(self) -> List[dict]:
         cursor = self.roads.find()
-        roads = await cursor.to_list(length=100)
+        roads = await cursor.to_list(length=None)
         for road in roads:
             road["id"] = str(road["_id"])
         return roads
     
+    @cached("road")
     async def get_road_by_id(self, road_id: str) -> dict:
         from bson import ObjectId
         road = await self.roads.find_one({"_id": ObjectId(road_id)})
@@ -120,6 +254,7 @@ class Database:
     
     async def create_road(self, road_data: dict) -> dict:
         result = await self.roads.insert_one(road_data)
+        self._invalidate(*ROAD_CACHE_NAMESPACES)
         new_road = await self.roads.find_one({"_id": result.inserted_id})
         new_road["id"] = str(new_road["_id"])
         return new_road
@@ -130,6 +265,7 @@ class Database:
             {"_id": ObjectId(road_id)},
             {"$set": road_data}
         )
+        self._invalidate(*ROAD_CACHE_NAMESPACES)
         if result.modified_count:
             updated_road = await self.roads.find_one({"_id": ObjectId(road_id)})
             updated_road["id"] = str(updated_road["_id"])
@@ -142,14 +278,17 @@ class Database:
             {"_id": ObjectId(road_id)},
             {"$set": {"mode": newMode}}
         )
+        self._invalidate(*ROAD_CACHE_NAMESPACES)
         print("update mode " + road_id + " " + newMode)
     
     async def delete_road(self, road_id: str) -> bool:
         from bson import ObjectId
         result = await self.roads.delete_one({"_id": ObjectId(road_id)})
+        self._invalidate(*ROAD_CACHE_NAMESPACES)
         return result.deleted_count > 0
     
     # Device operations
+    @cached("devices")
     async def get_all_devices(self) -> List[dict]:
         cursor = self.devices.find()
         devices = await cursor.to_list(length=100)
@@ -157,6 +296,7 @@ class Database:
             device["id"] = str(device["_id"])
         return devices
     
+    @cached("device")
     async def get_device_by_id(self, device_id: str) -> dict:
         from bson import ObjectId
         device = await self.devices.find_one({"_id": ObjectId(device_id)})
@@ -166,6 +306,7 @@ class Database:
     
     async def create_device(self, device_data: dict) -> dict:
         result = await self.devices.insert_one(device_data)
+        self._invalidate(*DEVICE_CACHE_NAMESPACES)
         new_device = await self.devices.find_one({"_id": result.inserted_id})
         new_device["id"] = str(new_device["_id"])
         print(new_device)
@@ -191,6 +332,7 @@ class Database:
             {"_id": ObjectId(device_id)},
             {"$set": device_data}
         )
+        self._invalidate(*DEVICE_CACHE_NAMESPACES)
         if result.modified_count:
             updated_device = await self.devices.find_one({"_id": ObjectId(device_id)})
             updated_device["id"] = str(updated_device["_id"])
@@ -200,8 +342,10 @@ class Database:
     async def delete_device(self, device_id: str) -> bool:
         from bson import ObjectId
         result = await self.devices.delete_one({"_id": ObjectId(device_id)})
+        self._invalidate(*DEVICE_CACHE_NAMESPACES)
         return result.deleted_count > 0
 
+    @cached("devices_by_road")
     async def get_device_by_road_id(self, road_id: str) -> dict:
         cursor = self.devices.find({"road_id": road_id})
         devices = await cursor.to_list(length=100)
@@ -211,6 +355,7 @@ class Database:
     
     # Dong thêm các hàm liên quan đến aggregated vehicle counts
 
+    @cached("cameras")
     async def get_all_cameras(self) -> List[dict]:
         cursor = self.devices.find({"type": "camera"})
         cameras = await cursor.to_list(length=100)
@@ -223,6 +368,7 @@ class Database:
         """Lưu trữ bản ghi đếm xe gộp."""
         # Chuyển Pydantic model thành dict, sử dụng alias nếu có
         await self.aggregated_counts.insert_one(agg_count_data.dict(by_alias=True))
+
         
     async def get_aggregated_counts_for_device_in_range(
         self,
@@ -234,13 +380,14 @@ class Database:
         Lấy các bản ghi đếm gộp cho một thiết bị trong một khoảng thời gian.
         Sắp xếp theo timestamp tăng dần để dễ xử lý delta.
         """
+        # Khớp index (deviceID, timefrom)
         cursor = self.aggregated_counts.find({
-            "deviceName": device_name,
-            "timestamp": {
+            "deviceID": device_name,
+            "timefrom": {
                 "$gte": start_time,
                 "$lte": end_time
             }
-        }).sort("timestamp", 1) # Sắp xếp TĂNG DẦN (ASC)
+        }).sort("timefrom", 1) # Sắp xếp TĂNG DẦN (ASC)
         
         docs = await cursor.to_list(length=None)
         # Chuyển đổi các dict từ MongoDB thành Pydantic model
@@ -273,41 +420,61 @@ class Database:
             dict_result[camera["direction_from"]].extend([AggregatedVehicleCount(**doc) for doc in docs])
         return dict_result
 
+    async def get_road_flow_rates(
+        self,
+        road_ids: List[str],
+        window_minutes: Optional[float] = None,
+        limit: int = 60
+    ) -> dict:
+        """
+        Lưu lượng NS/EW của một hoặc nhiều road trong một aggregation duy nhất.
+        - window_minutes=None: tổng totalCount của `limit` bản ghi gần nhất mỗi camera (như trước)
+        - window_minutes: số xe/giờ thực tế trong cửa sổ `window_minutes` phút gần nhất
+        Trả về {road_id: {"North-South": float, "East-West": float}}
+        """
+        counts_pipeline = []
+        if window_minutes:
+            since = datetime.now() - timedelta(minutes=window_minutes)
+            counts_pipeline.append({"$match": {"timefrom": {"$gte": since}}})
+        else:
+            counts_pipeline += [{"$sort": {"timefrom": -1}}, {"$limit": limit}]
+        counts_pipeline.append({"$group": {"_id": "$direction_from", "total": {"$sum": "$totalCount"}}})
+
+        pipeline = [
+            {"$match": {"road_id": {"$in": road_ids}, "type": "camera"}},
+            # localField + pipeline (MongoDB 5.0+): dùng index (deviceID, timefrom)
+            {"$lookup": {
+                "from": self.aggregated_counts.name,
+                "localField": "device_id",
+                "foreignField": "deviceID",
+                "pipeline": counts_pipeline,
+                "as": "flows",
+            }},
+            {"$unwind": "$flows"},
+            {"$group": {
+                "_id": {"road_id": "$road_id", "direction": "$flows._id"},
+                "total": {"$sum": "$flows.total"},
+            }},
+        ]
+
+        result = {road_id: {"North-South": 0.0, "East-West": 0.0} for road_id in road_ids}
+        scale = 60.0 / window_minutes if window_minutes else 1.0
+        async for doc in self.devices.aggregate(pipeline):
+            phase = DIRECTION_TO_PHASE.get(doc["_id"]["direction"])
+            if phase is not None:
+                result[doc["_id"]["road_id"]][phase] += doc["total"] * scale
+        return result
+
     async def get_aggregated_counts_for_a_road_and_compute_vehicle_per_hour(
         self,
         road_id: str,
         limit: int = 60
     ):
         """
-        Khi có road id -> get all device with type camera from database have road_id
+        Khi có road id -> tổng totalCount của `limit` bản ghi gần nhất mỗi camera, theo pha NS/EW
         """
-        cursor = self.devices.find({"road_id": road_id, "type": "camera"})
-        cameras = await cursor.to_list(length=limit)
-        dict_result = {
-            "North-South": 0,
-            "East-West": 0
-        }
-        dict_lane = {
-            "North": 0,
-            "South": 0,
-            "East": 0,
-            "West": 0
-        }
-        for camera in cameras:
-            # get all aggregated vehicle counts from camera_id
-            camera_id = camera["device_id"]
-            print(camera_id)
-            cursor = self.aggregated_counts.find({
-                "deviceID": camera_id,
-            }).sort("timefrom", -1).limit(limit)
-            docs = await cursor.to_list(length=limit)
-            # compute sum or total count
-            for doc in docs:
-                dict_lane[doc["direction_from"]] += doc["totalCount"]
-
-        dict_result["North-South"] = dict_lane["North"] + dict_lane["South"]
-        dict_result["East-West"] = dict_lane["East"] + dict_lane["West"]
-        return dict_result
+        flows = await self.get_road_flow_rates([road_id], limit=limit)
+        return flows[road_id]
 
 
 # Global database instance
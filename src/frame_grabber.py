@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import deque
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from config import settings
+
+
+def is_file_source(stream_url: str) -> bool:
+    """True if the source is a local video file rather than a live stream/camera."""
+    return not (stream_url and (stream_url.startswith(('http://', 'https://', 'rtsp://')) or stream_url.isdigit()))
+
+
+class FrameGrabber:
+    """Thread that continuously drains a `cv2.VideoCapture` into a small ring buffer.
+
+    Live sources are read as fast as they deliver so OpenCV's internal buffer
+    never fills up; when the buffer is full the oldest frame is overwritten.
+    The consumer always takes the newest frame and everything older is
+    counted as dropped. Video files are paced at their native FPS and loop
+    forever, like the inline reader.
+    """
+
+    def __init__(self, cap: cv2.VideoCapture, is_file: bool, buffer_size: Optional[int] = None, name: str = "frame-grabber"):
+        self.cap = cap
+        self.is_file = is_file
+        self.buffer = deque(maxlen=max(1, buffer_size or settings.frame_buffer_size))
+        self.lock = threading.Lock()
+        self.failed = False # True khi stream live bị mất kết nối
+        self.frames_grabbed = 0
+        self._dropped_pending = 0
+        self._stop_event = threading.Event()
+        self._release_on_exit = False
+        self._release_lock = threading.Lock()
+        self._released = False
+        self.thread = threading.Thread(target=self._run, daemon=True, name=name)
+
+        source_fps = cap.get(cv2.CAP_PROP_FPS) if is_file else 0
+        self.frame_interval = 1 / (source_fps if source_fps and source_fps > 0 else settings.fps)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, release: bool = False):
+        """Stop the thread; with `release`, also release the capture once the thread no longer reads it.
+
+        A stalled live source can keep the thread inside `cap.read()` past the
+        join timeout. The capture is then released by the thread itself when
+        the read returns, never while it is still in use.
+        """
+        self._release_on_exit = release
+        self._stop_event.set()
+        if self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join(timeout=2)
+        if release and not self.thread.is_alive():
+            self._release()
+
+    def _release(self):
+        with self._release_lock:
+            if not self._released:
+                self._released = True
+                self.cap.release()
+
+    def _run(self):
+        try:
+            self._read_loop()
+        finally:
+            if self._release_on_exit:
+                self._release()
+
+    def _read_loop(self):
+        next_frame_time = time.monotonic()
+        read_failures = 0
+        while not self._stop_event.is_set():
+            ret, frame = self.cap.read()
+            if not ret:
+                read_failures += 1
+                if self.is_file and read_failures < 3:
+                    self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    continue
+                self.failed = True
+                break
+            read_failures = 0
+
+            with self.lock:
+                if len(self.buffer) == self.buffer.maxlen:
+                    self._dropped_pending += 1 # Ghi đè frame cũ nhất
+                self.buffer.append(frame)
+                self.frames_grabbed += 1
+
+            if self.is_file:
+                # Phát file theo đúng FPS gốc thay vì đọc hết tốc độ
+                next_frame_time += self.frame_interval
+                delay = next_frame_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_frame_time = time.monotonic()
+
+    def read_latest(self) -> Tuple[Optional[np.ndarray], int]:
+        """Return the newest frame (or None) and how many frames were dropped since the last call."""
+        with self.lock:
+            if not self.buffer:
+                return None, 0
+            frame = self.buffer.pop()
+            dropped = self._dropped_pending + len(self.buffer)
+            self.buffer.clear()
+            self._dropped_pending = 0
+        return frame, dropped
@@ -0,0 +1,133 @@
+import asyncio
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from config import settings
+from model_loader import get_class_names, load_detector
+
+VEHICLE_CLASS_NAMES = ['car', 'motorcycle', 'bus', 'truck', 'bicycle']
+
+
+class InferenceServer:
+    """Shared YOLO model that serves every VideoProcessor through micro-batches.
+
+    Each processor awaits `infer(frame)`; frames arriving within `max_wait_ms`
+    of each other are stacked into one model call (up to `max_batch_size`)
+    and the results are scattered back to the callers.
+    """
+
+    def __init__(self, model_path: Optional[str] = None,
+                 max_batch_size: Optional[int] = None, max_wait_ms: Optional[float] = None):
+        self.model = load_detector(model_path)
+        self.class_names = get_class_names(self.model)
+        self.vehicle_class_ids = {
+            k for k, v in self.class_names.items() if v in VEHICLE_CLASS_NAMES
+        }
+
+        self.max_batch_size = max(1, max_batch_size or settings.inference_batch_size)
+        wait_ms = settings.inference_max_wait_ms if max_wait_ms is None else max_wait_ms
+        self.max_wait = max(0.0, wait_ms) / 1000
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_task: Optional[asyncio.Task] = None
+        self.stats = {
+            'batches': 0,
+            'frames': 0,
+            'avg_batch_size': 0.0,
+            'last_batch_ms': 0.0,
+        }
+        print(f"InferenceServer ready ({settings.inference_backend}, {settings.inference_precision}) "
+              f"(max_batch_size={self.max_batch_size}, max_wait={self.max_wait * 1000:.0f}ms)")
+
+    def start(self):
+        """Start the batching task on the running event loop (idempotent)."""
+        if self._worker_task is None or self._worker_task.done():
+            self._queue = asyncio.Queue()
+            self._worker_task = asyncio.create_task(self._batch_loop())
+
+    async def stop(self):
+        if self._worker_task and not self._worker_task.done():
+            self._worker_task.cancel()
+            try:
+                await self._worker_task
+            except asyncio.CancelledError:
+                pass
+        self._worker_task = None
+
+    async def infer(self, frame: np.ndarray):
+        """Queue one frame and wait for its ultralytics `Results`."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((frame, future))
+        return await future
+
+    def _predict(self, frames: List[np.ndarray]):
+        return self.model(frames, conf=settings.conf_thresh, iou=settings.iou_thresh,
+                          classes=list(self.vehicle_class_ids), verbose=False)
+
+    async def _collect_batch(self) -> List[Tuple[np.ndarray, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            # Bỏ các request mà caller đã hủy (vd: processor bị stop)
+            batch = [(frame, future) for frame, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            try:
+                # Chạy model ngoài event loop để không chặn API/WebSocket
+                results = await loop.run_in_executor(None, self._predict, [frame for frame, _ in batch])
+            except Exception as e:
+                print(f"Error running batched inference: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+            self.stats['batches'] += 1
+            self.stats['frames'] += len(batch)
+            self.stats['avg_batch_size'] = round(self.stats['frames'] / self.stats['batches'], 2)
+            self.stats['last_batch_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    def get_stats(self) -> dict:
+        stats = self.stats.copy()
+        stats['queued'] = self._queue.qsize() if self._queue is not None else 0
+        return stats
+
+
+# Global inference server instance
+_inference_server = None
+
+def get_inference_server():
+    global _inference_server
+    if _inference_server is None:
+        _inference_server = InferenceServer()
+    return _inference_server
+
+def peek_inference_server():
+    """The inference server if it has been created, without loading the model."""
+    return _inference_server
@@ -1,45 +1,129 @@
 from mqtt_client import MQTTClient
+import asyncio
 import time
+from typing import Optional
 from database import get_database
 from video_processor import VideoProcessor
 
 db = get_database()
 
 class Light_Controller:
-    def __init__(self, mqtt: MQTTClient, is_auto: bool):
+    """Adaptive two-road light controller running as a background task.
+
+    Every `duration` seconds the `total` seconds of green are split between
+    road 1 and road 2 in proportion to the vehicles each processor counted
+    since the previous run, and the new cycles are published over MQTT.
+    Each road always gets at least `min_green` seconds of green, so `total`
+    must be at least `2 * min_green + yellow` seconds.
+    Counts are read as deltas of `counts_all`, which is never reset here,
+    so vehicles counted while a cycle is computed are not lost.
+    """
+
+    def __init__(self, mqtt: MQTTClient, is_auto: bool, duration: float = 60, total: int = 40, min_green: int = 5):
         self.mqtt = mqtt
         self.is_auto = is_auto
-        self.total_time = 40
+        self.total_time = total
+        self.duration = duration
+        self.time_yellow = 3000 # ms
+        self.min_green = min_green # s
+        self._task: Optional[asyncio.Task] = None
+        self._last_counts = (0, 0)
+        self.runs = 0
+        self.last_run: Optional[float] = None
+        self.last_cycle: Optional[dict] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, video_processor1: VideoProcessor, video_processor2: VideoProcessor, topic,
+              duration: Optional[float] = None, total: Optional[int] = None) -> bool:
+        """Start the control loop; False if it is already running. Raises ValueError if `total` is too short."""
+        if self.running:
+            return False
+        if total is not None and total < self.min_total:
+            raise ValueError(f"total must be at least {self.min_total} seconds")
+        if duration is not None:
+            self.duration = duration
+        if total is not None:
+            self.total_time = total
+        self.is_auto = True
+        # Mốc đếm ban đầu: chỉ tính xe đi qua từ lúc bật chế độ tự động
+        self._last_counts = (video_processor1.counts_all, video_processor2.counts_all)
+        self._task = asyncio.create_task(self._run(video_processor1, video_processor2, topic))
+        return True
+
+    @property
+    def min_total(self) -> int:
+        return 2 * self.min_green + self.time_yellow // 1000
+
+    async def stop(self):
+        self.is_auto = False
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
 
     async def control(self, video_processor1: VideoProcessor, video_processor2: VideoProcessor, topic, duration=60, total =40):
-        while True:
-            if self.is_auto == False:
-                return
-            time.sleep(duration)
-            count_1 = video_processor1.counts_all
-            count_2 = video_processor2.counts_all
-            video_processor1.counts_all = 0
-            video_processor2.counts_all = 0
+        """Kept for compatibility: starts the background loop and returns immediately."""
+        self.start(video_processor1, video_processor2, topic, duration=duration, total=total)
 
-            ratio1 = count_1/(count_1 + count_2)
-            time_green = int(total*ratio1)
-            time_red = total - time_green
-            time_yellow = 3000
+    async def _run(self, video_processor1: VideoProcessor, video_processor2: VideoProcessor, topic):
+        loop = asyncio.get_running_loop()
+        next_run = loop.time() + self.duration
+        while self.is_auto:
+            # asyncio.sleep thay cho time.sleep: không chặn event loop (API, stream, WebSocket)
+            await asyncio.sleep(max(0.0, next_run - loop.time()))
+            next_run += self.duration # Lịch cố định, không trôi theo thời gian xử lý
+            try:
+                self._apply_cycle(video_processor1, video_processor2, topic)
+            except Exception as e:
+                print(f"Light_Controller: error applying cycle: {e}")
 
-            time_green2 = time_red - time_yellow
-            time_red2 = time_yellow + time_green
-            time_yellow2 = 3000
+    def _apply_cycle(self, video_processor1: VideoProcessor, video_processor2: VideoProcessor, topic):
+        counts = (video_processor1.counts_all, video_processor2.counts_all)
+        count_1 = max(0, counts[0] - self._last_counts[0])
+        count_2 = max(0, counts[1] - self._last_counts[1])
+        self._last_counts = counts
 
+        total = self.total_time
+        time_yellow = self.time_yellow
+        yellow_s = time_yellow // 1000
+        # Không có xe nào: chia đều thay vì chia cho 0
+        ratio1 = count_1/(count_1 + count_2) if count_1 + count_2 > 0 else 0.5
+        # Kẹp để cả 2 đường luôn có ít nhất min_green giây xanh (không có thời gian âm khi một đường không có xe)
+        time_green = min(max(int(total*ratio1), self.min_green), total - yellow_s - self.min_green)
+        time_red = total - time_green
 
-            message1 = f"1,{time_green*1000},{time_yellow},{time_red*1000}"
-            message2 = f"1,{time_green2*1000},{time_yellow2},{time_red2*1000}"
-            self.mqtt.publish(topic=topic, payload=message1)
-            self.mqtt.publish(topic=topic, payload=message2)
-    
-    def cal_time():
-        pass
+        time_green2 = time_red - yellow_s
+        time_red2 = yellow_s + time_green
+        time_yellow2 = self.time_yellow
 
+        cycle_1 = (time_green*1000, time_yellow, time_red*1000)
+        cycle_2 = (time_green2*1000, time_yellow2, time_red2*1000)
+        # Kiểm tra cả 2 chu kỳ trước khi publish để 2 đường không bị lệch nhau
+        if min(cycle_1 + cycle_2) <= 0:
+            raise ValueError(f"Invalid cycle for total={total}s: road 1 {cycle_1}, road 2 {cycle_2}")
+        self.mqtt.publish_cycles([(1, *cycle_1), (2, *cycle_2)], topic=topic)
 
+        self.runs += 1
+        self.last_run = time.time()
+        self.last_cycle = {
+            'counts': {'1': count_1, '2': count_2},
+            'road_1': {'green': time_green*1000, 'yellow': time_yellow, 'red': time_red*1000},
+            'road_2': {'green': time_green2*1000, 'yellow': time_yellow2, 'red': time_red2*1000},
+        }
 
-            
-            
\ No newline at end of file
+    def status(self) -> dict:
+        return {
+            'is_auto': self.is_auto,
+            'running': self.running,
+            'duration': self.duration,
+            'total_time': self.total_time,
+            'runs': self.runs,
+            'last_run': self.last_run,
+            'last_cycle': self.last_cycle,
+        }
@@ -0,0 +1,92 @@
+"""Traffic light phases reconstructed from the per-second countdown telemetry.
+
+A light sends "ROAD,COLOR,timeDuration,remaining" every second. Once the
+color, its duration and the end time are known, every following tick of
+the same phase is predictable, so only phase changes need to reach the
+dashboards: they receive `endsAt` together with `serverTime` and count
+down locally.
+
+A tick starts a new phase when the color or the duration changes, or when
+its remaining time differs from the prediction by more than
+`drift_tolerance` seconds (light restarted, lost messages, clock drift).
+"""
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from config import settings
+from mqtt_payload import LightTelemetry
+
+
+@dataclass(frozen=True)
+class LightPhase:
+    road: str
+    color: str
+    duration: int       # timeDuration của pha (giây)
+    started_at: float   # epoch (giây)
+    ends_at: float
+
+    def remaining(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        return max(0, math.ceil(self.ends_at - now))
+
+    def to_message(self, topic: str, now: Optional[float] = None) -> dict:
+        """Same fields as a countdown message plus the phase timing (epoch ms)."""
+        remaining = self.remaining(now)
+        return {
+            "topic": topic,
+            "road": self.road,
+            "color": self.color,
+            "timeDuration": str(self.duration),
+            "content": str(remaining),
+            "remaining": remaining,
+            "startedAt": int(self.started_at * 1000),
+            "endsAt": int(self.ends_at * 1000),
+        }
+
+
+class PhaseTracker:
+    """Current phase of every road, updated from countdown telemetry."""
+
+    def __init__(self, drift_tolerance: Optional[float] = None):
+        self.drift_tolerance = settings.light_phase_drift if drift_tolerance is None else drift_tolerance
+        self.phases: Dict[str, LightPhase] = {}
+        self.topics: Dict[str, str] = {}  # road -> topic MQTT của tin gần nhất
+        self.stats = {'ticks': 0, 'phase_changes': 0, 'resyncs': 0}
+
+    def update(self, topic: str, record: LightTelemetry, now: Optional[float] = None) -> Optional[LightPhase]:
+        """Feed one telemetry message; return the new phase if it started one, else None."""
+        if record.is_status:
+            return None
+        now = time.time() if now is None else now
+        self.stats['ticks'] += 1
+        current = self.phases.get(record.road)
+        if current is not None and current.color == record.color and current.duration == record.time_duration:
+            if abs(current.ends_at - now - record.remaining) <= self.drift_tolerance:
+                return None # Tick đúng như dự đoán: client tự đếm ngược
+            self.stats['resyncs'] += 1
+        else:
+            self.stats['phase_changes'] += 1
+
+        phase = LightPhase(
+            road=record.road,
+            color=record.color,
+            duration=record.time_duration,
+            started_at=now + record.remaining - record.time_duration,
+            ends_at=now + record.remaining,
+        )
+        self.phases[record.road] = phase
+        self.topics[record.road] = topic
+        return phase
+
+    def snapshot(self, roads: Optional[Iterable[str]] = None, now: Optional[float] = None) -> List[dict]:
+        """Messages for the current phase of `roads` (all roads by default)."""
+        roads = self.phases.keys() if roads is None else roads
+        now = time.time() if now is None else now
+        return [self.phases[road].to_message(self.topics[road], now) for road in roads if road in self.phases]
+
+    def get_stats(self) -> dict:
+        stats = self.stats.copy()
+        stats['roads'] = len(self.phases)
+        return stats
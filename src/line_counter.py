@@ -0,0 +1,103 @@
+from typing import Tuple
+
+import numpy as np
+
+
+class LineCrossingCounter:
+    """Vectorized line-crossing counter for tracked detections.
+
+    The anchor of each box (bottom-center) is placed on one side of the
+    directed line start -> end using the sign of the 2D cross product. A
+    track is counted when its side flips between two observations while its
+    projection falls inside the segment, so any line orientation works.
+    Moving to the positive side is "in" (downwards for a left-to-right
+    horizontal line), the opposite is "out"; each track is counted at most
+    once per direction.
+
+    Per-track state lives in sorted NumPy arrays and tracks that have not
+    been seen for `max_missing_frames` updates are expired, so memory stays
+    bounded by the number of live tracks.
+    """
+
+    IN = 1
+    OUT = 2
+
+    def __init__(self, start: Tuple[float, float], end: Tuple[float, float], max_missing_frames: int = 30):
+        self.start = np.asarray(start, dtype=np.float64)
+        self.end = np.asarray(end, dtype=np.float64)
+        self.vector = self.end - self.start
+        self.length_sq = float(self.vector @ self.vector) or 1.0
+        self.max_missing_frames = max_missing_frames
+
+        self._ids = np.empty(0, dtype=np.int64)       # tracker_id, luôn được sắp xếp
+        self._sides = np.empty(0, dtype=np.int8)      # -1 / +1: phía của anchor so với vạch
+        self._counted = np.empty(0, dtype=np.uint8)   # bit IN / OUT đã đếm
+        self._last_seen = np.empty(0, dtype=np.int64)
+        self._frame = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def reset(self):
+        self._ids = self._ids[:0]
+        self._sides = self._sides[:0]
+        self._counted = self._counted[:0]
+        self._last_seen = self._last_seen[:0]
+
+    def update(self, xyxy: np.ndarray, tracker_id: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Feed one frame of tracked boxes; return (crossed_in, crossed_out) masks aligned with them."""
+        self._frame += 1
+        tracker_id = np.asarray(tracker_id, dtype=np.int64)
+        if len(tracker_id) == 0:
+            self._expire()
+            empty = np.zeros(0, dtype=bool)
+            return empty, empty
+
+        anchors = np.column_stack(((xyxy[:, 0] + xyxy[:, 2]) / 2, xyxy[:, 3])) - self.start
+        sides = np.sign(self.vector[0] * anchors[:, 1] - self.vector[1] * anchors[:, 0]).astype(np.int8)
+        projection = anchors @ self.vector / self.length_sq
+        within = (projection >= 0) & (projection <= 1)
+
+        # Tra cứu trạng thái cũ của các track bằng searchsorted
+        if len(self._ids):
+            idx = np.minimum(np.searchsorted(self._ids, tracker_id), len(self._ids) - 1)
+            known = self._ids[idx] == tracker_id
+            prev_sides = np.where(known, self._sides[idx], 0).astype(np.int8)
+            counted = np.where(known, self._counted[idx], 0).astype(np.uint8)
+        else:
+            idx = np.zeros(len(tracker_id), dtype=np.int64)
+            known = np.zeros(len(tracker_id), dtype=bool)
+            prev_sides = np.zeros(len(tracker_id), dtype=np.int8)
+            counted = np.zeros(len(tracker_id), dtype=np.uint8)
+
+        crossed_in = known & (prev_sides < 0) & (sides > 0) & within & ((counted & self.IN) == 0)
+        crossed_out = known & (prev_sides > 0) & (sides < 0) & within & ((counted & self.OUT) == 0)
+        counted = counted | np.where(crossed_in, self.IN, 0).astype(np.uint8) | np.where(crossed_out, self.OUT, 0).astype(np.uint8)
+        # Anchor nằm đúng trên vạch: giữ phía cũ để lần sau vẫn nhận ra lần vượt
+        sides = np.where(sides == 0, prev_sides, sides).astype(np.int8)
+
+        known_idx = idx[known]
+        self._sides[known_idx] = sides[known]
+        self._counted[known_idx] = counted[known]
+        self._last_seen[known_idx] = self._frame
+
+        new = ~known
+        if new.any():
+            ids = np.concatenate((self._ids, tracker_id[new]))
+            order = np.argsort(ids, kind="stable")
+            self._ids = ids[order]
+            self._sides = np.concatenate((self._sides, sides[new]))[order]
+            self._counted = np.concatenate((self._counted, counted[new]))[order]
+            self._last_seen = np.concatenate((self._last_seen, np.full(int(new.sum()), self._frame, dtype=np.int64)))[order]
+
+        self._expire()
+        return crossed_in, crossed_out
+
+    def _expire(self):
+        """Forget tracks the tracker has dropped."""
+        alive = self._frame - self._last_seen <= self.max_missing_frames
+        if not alive.all():
+            self._ids = self._ids[alive]
+            self._sides = self._sides[alive]
+            self._counted = self._counted[alive]
+            self._last_seen = self._last_seen[alive]
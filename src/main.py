@@ -1,4 +1,4 @@
-from fastapi import Depends, FastAPI, WebSocket, HTTPException, Body, WebSocketDisconnect
+from fastapi import Depends, FastAPI, WebSocket, HTTPException, Body
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, HTMLResponse
 from typing import List, Dict, Tuple
@@ -11,7 +11,7 @@ from websocket_manager import WebSocketManager
 import asyncio
 import os
 from pydantic import BaseModel
-from mqtt_client import MQTTClient
+from mqtt_client import LIGHTS_TOPIC, create_mqtt_client
 from light_controller import Light_Controller
 from pydantic import BaseModel, Field
 from typing import List, Optional
@@ -19,6 +19,7 @@ from bson import ObjectId
 from datetime import datetime
 import config
 from models import Road, Device, PyObjectId
+from persistence import get_write_behind
 # Get the base directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -41,10 +42,14 @@ video_processor1 = VideoProcessor(stream_port=PORT1)
 video_processor2 = VideoProcessor(stream_port=PORT1)
 loop = asyncio.get_event_loop()
 mqtt_websocket_manager = WebSocketManager()
-mqtt_client = MQTTClient(loop,mqtt_websocket_manager)
+mqtt_client = create_mqtt_client(loop, mqtt_websocket_manager)
 
 light_controller = Light_Controller(mqtt=mqtt_client, is_auto=False)
 
+# Số đếm camera dùng chung hub với tin MQTT để /ws/{topic} phục vụ được cả hai
+video_processor1.publish_stats_to(mqtt_websocket_manager, "stats/1")
+video_processor2.publish_stats_to(mqtt_websocket_manager, "stats/2")
+
 # Database dependency
 async def get_db():
     return get_database()
@@ -63,6 +68,10 @@ async def startup_event():
     except:
         print("MQTT connection failed. Please check your broker settings.")
     # mqtt_client.publish(settings.mqtt_topic_pub, "30000;5000;20000")
+    try:
+        await get_database().ensure_schema()
+    except Exception as e:
+        print(f"Error preparing database schema: {e}")
 
     """Initialize video processing on server startup"""
     try:
@@ -321,14 +330,35 @@ async def root():
 
 @app.post("/auto_control")
 async def auto_control(is_auto:bool):
+    """Giữ lại cho tương thích: bật/tắt điều khiển tự động (chạy nền, trả về ngay)"""
     if is_auto is None:
         raise HTTPException(status_code=400, detail="Khong biet")
-    light_controller.is_auto = is_auto
-    try:
-        await light_controller.control(video_processor1=video_processor1, video_processor2=video_processor2, topic=settings.mqtt_topic_pub)
-    except:
-        raise HTTPException(status_code=400, detail="Khong biet")
+    if is_auto:
+        light_controller.start(video_processor1=video_processor1, video_processor2=video_processor2, topic=settings.mqtt_topic_pub)
+    else:
+        await light_controller.stop()
     return {"status": 200, "messsage":"auto ok"}
+
+@app.post("/api/light-controller/start")
+async def start_light_controller(duration: Optional[float] = None, total: Optional[int] = None):
+    """Bật điều khiển đèn tự động theo số xe đếm được của 2 camera"""
+    if duration is not None and duration <= 0:
+        raise HTTPException(status_code=400, detail="duration must be positive")
+    try:
+        started = light_controller.start(video_processor1=video_processor1, video_processor2=video_processor2,
+                                         topic=settings.mqtt_topic_pub, duration=duration, total=total)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"started": started, **light_controller.status()}
+
+@app.post("/api/light-controller/stop")
+async def stop_light_controller():
+    await light_controller.stop()
+    return light_controller.status()
+
+@app.get("/api/light-controller/status")
+async def get_light_controller_status():
+    return light_controller.status()
     
 
 # Stream endpoints for both cameras
@@ -442,153 +472,60 @@ async def get_count_history(processor_id: int):
 # endpoint to change traffic cycles
 @app.post("/api/cycle")
 async def change_cycle(message: str):
-    greenTime1, redTime1 = map(int, message.split(","))
-    yellowTime1 = 3
-    redTime2 = greenTime1 + yellowTime1
-    yellowTime2 = 3
-    greenTime2 = redTime1 - yellowTime1
-    message1 = f"1,{greenTime1*1000},{yellowTime1*1000},{redTime1*1000}"
-    message2 = f"2,{greenTime2*1000},{yellowTime2*1000},{redTime2*1000}"
-    mqtt_client.publish(settings.mqtt_topic_pub, message1)
-    mqtt_client.publish(settings.mqtt_topic_pub, message2)
+    try:
+        greenTime1, redTime1 = map(int, message.split(","))
+        yellowTime1 = 3
+        redTime2 = greenTime1 + yellowTime1
+        yellowTime2 = 3
+        greenTime2 = redTime1 - yellowTime1
+        # Encode cả 2 chu kỳ trước khi publish: lỗi (vd. thời gian âm) không làm lệch 2 đường
+        mqtt_client.publish_cycles([
+            (1, greenTime1*1000, yellowTime1*1000, redTime1*1000),
+            (2, greenTime2*1000, yellowTime2*1000, redTime2*1000),
+        ])
+    except ValueError as e: # PayloadError là ValueError
+        raise HTTPException(status_code=400, detail=str(e))
     return {f"message_pub to {settings.mqtt_topic_pub}"}
 
 
 # WebSocket endpoints for both cameras
+# Không còn vòng lặp 1 giây cho mỗi client: processor publish số đếm khi có thay đổi,
+# JSON được tạo một lần và gửi cho mọi client đăng ký (client mới nhận ngay bản mới nhất)
 @app.websocket("/ws/stats/1")
 async def websocket_endpoint1(websocket: WebSocket):
     """WebSocket endpoint for real-time count updates from camera 1"""
-    await websocket.accept()
-    client_host = websocket.client.host
-    client_port = websocket.client.port
-    print(f"WebSocket connection 1 accepted from: {client_host}:{client_port}")
-    try:
-        while True:
-            # Send current counts every second
-            data_to_send = video_processor1.get_counts()
-            await websocket.send_json(data_to_send)
-            await asyncio.sleep(1)
-    except WebSocketDisconnect:
-        print(f"Client disconnected from websocket 1: {client_host}:{client_port}")
-    except asyncio.CancelledError:
-        print(f"WebSocket 1 task cancelled for: {client_host}:{client_port}")
-    except Exception as e:
-        print(f"WebSocket 1 error for {client_host}:{client_port}: {e} ({type(e).__name__})")
-        try:
-            await websocket.close(code=1011)
-        except Exception as close_exc:
-            print(f"Unexpected error during WebSocket 1 close: {close_exc}")
-    finally:
-        print(f"WebSocket 1 handler finished for: {client_host}:{client_port}")
+    await mqtt_websocket_manager.serve("stats/1", websocket)
 
 
 @app.websocket("/ws/stats/2")
 async def websocket_endpoint2(websocket: WebSocket):
     """WebSocket endpoint for real-time count updates from camera 2"""
-    await websocket.accept()
-    client_host = websocket.client.host
-    client_port = websocket.client.port
-    print(f"WebSocket connection 2 accepted from: {client_host}:{client_port}")
-    try:
-        while True:
-            # Send current counts every second
-            data_to_send = video_processor2.get_counts()
-            await websocket.send_json(data_to_send)
-            await asyncio.sleep(1)
-    except WebSocketDisconnect:
-        print(f"Client disconnected from websocket 2: {client_host}:{client_port}")
-    except asyncio.CancelledError:
-        print(f"WebSocket 2 task cancelled for: {client_host}:{client_port}")
-    except Exception as e:
-        print(f"WebSocket 2 error for {client_host}:{client_port}: {e} ({type(e).__name__})")
-        try:
-            await websocket.close(code=1011)
-        except Exception as close_exc:
-            print(f"Unexpected error during WebSocket 2 close: {close_exc}")
-    finally:
-        print(f"WebSocket 2 handler finished for: {client_host}:{client_port}")
+    await mqtt_websocket_manager.serve("stats/2", websocket)
+
+@app.get("/api/websocket/stats")
+async def get_websocket_stats():
+    """Thống kê hub WebSocket số đếm: số lần publish, bỏ qua do không đổi, số client mỗi topic"""
+    return mqtt_websocket_manager.get_stats()
     
 # WebSocket endpoint for MQTT data
+# /ws/mqtt1 và /ws/mqtt2 giữ lại cho dashboard cũ: cả hai nhận tin của mọi đèn như trước
 @app.websocket("/ws/mqtt1")
-async def websocket_mqtt_endpoint(websocket: WebSocket):
-    """WebSocket endpoint for real-time MQTT updates"""
-    await websocket.accept()  # Sử dụng accept trực tiếp vì chưa có phương thức connect trong code bạn chia sẻ
-    client_host = websocket.client.host
-    client_port = websocket.client.port
-    print(f"MQTT WebSocket connection accepted from: {client_host}:{client_port}")
-    # Thêm websocket vào danh sách kết nối của mqtt_websocket_manager
-    if not hasattr(mqtt_websocket_manager, "active_connections"):
-        mqtt_websocket_manager.active_connections = []
-    mqtt_websocket_manager.active_connections.append(websocket)
-    mqtt_websocket_manager.list_channel["mqtt1"] = websocket
-    
-    try:
-        # Gửi thông báo kết nối thành công
-        await websocket.send_json({
-            "type": "mqtt_connection",
-            "status": "connected",
-            "message": "Connected to MQTT WebSocket endpoint"
-        })
-        
-        # Giữ kết nối mở
-        while True:
-            # Chờ tin nhắn từ client (nếu cần)
-            data = await websocket.receive_text()
-            # Xử lý tin nhắn từ client nếu cần
-            print(f"Received message from MQTT WebSocket client")
-    except WebSocketDisconnect:
-        print(f"Client disconnected from MQTT websocket: {client_host}:{client_port}")
-        # Xóa websocket khỏi danh sách kết nối
-        if websocket in mqtt_websocket_manager.active_connections:
-            mqtt_websocket_manager.active_connections.remove(websocket)
-    except Exception as e:
-        print(f"MQTT WebSocket error: {e}")
-        # Xóa websocket khỏi danh sách kết nối trong trường hợp lỗi
-        if hasattr(mqtt_websocket_manager, "active_connections"):
-            if websocket in mqtt_websocket_manager.active_connections:
-                mqtt_websocket_manager.active_connections.remove(websocket)
-                mqtt_websocket_manager.list_channel.pop("mqtt1")
+async def websocket_mqtt_endpoint1(websocket: WebSocket):
+    """WebSocket endpoint for real-time MQTT updates (alias of /ws/lights)"""
+    await mqtt_websocket_manager.serve(LIGHTS_TOPIC, websocket)
 
-# WebSocket endpoint for MQTT data
 @app.websocket("/ws/mqtt2")
-async def websocket_mqtt_endpoint(websocket: WebSocket):
-    """WebSocket endpoint for real-time MQTT updates"""
-    await websocket.accept()  # Sử dụng accept trực tiếp vì chưa có phương thức connect trong code bạn chia sẻ
-    client_host = websocket.client.host
-    client_port = websocket.client.port
-    print(f"MQTT WebSocket connection accepted from: {client_host}:{client_port}")
-    
-    # Thêm websocket vào danh sách kết nối của mqtt_websocket_manager
-    if not hasattr(mqtt_websocket_manager, "active_connections"):
-        mqtt_websocket_manager.active_connections = []
-    mqtt_websocket_manager.active_connections.append(websocket)
-    mqtt_websocket_manager.list_channel["mqtt2"] = websocket
-    try:
-        # Gửi thông báo kết nối thành công
-        await websocket.send_json({
-            "type": "mqtt_connection",
-            "status": "connected",
-            "message": "Connected to MQTT WebSocket endpoint"
-        })
-        
-        # Giữ kết nối mở
-        while True:
-            # Chờ tin nhắn từ client (nếu cần)
-            data = await websocket.receive_text()
-            # Xử lý tin nhắn từ client nếu cần
-            print(f"Received message from MQTT WebSocket client")
-    except WebSocketDisconnect:
-        print(f"Client disconnected from MQTT websocket: {client_host}:{client_port}")
-        # Xóa websocket khỏi danh sách kết nối
-        if websocket in mqtt_websocket_manager.active_connections:
-            mqtt_websocket_manager.active_connections.remove(websocket)
-    except Exception as e:
-        print(f"MQTT WebSocket error: {e}")
-        # Xóa websocket khỏi danh sách kết nối trong trường hợp lỗi
-        if hasattr(mqtt_websocket_manager, "active_connections"):
-            if websocket in mqtt_websocket_manager.active_connections:
-                mqtt_websocket_manager.active_connections.remove(websocket)
-                mqtt_websocket_manager.list_channel.pop("mqtt2")
+async def websocket_mqtt_endpoint2(websocket: WebSocket):
+    """WebSocket endpoint for real-time MQTT updates (alias of /ws/lights)"""
+    await mqtt_websocket_manager.serve(LIGHTS_TOPIC, websocket)
+
+@app.websocket("/ws/{topic:path}")
+async def websocket_topic_endpoint(websocket: WebSocket, topic: str):
+    """Subscribe to one topic, e.g. /ws/lights/1 (one light), /ws/lights (all lights), /ws/stats/1 (camera counts).
+
+    Declared after the specific /ws/... endpoints so it does not shadow them.
+    """
+    await mqtt_websocket_manager.serve(topic, websocket)
 
 # ========== Road Endpoints ==========
 
@@ -713,6 +650,9 @@ async def shutdown_event():
     """Cleanup on shutdown"""
     video_processor1.stop()
     video_processor2.stop()
+    await light_controller.stop()
+    await mqtt_client.stop()
+    await get_write_behind().stop()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,6 @@
-from fastapi import Depends, FastAPI, WebSocket, HTTPException, Body, WebSocketDisconnect
+from fastapi import Depends, FastAPI, WebSocket, HTTPException, Body, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, HTMLResponse, Response
 from typing import List, Dict, Tuple
 import uvicorn
 from config import settings
@@ -12,7 +12,7 @@ from websocket_manager import WebSocketManager
 import asyncio
 import os
 from pydantic import BaseModel
-from mqtt_client import MQTTClient
+from mqtt_client import LIGHTS_TOPIC, create_mqtt_client
 from light_controller import Light_Controller
 from pydantic import BaseModel, Field
 from typing import List, Optional
@@ -21,6 +21,8 @@ from datetime import datetime
 import config
 from models import Road, Device, PyObjectId
 from utility import RoadManager
+from inference_server import InferenceServer, get_inference_server, peek_inference_server
+from persistence import get_write_behind
 from fastapi.logger import logger
 # Get the base directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -34,6 +36,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Define ports for each processor
@@ -44,7 +47,7 @@ line_start = (0, settings.frame_height2*4//5)  # Start from left side
 line_end = (settings.frame_width, settings.frame_height2*4//5)  # End at right side
 loop = asyncio.get_event_loop()
 mqtt_websocket_manager = WebSocketManager()
-mqtt_client = MQTTClient(loop,mqtt_websocket_manager)
+mqtt_client = create_mqtt_client(loop, mqtt_websocket_manager)
 
 light_controller = Light_Controller(mqtt=mqtt_client, is_auto=False)
 
@@ -55,6 +58,15 @@ class VideoProcessorManager:
     def __init__(self):
         self.processors: Dict[str, VideoProcessor] = {}
 
+    @property
+    def inference_server(self) -> Optional[InferenceServer]:
+        # Một model dùng chung, gom frame của mọi camera thành batch.
+        # Tạo lazy để process worker (spawn) import module này không phải load model.
+        # Chế độ process không dùng server này: mỗi worker có model riêng.
+        if not settings.shared_inference or settings.video_execution_mode == "process":
+            return None
+        return get_inference_server()
+
     def add_processor(self, device: Device):
         # check if processor_name already exists
         processor_id = device.device_id
@@ -65,6 +77,7 @@ class VideoProcessorManager:
             input_video_stream=device.ip_address,
             direction_from=device.direction_from,
             direction_to=device.direction_to,
+            inference_server=self.inference_server,
         )
         return {"status": "success", "message": f"Processor {processor_id} added."}
 
@@ -86,6 +99,11 @@ async def startup_event():
     except:
         print("MQTT connection failed. Please check your broker settings.")
     # mqtt_client.publish(settings.mqtt_topic_pub, "30000;5000;20000")
+    try:
+        await get_database().ensure_schema()
+    except Exception as e:
+        print(f"Error preparing database schema: {e}")
+    get_write_behind().start()
     cameras_from_database = await get_database().get_all_cameras()
     cnt = 0
     for camera in cameras_from_database:
@@ -113,6 +131,13 @@ async def startup_event():
         else:
             await road_manager.invoke_manual_control(road["id"])
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Dừng scheduler điều khiển đèn, ngắt MQTT và ghi nốt các bản ghi còn trong bộ đệm write-behind"""
+    await road_manager.shutdown()
+    await mqtt_client.stop()
+    await get_write_behind().stop()
+
 @app.post("/roads/{road_id}/auto", summary="Kích hoạt chế độ tự động cho nút giao")
 async def set_road_auto_control(road_id: str):
     try:
@@ -147,6 +172,32 @@ class CountingLineRequest(BaseModel):
     processor_id: int = 1  # Default to first processor
 
 
+class DeviceCountingLineRequest(BaseModel):
+    start: Tuple[int, int]  # (x, y): sai số phần tử trả về 422 thay vì lỗi 500 trong set_counting_line
+    end: Tuple[int, int]
+    roi_enabled: Optional[bool] = None  # Chỉ đưa dải quanh vạch đếm vào YOLO
+    roi_band_above: Optional[int] = None
+    roi_band_below: Optional[int] = None
+
+@app.post("/api/config/counting-line/{device_id}")
+async def set_device_counting_line(device_id: str, line: DeviceCountingLineRequest):
+    """Set the counting line (and optional detection ROI band) of a camera"""
+    processor = video_processor_manager.get_processor(device_id)
+    if not processor:
+        raise HTTPException(status_code=404, detail="Processor not found")
+    try:
+        processor.set_counting_line(tuple(line.start), tuple(line.end))
+        if line.roi_enabled is not None or line.roi_band_above is not None or line.roi_band_below is not None:
+            enabled = processor.roi_enabled if line.roi_enabled is None else line.roi_enabled
+            processor.set_roi(enabled, line.roi_band_above, line.roi_band_below)
+        return {
+            "status": "success",
+            "message": "Counting line set",
+            "roi": {"enabled": processor.roi_enabled, "band": list(processor.roi_band)},
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Thêm nhưng chưa biết dùng làm gì
 @app.post("/turn_on_camera")
 async def turn_on_camera(device_id: str):
@@ -181,105 +232,55 @@ async def turn_off_camera(device_id: str):
 # endpoint to change traffic cycles
 @app.post("/api/cycle")
 async def change_cycle(message: str):
-    greenTime1, redTime1 = map(int, message.split(","))
-    yellowTime1 = 3
-    redTime2 = greenTime1 + yellowTime1
-    yellowTime2 = 3
-    greenTime2 = redTime1 - yellowTime1
-    message1 = f"1,{greenTime1*1000},{yellowTime1*1000},{redTime1*1000}"
-    message2 = f"2,{greenTime2*1000},{yellowTime2*1000},{redTime2*1000}"
-    mqtt_client.publish(settings.mqtt_topic_pub, message1)
-    mqtt_client.publish(settings.mqtt_topic_pub, message2)
+    try:
+        greenTime1, redTime1 = map(int, message.split(","))
+        yellowTime1 = 3
+        redTime2 = greenTime1 + yellowTime1
+        yellowTime2 = 3
+        greenTime2 = redTime1 - yellowTime1
+        # Encode cả 2 chu kỳ trước khi publish: lỗi (vd. thời gian âm) không làm lệch 2 đường
+        mqtt_client.publish_cycles([
+            (1, greenTime1*1000, yellowTime1*1000, redTime1*1000),
+            (2, greenTime2*1000, yellowTime2*1000, redTime2*1000),
+        ])
+    except ValueError as e: # PayloadError là ValueError
+        raise HTTPException(status_code=400, detail=str(e))
     return {f"message_pub to {settings.mqtt_topic_pub}"}
 
 
 # WebSocket endpoint for MQTT data
+# /ws/mqtt1 và /ws/mqtt2 giữ lại cho dashboard cũ: cả hai nhận tin của mọi đèn như trước
 @app.websocket("/ws/mqtt1")
-async def websocket_mqtt_endpoint(websocket: WebSocket):
-    """WebSocket endpoint for real-time MQTT updates"""
-    await websocket.accept()  # Sử dụng accept trực tiếp vì chưa có phương thức connect trong code bạn chia sẻ
-    client_host = websocket.client.host
-    client_port = websocket.client.port
-    print(f"MQTT WebSocket connection accepted from: {client_host}:{client_port}")
-    # Thêm websocket vào danh sách kết nối của mqtt_websocket_manager
-    if not hasattr(mqtt_websocket_manager, "active_connections"):
-        mqtt_websocket_manager.active_connections = []
-    mqtt_websocket_manager.active_connections.append(websocket)
-    mqtt_websocket_manager.list_channel["mqtt1"] = websocket
-    
-    try:
-        # Gửi thông báo kết nối thành công
-        await websocket.send_json({
-            "type": "mqtt_connection",
-            "status": "connected",
-            "message": "Connected to MQTT WebSocket endpoint"
-        })
-        
-        # Giữ kết nối mở
-        while True:
-            # Chờ tin nhắn từ client (nếu cần)
-            data = await websocket.receive_text()
-            # Xử lý tin nhắn từ client nếu cần
-            print(f"Received message from MQTT WebSocket client")
-    except WebSocketDisconnect:
-        print(f"Client disconnected from MQTT websocket: {client_host}:{client_port}")
-        # Xóa websocket khỏi danh sách kết nối
-        if websocket in mqtt_websocket_manager.active_connections:
-            mqtt_websocket_manager.active_connections.remove(websocket)
-    except Exception as e:
-        print(f"MQTT WebSocket error: {e}")
-        # Xóa websocket khỏi danh sách kết nối trong trường hợp lỗi
-        if hasattr(mqtt_websocket_manager, "active_connections"):
-            if websocket in mqtt_websocket_manager.active_connections:
-                mqtt_websocket_manager.active_connections.remove(websocket)
-                mqtt_websocket_manager.list_channel.pop("mqtt1")
+async def websocket_mqtt_endpoint1(websocket: WebSocket):
+    """WebSocket endpoint for real-time MQTT updates (alias of /ws/lights)"""
+    await mqtt_websocket_manager.serve(LIGHTS_TOPIC, websocket)
 
-# WebSocket endpoint for MQTT data
 @app.websocket("/ws/mqtt2")
-async def websocket_mqtt_endpoint(websocket: WebSocket):
-    """WebSocket endpoint for real-time MQTT updates"""
-    await websocket.accept()  # Sử dụng accept trực tiếp vì chưa có phương thức connect trong code bạn chia sẻ
-    client_host = websocket.client.host
-    client_port = websocket.client.port
-    print(f"MQTT WebSocket connection accepted from: {client_host}:{client_port}")
-    
-    # Thêm websocket vào danh sách kết nối của mqtt_websocket_manager
-    if not hasattr(mqtt_websocket_manager, "active_connections"):
-        mqtt_websocket_manager.active_connections = []
-    mqtt_websocket_manager.active_connections.append(websocket)
-    mqtt_websocket_manager.list_channel["mqtt2"] = websocket
-    try:
-        # Gửi thông báo kết nối thành công
-        await websocket.send_json({
-            "type": "mqtt_connection",
-            "status": "connected",
-            "message": "Connected to MQTT WebSocket endpoint"
-        })
-        
-        # Giữ kết nối mở
-        while True:
-            # Chờ tin nhắn từ client (nếu cần)
-            data = await websocket.receive_text()
-            # Xử lý tin nhắn từ client nếu cần
-            print(f"Received message from MQTT WebSocket client")
-    except WebSocketDisconnect:
-        print(f"Client disconnected from MQTT websocket: {client_host}:{client_port}")
-        # Xóa websocket khỏi danh sách kết nối
-        if websocket in mqtt_websocket_manager.active_connections:
-            mqtt_websocket_manager.active_connections.remove(websocket)
-    except Exception as e:
-        print(f"MQTT WebSocket error: {e}")
-        # Xóa websocket khỏi danh sách kết nối trong trường hợp lỗi
-        if hasattr(mqtt_websocket_manager, "active_connections"):
-            if websocket in mqtt_websocket_manager.active_connections:
-                mqtt_websocket_manager.active_connections.remove(websocket)
-                mqtt_websocket_manager.list_channel.pop("mqtt2")
+async def websocket_mqtt_endpoint2(websocket: WebSocket):
+    """WebSocket endpoint for real-time MQTT updates (alias of /ws/lights)"""
+    await mqtt_websocket_manager.serve(LIGHTS_TOPIC, websocket)
+
+@app.websocket("/ws/{topic:path}")
+async def websocket_topic_endpoint(websocket: WebSocket, topic: str):
+    """Subscribe to one topic, e.g. /ws/lights/1 (one light), /ws/lights (all lights).
+
+    Declared after the specific /ws/... endpoints so it does not shadow them.
+    """
+    await mqtt_websocket_manager.serve(topic, websocket)
 
 # ========== Road Endpoints ==========
 
 @app.get("/api/roads/device/all", response_model=List[RoadResponse])
-async def list_roads(db: Database = Depends(get_db)):
-    roads = await db.get_all_roads_and_devices()
+async def list_roads(response: Response, limit: Optional[int] = None, after: Optional[str] = None,
+                     db: Database = Depends(get_db)):
+    """Roads kèm devices. Có `limit` thì phân trang: trang tiếp theo lấy bằng `after` = header X-Next-Cursor"""
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    if after is not None and not ObjectId.is_valid(after):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    roads = await db.get_all_roads_and_devices(limit=limit, after=after)
+    if limit is not None and len(roads) == limit:
+        response.headers["X-Next-Cursor"] = roads[-1]["id"]
     return roads
 
 @app.get("/api/roads", response_model=List[Road])
@@ -427,19 +428,75 @@ async def get_devices_by_road(road_id: str, db: Database = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Devices not found for this road")
     return devices
 
+@app.get("/api/inference/stats")
+async def get_inference_stats():
+    """Thống kê batch của inference server dùng chung"""
+    # Không đọc video_processor_manager.inference_server: property đó tạo server và load model
+    if not settings.shared_inference or settings.video_execution_mode == "process":
+        return {"shared_inference": False}
+    server = peek_inference_server()
+    if server is None:
+        return {"shared_inference": True, "loaded": False}
+    return {"shared_inference": True, "loaded": True, **server.get_stats()}
+
+@app.get("/api/cache/stats")
+async def get_cache_stats(db: Database = Depends(get_db)):
+    """Thống kê hit/miss của cache đọc trong Database"""
+    if db.cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **db.cache.get_stats()}
+
+@app.get("/api/mqtt/stats")
+async def get_mqtt_stats():
+    """Thống kê message MQTT (nhận, xử lý, bị bỏ do hàng đợi đầy, kết nối lại)"""
+    return mqtt_client.get_stats()
+
+@app.get("/api/persistence/stats")
+async def get_persistence_stats():
+    """Thống kê hàng đợi write-behind ghi số đếm xe xuống MongoDB"""
+    return get_write_behind().get_stats()
+
+@app.get("/api/websocket/stats")
+async def get_websocket_stats():
+    """Thống kê hub WebSocket: số lần publish, tin bị bỏ/gộp, số client mỗi topic"""
+    return mqtt_websocket_manager.get_stats()
+
+@app.get("/api/roads/scheduler/stats")
+async def get_scheduler_stats():
+    """Thống kê scheduler điều khiển tự động: số road đang lập lịch, kích thước batch, độ trễ lập lịch mỗi road"""
+    return road_manager.get_scheduler_stats()
+
 # ============ Video Streaming Endpoints for each Camera ==========
 @app.get("/api/devices/{device_id}/stream.mjpg")
-async def video_stream(device_id: str):
-    """Stream the processed video feed"""
+async def video_stream(device_id: str,
+                       w: Optional[int] = Query(None, ge=16, description="Chiều rộng (px), làm tròn lên theo STREAM_WIDTH_STEP"),
+                       q: Optional[int] = Query(None, ge=1, le=100, description="Chất lượng JPEG, làm tròn theo bậc 10"),
+                       fps: Optional[float] = Query(None, gt=0, le=60, description="Số frame tối đa mỗi giây")):
+    """Stream the processed video feed, e.g. ?w=320&q=60&fps=5 for a dashboard thumbnail.
+
+    Each (width, quality) tier is encoded once per frame and shared by all viewers of that tier.
+    """
     processor = video_processor_manager.get_processor(device_id)
     if not processor:
         raise HTTPException(status_code=404, detail="Processor not found")
 
     return StreamingResponse(
-        processor.generate_frames(),
+        processor.generate_frames(width=w, quality=q, fps=fps),
         media_type="multipart/x-mixed-replace; boundary=boundary"
     )
 
+@app.get("/api/devices/{device_id}/snapshot.jpg")
+async def video_snapshot(device_id: str, w: Optional[int] = Query(None, ge=16), q: Optional[int] = Query(None, ge=1, le=100)):
+    """Annotated snapshot of a camera (works even when annotation is headless)"""
+    processor = video_processor_manager.get_processor(device_id)
+    if not processor:
+        raise HTTPException(status_code=404, detail="Processor not found")
+
+    frame_bytes = await processor.get_snapshot(width=w, quality=q)
+    if frame_bytes is None:
+        raise HTTPException(status_code=503, detail="No frame available")
+    return Response(content=frame_bytes, media_type="image/jpeg")
+
 if __name__ == "__main__":
     # Ensure we're in the correct directory
     os.chdir(BASE_DIR)
@@ -0,0 +1,108 @@
+import os
+import shutil
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+from ultralytics import YOLO
+
+from config import settings
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# backend -> các mức precision hỗ trợ
+SUPPORTED_PRECISIONS = {
+    "torch": ("fp32",),
+    "onnx": ("fp32", "int8"),
+    "openvino": ("fp32", "fp16", "int8"),
+}
+
+
+def _exported_path(weights_path: str, backend: str, precision: str) -> str:
+    stem = os.path.splitext(weights_path)[0]
+    suffix = "" if precision == "fp32" else f"_{precision}"
+    if backend == "onnx":
+        return f"{stem}{suffix}.onnx"
+    # Ultralytics nhận dạng model OpenVINO qua đuôi thư mục "_openvino_model"
+    return f"{stem}{suffix}_openvino_model"
+
+
+def _export(weights_path: str, backend: str, precision: str, target: str):
+    """Export the PyTorch weights to `target` (done once, then reused)."""
+    print(f"Exporting {weights_path} to {backend} ({precision}) -> {target}")
+    model = YOLO(weights_path)
+    imgsz = max(settings.frame_width2, settings.frame_height2)
+
+    if backend == "onnx":
+        exported = model.export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+        if precision == "int8":
+            # Dynamic INT8 quantization của onnxruntime, không cần dữ liệu calibration
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(exported, target, weight_type=QuantType.QUInt8)
+            os.remove(exported)
+        elif os.path.abspath(exported) != os.path.abspath(target):
+            shutil.move(exported, target)
+        return
+
+    # dynamic=True: IR nhận batch bất kỳ (InferenceServer gom tối đa INFERENCE_BATCH_SIZE frame)
+    exported = model.export(format="openvino", imgsz=imgsz, dynamic=True,
+                            half=precision == "fp16", int8=precision == "int8")
+    if os.path.abspath(exported) != os.path.abspath(target):
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        shutil.move(exported, target)
+
+
+def load_detector(model_path: Optional[str] = None, backend: Optional[str] = None, precision: Optional[str] = None) -> YOLO:
+    """Load the YOLO detector for the configured inference backend.
+
+    "torch" uses the .pt weights (CUDA when available). "onnx" and
+    "openvino" run on CPU from an exported copy of the weights, which is
+    created next to them on first use. All backends share the ultralytics
+    call interface, so callers do not need to know which one is active.
+    """
+    weights_path = model_path or os.path.join(BASE_DIR, settings.model_path)
+    backend = (backend or settings.inference_backend).lower()
+    precision = (precision or settings.inference_precision).lower()
+    if backend not in SUPPORTED_PRECISIONS:
+        raise ValueError(f"Unknown inference backend '{backend}'. Use one of {list(SUPPORTED_PRECISIONS)}")
+    if precision not in SUPPORTED_PRECISIONS[backend]:
+        raise ValueError(f"Backend '{backend}' does not support precision '{precision}' "
+                         f"(supported: {SUPPORTED_PRECISIONS[backend]})")
+
+    if backend == "torch":
+        model = YOLO(weights_path)
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        model.to(device)
+        print(f"Loaded detector {weights_path} (torch, {device})")
+        return model
+
+    target = _exported_path(weights_path, backend, precision)
+    if not os.path.exists(target):
+        _export(weights_path, backend, precision, target)
+    model = YOLO(target, task="detect")
+    # Warm-up: model export chỉ có tên lớp sau khi predictor được khởi tạo
+    model.predict(np.zeros((settings.frame_height2, settings.frame_width2, 3), dtype=np.uint8), verbose=False)
+    print(f"Loaded detector {target} ({backend}, {precision})")
+    return model
+
+
+def load_class_names(model_path: Optional[str] = None) -> Dict[int, str]:
+    """Class names stored in the .pt weights, without building a detector.
+
+    Exported backends are created from the same weights, so the names are
+    the same for every backend.
+    """
+    weights_path = model_path or os.path.join(BASE_DIR, settings.model_path)
+    checkpoint = torch.load(weights_path, map_location="cpu", weights_only=False)
+    model = checkpoint.get("ema") or checkpoint["model"]
+    names = model.names
+    del checkpoint, model
+    return dict(enumerate(names)) if isinstance(names, (list, tuple)) else dict(names)
+
+
+def get_class_names(model: YOLO) -> Dict[int, str]:
+    names = model.names
+    if not names and model.predictor is not None:
+        names = model.predictor.model.names
+    return dict(names)
@@ -0,0 +1,62 @@
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from config import settings
+
+
+class MotionGate:
+    """Cheap frame-differencing pre-filter that tells when a scene is static.
+
+    Frames are downscaled to grayscale and compared with the previous one;
+    if fewer than `min_changed_ratio` of the pixels changed, nothing is
+    moving and the caller can skip the detector. A detection is still
+    forced every `max_gated_frames` so the tracker is refreshed.
+    """
+
+    def __init__(self, min_changed_ratio: Optional[float] = None, pixel_threshold: int = 25,
+                 width: int = 160, max_gated_frames: Optional[int] = None):
+        self.min_changed_ratio = settings.motion_min_changed_ratio if min_changed_ratio is None else min_changed_ratio
+        self.pixel_threshold = pixel_threshold
+        self.width = width
+        self.max_gated_frames = max_gated_frames or settings.fps * 2
+        self._previous: Optional[np.ndarray] = None
+        self._gated_in_a_row = 0
+        self.frames_checked = 0
+        self.frames_gated = 0
+
+    def reset(self):
+        self._previous = None
+        self._gated_in_a_row = 0
+
+    def _prepare(self, frame: np.ndarray) -> np.ndarray:
+        height = max(1, int(frame.shape[0] * self.width / frame.shape[1]))
+        small = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(gray, (5, 5), 0)
+
+    def has_motion(self, frame: np.ndarray, band: Optional[Tuple[int, int]] = None) -> bool:
+        """Return False when the frame (or the `band` rows of it) is static."""
+        if band is not None:
+            frame = frame[band[0]:band[1]]
+        if frame.size == 0:
+            return True
+
+        gray = self._prepare(frame)
+        previous, self._previous = self._previous, gray
+        self.frames_checked += 1
+        if previous is None or previous.shape != gray.shape:
+            return True
+
+        diff = cv2.absdiff(gray, previous)
+        _, changed = cv2.threshold(diff, self.pixel_threshold, 255, cv2.THRESH_BINARY)
+        changed_ratio = cv2.countNonZero(changed) / changed.size
+
+        if changed_ratio >= self.min_changed_ratio or self._gated_in_a_row >= self.max_gated_frames:
+            self._gated_in_a_row = 0
+            return True
+
+        self._gated_in_a_row += 1
+        self.frames_gated += 1
+        return False
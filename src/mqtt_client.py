@@ -2,23 +2,45 @@ import paho.mqtt.client as mqtt
 import threading
 import asyncio
 from config import settings
-from database import get_database
+from persistence import get_write_behind
 from datetime import datetime
 from models import TrafficLight, TrafficLightLog
 import time
+from typing import Awaitable, Callable, List, Optional, Tuple
 from websocket_manager import WebSocketManager
-lastest_mqtt_messages = {}
-dem = {}
-async def handle_sub_message(topic, message,websocket: WebSocketManager):
+from mqtt_payload import FORMAT_BINARY, FORMAT_CSV, LightTelemetry, PayloadError, encode_cycle, parse_telemetry
+from light_phase import PhaseTracker
+# Topic WebSocket của đèn: "lights/<road>" cho một road, "lights" cho mọi road
+LIGHTS_TOPIC = "lights"
+
+def light_topic(road) -> str:
+    return f"{LIGHTS_TOPIC}/{road}"
+
+def light_topics(road) -> Tuple[str, str]:
+    return light_topic(road), LIGHTS_TOPIC
+
+def phase_message(messages: List[dict], kind: str = "phase") -> dict:
+    """Phase event / snapshot; `serverTime` lets clients turn `endsAt` into a local countdown."""
+    return {"type": kind, "serverTime": int(time.time() * 1000), "messages": messages}
+
+async def handle_sub_message(topic, record: LightTelemetry, websocket: WebSocketManager,
+                             phases: Optional[PhaseTracker] = None):
     try:
         # global lastest_mqtt_messages
         # global dem
         # lastest_mqtt_messages[topic] = message
-        _db = get_database()
-        road, color, timeDuration, content = message.split(",")
-        if content not in ('ON','OFF'):
-            if(websocket):
-                await websocket.broadcast({"messages":[{
+        # record đã được parse một lần trong thread MQTT (CSV hoặc binary)
+        road, color, timeDuration, content = record.road, record.color, str(record.time_duration), record.content
+        if not record.is_status:
+            if(websocket and phases is not None):
+                # Chỉ gửi khi đổi pha; các tick còn lại client tự nội suy từ endsAt
+                phase = phases.update(topic, record)
+                if phase is not None:
+                    websocket.publish(light_topics(road), phase_message([phase.to_message(topic)]),
+                                      key=light_topic(road))
+            elif(websocket):
+                # Chỉ gửi cho client đăng ký đèn này (lights/<road>) hoặc tất cả đèn (lights)
+                websocket.publish(light_topics(road), {"messages":[{
                 
                     "topic": topic,
                     "road": road,
@@ -26,135 +48,314 @@ async def handle_sub_message(topic, message,websocket: WebSocketManager):
                     "timeDuration": timeDuration,
                     "content": content,
                 
-                }]})
+                }]}, key=light_topic(road))
         # if(content not in ["ON", "OFF"]):
         #     dem[topic] = int(content)
         #     print("đếm với topic", topic, "thời gian còn lại", dem[topic])
 
-        if(content in ["ON", "OFF"]):
-            existing_traffic_light = await _db.get_traffic_light_status(color, road)
-            if existing_traffic_light:
-                success = await _db.update_traffic_light_status(color, content, int(timeDuration), str(road))
-                if success:
-                    print(f"Đèn {color} đã được cập nhật trạng thái thành {content}")
-                else:
-                    print("Lỗi khi cập nhật trạng thái đèn.")
-            else:
-                trafficLight = TrafficLight(
-                    color=color,
-                    road=road,
-                    status=content,
-                    timeDuration=int(timeDuration)
-                )
-                await _db.save_traffic_light_status(trafficLight)
-                # print("Trạng thái đèn giao thông đã được lưu:", trafficLight)
+        # Ghi DB qua hàng đợi write-behind: gom lại và ghi theo batch (insert_many / bulk_write)
+        if(record.is_status):
+            # Một upsert thay cho đọc trạng thái rồi update/insert
+            trafficLight = TrafficLight(
+                color=color,
+                road=road,
+                status=content,
+                timeDuration=int(timeDuration)
+            )
+            if not get_write_behind().upsert_traffic_light_status(trafficLight):
+                print("Write-behind buffer is full, dropping traffic light status update.")
         else:
             status = "ON"
-            if(int(content) == 0):
+            if(record.remaining == 0):
                 status  = "OFF"
             trafficLightLog = TrafficLightLog(
                 color=color,
                 road=road,
                 status=status,
                 timeDuration=int(timeDuration),
-                timeRemaning=int(content),
+                timeRemaning=record.remaining,
                 timestamp=datetime.utcnow()
             )
-            await _db.save_traffic_light_log(trafficLightLog)
-            # print("Traffic light log saved:", trafficLightLog)
+            if not get_write_behind().add_traffic_light_log(trafficLightLog):
+                print("Write-behind buffer is full, dropping traffic light log.")
     except Exception as e:
         print("Error handling MQTT message:", e)
 
-class MQTTClient:
+MessageHandler = Callable[[str, bytes], Awaitable[None]]
+
+
+class _MQTTClientBase:
+    """State and publishing helpers shared by the thread and asyncio clients."""
+
     def __init__(self, loop: asyncio.AbstractEventLoop, websocket_manager: WebSocketManager):
-        self.client = mqtt.Client()
+        self.loop = loop
+        self.websocket_manager = websocket_manager
+        self.qos = settings.mqtt_qos
+        # Định dạng payload mỗi đèn đang dùng (road -> "csv" | "binary"), học từ tin nhắn đèn gửi lên
+        self.device_formats = {}
+        # Tin nhắn mới nhất của mỗi road
+        self.latest_messages = {}
+        # Pha hiện tại của mỗi đèn: WebSocket chỉ nhận sự kiện đổi pha (LIGHT_PHASE_EVENTS)
+        self.phases = PhaseTracker() if settings.light_phase_events else None
+        if self.phases is not None and websocket_manager is not None:
+            websocket_manager.set_snapshot_provider(LIGHTS_TOPIC, self._light_snapshot)
+        self.stats = {
+            'mode': 'thread',
+            'connected': False,
+            'received': 0,
+            'parse_errors': 0,
+        }
+
+    def _remember(self, record: LightTelemetry):
+        self.device_formats[record.road] = record.format
+        self.latest_messages[record.road] = record.to_csv()
+
+    def payload_format(self, road) -> str:
+        """Format used when publishing to `road`: forced by MQTT_PAYLOAD_FORMAT or negotiated from its telemetry."""
+        road = str(road)
+        if not road.isdigit():
+            return FORMAT_CSV # Frame binary chỉ chứa road dạng số
+        if settings.mqtt_payload_format in (FORMAT_CSV, FORMAT_BINARY):
+            return settings.mqtt_payload_format
+        return self.device_formats.get(road, FORMAT_CSV)
+
+    def publish_cycle(self, road, green_ms: int, yellow_ms: int, red_ms: int, topic: str = None):
+        """Publish a new light cycle (milliseconds) in the format the light understands."""
+        self.publish_cycles([(road, green_ms, yellow_ms, red_ms)], topic=topic)
+
+    def publish_cycles(self, cycles: List[Tuple], topic: str = None):
+        """Publish several (road, green_ms, yellow_ms, red_ms) cycles, or none of them.
+
+        Every cycle is encoded first, so a PayloadError on one road leaves all
+        lights on their previous cycle instead of out of sync.
+        """
+        payloads = [encode_cycle(road, green_ms, yellow_ms, red_ms, self.payload_format(road))
+                    for road, green_ms, yellow_ms, red_ms in cycles]
+        for payload in payloads:
+            self.publish(topic or settings.mqtt_topic_pub, payload)
+
+    def publish(self, topic: str, payload):
+        # pub 1 message dạng "ROAD,GreenTimeDuration,YellowTimeDuration,RedTimeDuration" đơn vị ms "1,20000,5000,30000" hiện tại dùng 2 đường là 1 và 2
+        self.client.publish(topic, payload, qos=self.qos)
+
+    def _light_snapshot(self, topic: str) -> Optional[dict]:
+        """Current phase of every light of `topic` (lights or lights/<road>) for a new subscriber."""
+        roads = None if topic == LIGHTS_TOPIC else [topic[len(LIGHTS_TOPIC) + 1:]]
+        messages = self.phases.snapshot(roads)
+        return phase_message(messages, kind="snapshot") if messages else None
+
+    def get_stats(self) -> dict:
+        stats = self.stats.copy()
+        if self.phases is not None:
+            stats['phases'] = self.phases.get_stats()
+        return stats
+
+
+class MQTTClient(_MQTTClientBase):
+    def __init__(self, loop: asyncio.AbstractEventLoop, websocket_manager: WebSocketManager):
+        super().__init__(loop, websocket_manager)
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
-        self.loop = loop
         self.thread = threading.Thread(target=self._start_loop, daemon=True)
-        self.websocket_manager = websocket_manager
-    
-    async def _periodic_websocket_update(self):
-        global lastest_mqtt_messages
-        global dem
-            
-        while True:
-            if lastest_mqtt_messages and self.websocket_manager:
-                # Tạo một bản sao của tin nhắn mới nhất để tránh thay đổi trong quá trình xử lý
-                messages_to_send = lastest_mqtt_messages.copy()
-                
-                # Chuyển thành định dạng dễ đọc cho frontend
-                formatted_messages = []
-                for topic, message in messages_to_send.items():
-                    try:
-                        road, color, timeDuration, content = message.split(",")
-                        print(f"MQTT Message received on hello {topic}: {message} second:{dem[topic]}")
-
-                        formatted_messages.append({
-                            "topic": topic,
-                            "road": road,
-                            "color": color,
-                            "timeDuration": timeDuration,
-                            "content": dem[topic],
-
-                        })
-                        dem[topic] -= 1
-                        
-                    except Exception:
-                        # Nếu định dạng không đúng, gửi thông tin thô
-                        formatted_messages.append({
-                            "topic": topic,
-                            "raw_message": message
-                        })
-                
-                # Gửi đến tất cả clients
-                if formatted_messages:
-                    await self.websocket_manager.broadcast( {
-                        "type": "mqtt_update",
-                        "timestamp": datetime.now().isoformat(),
-                        "messages": formatted_messages
-                    })
-                
-            
-            # Đợi 1 giây trước khi gửi cập nhật tiếp theo
-            await asyncio.sleep(1)
 
     def connect(self):
         self.client.connect(settings.mqtt_broker, settings.mqtt_port, 60)
         self.thread.start()
-        # if self.websocket_manager:
-            # print("Starting periodic websocket update task")
-            # self.timer_task = asyncio.run_coroutine_threadsafe(
-            #     self._periodic_websocket_update(), 
-            #     self.loop
-            # )
+
+    async def stop(self):
+        self.client.disconnect()
 
     def _start_loop(self):
         self.client.loop_forever()
 
     def on_connect(self, client, userdata, flags, rc):
         print("MQTT Connected with result code " + str(rc))
-        self.client.subscribe(settings.mqtt_topic_sub)
+        self.stats['connected'] = rc == 0
+        self.client.subscribe(settings.mqtt_topic_sub, qos=self.qos)
+
+    def on_disconnect(self, client, userdata, rc):
+        self.stats['connected'] = False
 
     def on_message(self, client, userdata, msg):
-        global lastest_mqtt_messages, dem
         topic = msg.topic
-        message = msg.payload.decode()
-        # nhận message dạng "ROAD,COLOR,timeDuration,content" phần content có thể là trạng thái ON/OFF của đèn hoặc là thời gian còn lại của đèn
-        # print(f"MQTT Message received on topic {topic}: {message}")
-        road = message.split(",")[0]
-        lastest_mqtt_messages[road] = message
-        road, color, timeDuration, content = message.split(",")
-        if(content not in ["ON", "OFF"]):
-            dem[road] = int(content)
-            # print("đếm với topic", road, "thời gian còn lại", dem[road])
-
+        self.stats['received'] += 1
+        # Parse một lần ở đây: nhận dạng "ROAD,COLOR,timeDuration,content" hoặc frame binary (xem mqtt_payload.py)
+        try:
+            record = parse_telemetry(msg.payload)
+        except PayloadError as e:
+            self.stats['parse_errors'] += 1
+            print(f"Ignoring MQTT message on topic {topic}: {e}")
+            return
+        # print(f"MQTT Message received on topic {topic}: {record}")
+        self._remember(record)
 
         asyncio.run_coroutine_threadsafe(
-            handle_sub_message(topic, message, self.websocket_manager),
+            handle_sub_message(topic, record, self.websocket_manager, self.phases),
             self.loop
         )
 
-    def publish(self, topic: str, payload: str):
-        # pub 1 message dạng "ROAD,GreenTimeDuration,YellowTimeDuration,RedTimeDuration" đơn vị ms "1,20000,5000,30000" hiện tại dùng 2 đường là 1 và 2
-        self.client.publish(topic, payload)
+
+class AsyncMQTTClient(_MQTTClientBase):
+    """MQTT client driven by the asyncio event loop instead of a paho network thread.
+
+    paho's socket is registered with `loop.add_reader` / `add_writer` and
+    `loop_misc` (keepalive) runs as a task, so callbacks execute on the
+    event loop without thread hops. Incoming messages go into a bounded
+    queue (the newest are dropped when it is full) and a dispatcher task
+    routes them to the handlers whose topic filter matches. Lost
+    connections are re-established with exponential backoff.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, websocket_manager: WebSocketManager,
+                 qos: Optional[int] = None, queue_size: Optional[int] = None):
+        super().__init__(loop, websocket_manager)
+        if qos is not None:
+            self.qos = qos
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+        self.handlers: List[Tuple[str, MessageHandler]] = []
+        self.add_handler(settings.mqtt_topic_sub, self._handle_light_message)
+        self._inbound: asyncio.Queue = asyncio.Queue(maxsize=queue_size or settings.mqtt_queue_size)
+        self._dispatch_task: Optional[asyncio.Task] = None
+        self._misc_task: Optional[asyncio.Task] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.stats.update({
+            'mode': 'asyncio',
+            'handled': 0,
+            'dropped': 0,
+            'handler_errors': 0,
+            'reconnects': 0,
+            'avg_handle_ms': 0.0,
+        })
+
+    def add_handler(self, topic_filter: str, handler: MessageHandler):
+        """Route messages matching `topic_filter` (MQTT wildcards allowed) to `handler(topic, payload)`."""
+        self.handlers.append((topic_filter, handler))
+        if self.client.is_connected():
+            self.client.subscribe(topic_filter, qos=self.qos)
+
+    def connect(self):
+        """Connect to the broker; must be called from the running event loop."""
+        self.loop = asyncio.get_running_loop()
+        self._stopping = False
+        if self._dispatch_task is None or self._dispatch_task.done():
+            self._dispatch_task = self.loop.create_task(self._dispatch_loop())
+        try:
+            self.client.connect(settings.mqtt_broker, settings.mqtt_port, 60)
+        except OSError as e:
+            print(f"MQTT connection failed ({e}). Retrying in the background...")
+            self._schedule_reconnect()
+
+    async def stop(self):
+        self._stopping = True
+        self.client.disconnect()
+        for task in (self._reconnect_task, self._misc_task, self._dispatch_task):
+            if task is not None and not task.done():
+                task.cancel()
+
+    # --- Tích hợp socket của paho với event loop ---
+    def _on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        if self._misc_task is None or self._misc_task.done():
+            self._misc_task = self.loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        # Keepalive/ping và timeout; dừng khi mất kết nối
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    # --- Kết nối / kết nối lại ---
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        print(f"MQTT Connected with result code {reason_code}")
+        if reason_code.is_failure:
+            return
+        self.stats['connected'] = True
+        topic_filters = list(dict.fromkeys(topic_filter for topic_filter, _ in self.handlers))
+        if topic_filters:
+            client.subscribe([(topic_filter, self.qos) for topic_filter in topic_filters])
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self.stats['connected'] = False
+        if not self._stopping:
+            print(f"MQTT disconnected ({reason_code}). Reconnecting...")
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = self.loop.create_task(self._reconnect_loop())
+
+    async def _reconnect_loop(self):
+        delay = 1.0
+        while not self._stopping and not self.client.is_connected():
+            await asyncio.sleep(delay)
+            try:
+                self.client.reconnect()
+                self.stats['reconnects'] += 1
+                return
+            except OSError as e:
+                print(f"MQTT reconnect failed: {e}. Next attempt in {min(delay * 2, settings.mqtt_reconnect_max_delay):.0f}s")
+                delay = min(delay * 2, settings.mqtt_reconnect_max_delay)
+
+    # --- Nhận và định tuyến message ---
+    def _on_message(self, client, userdata, msg):
+        self.stats['received'] += 1
+        try:
+            self._inbound.put_nowait((msg.topic, msg.payload))
+        except asyncio.QueueFull:
+            self.stats['dropped'] += 1
+
+    async def _dispatch_loop(self):
+        while True:
+            topic, payload = await self._inbound.get()
+            started = time.perf_counter()
+            for topic_filter, handler in self.handlers:
+                if mqtt.topic_matches_sub(topic_filter, topic):
+                    try:
+                        await handler(topic, payload)
+                    except Exception as e:
+                        self.stats['handler_errors'] += 1
+                        print(f"Error in MQTT handler for {topic}: {e}")
+            self.stats['handled'] += 1
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.stats['avg_handle_ms'] = round(0.9 * self.stats['avg_handle_ms'] + 0.1 * elapsed_ms, 3)
+
+    async def _handle_light_message(self, topic: str, payload: bytes):
+        try:
+            record = parse_telemetry(payload)
+        except PayloadError as e:
+            self.stats['parse_errors'] += 1
+            print(f"Ignoring MQTT message on topic {topic}: {e}")
+            return
+        self._remember(record)
+        await handle_sub_message(topic, record, self.websocket_manager, self.phases)
+
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        stats['queued'] = self._inbound.qsize()
+        return stats
+
+
+def create_mqtt_client(loop: asyncio.AbstractEventLoop, websocket_manager: WebSocketManager):
+    """MQTT_MODE=asyncio chạy client trên event loop, mặc định dùng thread của paho."""
+    if settings.mqtt_mode == "asyncio":
+        return AsyncMQTTClient(loop, websocket_manager)
+    return MQTTClient(loop, websocket_manager)
@@ -0,0 +1,138 @@
+"""Traffic light MQTT payloads: the legacy CSV text and a compact binary layout.
+
+Telemetry (light -> server, MQTT_TOPIC_SUB)
+    CSV:    "ROAD,COLOR,timeDuration,content"   content = "ON" | "OFF" | remaining seconds
+    binary: <B magic=0xA5> <H road> <B color> <H timeDuration> <B kind> <H remaining>   (9 bytes)
+            color: 0 = RED, 1 = YELLOW, 2 = GREEN
+            kind:  0 = countdown, 1 = ON, 2 = OFF
+
+Cycle (server -> light, MQTT_TOPIC_PUB)
+    CSV:    "ROAD,green_ms,yellow_ms,red_ms"
+    binary: <B magic=0xA6> <H road> <I green_ms> <I yellow_ms> <I red_ms>   (15 bytes)
+
+All binary fields are little-endian (native on the ESP32). The magic byte is
+never a printable character, so both formats can share a topic.
+"""
+import struct
+from dataclasses import dataclass
+from typing import Optional, Union
+
+FORMAT_CSV = "csv"
+FORMAT_BINARY = "binary"
+
+TELEMETRY_MAGIC = 0xA5
+TELEMETRY_STRUCT = struct.Struct("<BHBHBH")
+CYCLE_MAGIC = 0xA6
+CYCLE_STRUCT = struct.Struct("<BHIII")
+
+COLORS = ("RED", "YELLOW", "GREEN")
+COLOR_CODES = {color: code for code, color in enumerate(COLORS)}
+KIND_COUNTDOWN, KIND_ON, KIND_OFF = 0, 1, 2
+STATUS_KINDS = {"ON": KIND_ON, "OFF": KIND_OFF}
+KIND_STATUS = {KIND_ON: "ON", KIND_OFF: "OFF"}
+
+
+class PayloadError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class LightTelemetry:
+    """One parsed telemetry message from a traffic light."""
+    road: str
+    color: str
+    time_duration: int
+    status: Optional[str]      # "ON" / "OFF" cho tin trạng thái, None cho tin đếm ngược
+    remaining: Optional[int]   # số giây còn lại cho tin đếm ngược
+    format: str = FORMAT_CSV
+
+    @property
+    def is_status(self) -> bool:
+        return self.status is not None
+
+    @property
+    def content(self) -> str:
+        """The legacy `content` field: "ON" / "OFF" or the remaining seconds."""
+        return self.status if self.status is not None else str(self.remaining)
+
+    def to_csv(self) -> str:
+        return f"{self.road},{self.color},{self.time_duration},{self.content}"
+
+
+def parse_telemetry(payload: Union[bytes, str]) -> LightTelemetry:
+    """Parse a CSV or binary telemetry payload, raising PayloadError if it is malformed."""
+    if isinstance(payload, (bytes, bytearray)) and payload[:1] == bytes((TELEMETRY_MAGIC,)):
+        if len(payload) != TELEMETRY_STRUCT.size:
+            raise PayloadError(f"Binary telemetry must be {TELEMETRY_STRUCT.size} bytes, got {len(payload)}")
+        _, road, color, time_duration, kind, remaining = TELEMETRY_STRUCT.unpack(payload)
+        if color >= len(COLORS) or kind not in (KIND_COUNTDOWN, KIND_ON, KIND_OFF):
+            raise PayloadError(f"Invalid binary telemetry: color={color}, kind={kind}")
+        return LightTelemetry(
+            road=str(road),
+            color=COLORS[color],
+            time_duration=time_duration,
+            status=KIND_STATUS.get(kind),
+            remaining=remaining if kind == KIND_COUNTDOWN else None,
+            format=FORMAT_BINARY,
+        )
+
+    text = payload
+    try:
+        if isinstance(payload, (bytes, bytearray)):
+            text = payload.decode()
+        road, color, time_duration, content = text.split(",")
+        if content in STATUS_KINDS:
+            return LightTelemetry(road, color, int(time_duration), content, None, FORMAT_CSV)
+        return LightTelemetry(road, color, int(time_duration), None, int(content), FORMAT_CSV)
+    except ValueError as e:
+        raise PayloadError(f"Invalid CSV telemetry {text!r}: {e}") from e
+
+
+def encode_telemetry(record: LightTelemetry, payload_format: str = FORMAT_BINARY) -> Union[bytes, str]:
+    if payload_format == FORMAT_CSV:
+        return record.to_csv()
+    kind = STATUS_KINDS[record.status] if record.is_status else KIND_COUNTDOWN
+    return TELEMETRY_STRUCT.pack(TELEMETRY_MAGIC, int(record.road), COLOR_CODES[record.color],
+                                 record.time_duration, kind, record.remaining or 0)
+
+
+MAX_ROAD = 0xFFFF
+MAX_DURATION_MS = 0xFFFFFFFF
+
+
+def encode_cycle(road: Union[int, str], green_ms: int, yellow_ms: int, red_ms: int,
+                 payload_format: str = FORMAT_CSV) -> Union[bytes, str]:
+    """Encode a light cycle, raising PayloadError if a field is out of range; binary needs a numeric road id."""
+    durations = {"green_ms": int(green_ms), "yellow_ms": int(yellow_ms), "red_ms": int(red_ms)}
+    for name, value in durations.items():
+        if not 0 <= value <= MAX_DURATION_MS:
+            raise PayloadError(f"Invalid cycle for road {road}: {name}={value} must be in [0, {MAX_DURATION_MS}]")
+    green_ms, yellow_ms, red_ms = durations.values()
+    if payload_format == FORMAT_BINARY:
+        try:
+            road_id = int(road)
+        except ValueError:
+            raise PayloadError(f"Binary cycle needs a numeric road id, got {road!r}") from None
+        if not 0 <= road_id <= MAX_ROAD:
+            raise PayloadError(f"Binary cycle road id must be in [0, {MAX_ROAD}], got {road_id}")
+        return CYCLE_STRUCT.pack(CYCLE_MAGIC, road_id, green_ms, yellow_ms, red_ms)
+    return f"{road},{green_ms},{yellow_ms},{red_ms}"
+
+
+if __name__ == "__main__":
+    # Kiểm tra round-trip nhanh: python mqtt_payload.py
+    for text in ("1,RED,30,12", "2,GREEN,20,ON"):
+        record = parse_telemetry(text)
+        assert parse_telemetry(encode_telemetry(record)) == LightTelemetry(**{**record.__dict__, "format": FORMAT_BINARY})
+        assert record.to_csv() == text
+
+    assert encode_cycle(1, 20000, 3000, 30000) == "1,20000,3000,30000"
+    assert CYCLE_STRUCT.unpack(encode_cycle(1, 20000, 3000, 30000, FORMAT_BINARY)) == (CYCLE_MAGIC, 1, 20000, 3000, 30000)
+    for args in ((1, -3000, 3000, 30000), (70000, 20000, 3000, 30000), ("A", 20000, 3000, 30000)):
+        try:
+            encode_cycle(*args, payload_format=FORMAT_BINARY)
+        except PayloadError as e:
+            print(f"rejected {args}: {e}")
+        else:
+            raise AssertionError(f"encode_cycle{args} should raise PayloadError")
+    print("mqtt_payload round-trip OK")
@@ -0,0 +1,259 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from pymongo.errors import AutoReconnect, BulkWriteError, ConnectionFailure, NetworkTimeout
+
+from config import settings
+from database import Database, get_database
+from models import AggregatedVehicleCount, TrafficLight, TrafficLightLog, VehicleCount
+
+# Lỗi tạm thời của MongoDB: giữ lại bản ghi và thử lại
+TRANSIENT_ERRORS = (AutoReconnect, NetworkTimeout, ConnectionFailure)
+DUPLICATE_KEY = 11000
+
+
+class WriteBehindQueue:
+    """Write-behind buffer shared by all processors and the MQTT handler.
+
+    Processors call `add_*` (non-blocking) instead of awaiting an insert in
+    the frame loop. Records are grouped per collection and written with
+    `insert_many` whenever `batch_size` records are waiting or every
+    `flush_interval` seconds. At most `max_buffered` records are held: when
+    the buffer is full `add_*` returns False and the caller keeps its
+    counts to retry later (backpressure).
+
+    Records added with a key are coalesced: `add_latest` keeps only the
+    newest document per key until the next flush, and `add_upsert` merges
+    the fields of all pending updates per key into one upsert, written with
+    `bulk_write`.
+
+    Transient errors are retried with exponential backoff. Records keep the
+    `_id` assigned by the first attempt, so a retried batch skips the ones
+    already written (duplicate keys) instead of inserting them twice.
+    """
+
+    def __init__(self, db: Database, batch_size: Optional[int] = None, flush_interval: Optional[float] = None,
+                 max_buffered: Optional[int] = None, max_retries: Optional[int] = None):
+        self.db = db
+        self.batch_size = max(1, batch_size or settings.persist_batch_size)
+        self.flush_interval = flush_interval or settings.persist_flush_interval
+        self.max_buffered = max(self.batch_size, max_buffered or settings.persist_max_buffered)
+        self.max_retries = settings.persist_max_retries if max_retries is None else max_retries
+
+        self._buffers: Dict[str, Deque[dict]] = {}
+        self._latest: Dict[str, "OrderedDict[Hashable, dict]"] = {}
+        self._upserts: Dict[str, "OrderedDict[Hashable, Tuple[dict, dict]]"] = {}
+        self._buffered = 0
+        self._flush_event: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            'enqueued': 0,
+            'coalesced': 0,
+            'written': 0,
+            'rejected': 0,
+            'dropped': 0,
+            'flushes': 0,
+            'retries': 0,
+            'failed_flushes': 0,
+            'last_flush_ms': 0.0,
+        }
+
+    # --- Producer side ---
+    def add_vehicle_count(self, count: VehicleCount) -> bool:
+        return self.add_many(self.db.counts.name, [count.dict()])
+
+    def add_vehicle_counts(self, counts: List[VehicleCount]) -> bool:
+        return self.add_many(self.db.counts.name, [count.dict() for count in counts])
+
+    def add_aggregated_count(self, count: AggregatedVehicleCount) -> bool:
+        return self.add_many(self.db.aggregated_counts.name, [count.dict(by_alias=True)])
+
+    def add_traffic_light_log(self, log: TrafficLightLog) -> bool:
+        if settings.light_log_coalesce:
+            # Chỉ giữ tick mới nhất của mỗi đèn trong mỗi lần flush
+            return self.add_latest(self.db.traffic_light_log.name, (log.road, log.color), log.dict())
+        return self.add_many(self.db.traffic_light_log.name, [log.dict()])
+
+    def upsert_traffic_light_status(self, light: TrafficLight) -> bool:
+        added = self.add_upsert(self.db.traffic_light.name, {"color": light.color, "road": light.road},
+                                {"status": light.status, "timeDuration": light.timeDuration})
+        if added:
+            self.db.remember_traffic_light(light)
+        return added
+
+    def add_many(self, collection_name: str, documents: List[dict]) -> bool:
+        """Buffer documents for `collection_name`; False if the buffer is full (nothing is added)."""
+        if not self._reserve(len(documents)):
+            return False
+        self._buffers.setdefault(collection_name, deque()).extend(documents)
+        self._added(len(documents))
+        return True
+
+    def add_latest(self, collection_name: str, key: Hashable, document: dict) -> bool:
+        """Buffer an insert that replaces any pending insert with the same key."""
+        pending = self._latest.setdefault(collection_name, OrderedDict())
+        if key in pending:
+            pending[key] = document
+            self.stats['coalesced'] += 1
+            return True
+        if not self._reserve(1):
+            return False
+        pending[key] = document
+        self._added(1)
+        return True
+
+    def add_upsert(self, collection_name: str, filter: dict, values: dict) -> bool:
+        """Buffer `$set: values` on the document matching `filter` (created if missing)."""
+        pending = self._upserts.setdefault(collection_name, OrderedDict())
+        key = tuple(sorted(filter.items()))
+        if key in pending:
+            pending[key][1].update(values)
+            self.stats['coalesced'] += 1
+            return True
+        if not self._reserve(1):
+            return False
+        pending[key] = (filter, dict(values))
+        self._added(1)
+        return True
+
+    def _reserve(self, count: int) -> bool:
+        if self._buffered + count > self.max_buffered:
+            self.stats['rejected'] += count
+            return False
+        return True
+
+    def _added(self, count: int):
+        self._buffered += count
+        self.stats['enqueued'] += count
+        self.start()
+        if self._buffered >= self.batch_size and self._flush_event is not None:
+            self._flush_event.set()
+
+    # --- Flushing ---
+    def start(self):
+        """Start the background flush task on the running event loop (idempotent)."""
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return # Chưa có event loop: task sẽ được tạo ở lần add/start tiếp theo
+        self._flush_event = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and write out everything still buffered."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        if self._buffered:
+            await self.flush()
+        if self._buffered:
+            print(f"WriteBehindQueue: {self._buffered} records could not be written on shutdown")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            if self._buffered:
+                await self.flush()
+
+    async def flush(self):
+        """Write all buffered records in batches of `batch_size`."""
+        lock = self._flush_lock or asyncio.Lock()
+        async with lock:
+            started = time.perf_counter()
+            # Các bản ghi đã gom theo key giờ là insert bình thường
+            for collection_name, pending in list(self._latest.items()):
+                self._buffers.setdefault(collection_name, deque()).extend(pending.values())
+                pending.clear()
+
+            for collection_name, buffer in list(self._buffers.items()):
+                while buffer:
+                    batch = [buffer.popleft() for _ in range(min(self.batch_size, len(buffer)))]
+                    if not await self._write(collection_name, batch, self.db.insert_documents):
+                        # Giữ thứ tự: trả batch về đầu hàng đợi, thử lại ở lần flush sau
+                        buffer.extendleft(reversed(batch))
+                        self.stats['failed_flushes'] += 1
+                        return
+                    self._buffered -= len(batch)
+
+            for collection_name, pending in list(self._upserts.items()):
+                while pending:
+                    batch = [pending.popitem(last=False) for _ in range(min(self.batch_size, len(pending)))]
+                    if not await self._write(collection_name, [operation for _, operation in batch], self.db.bulk_upsert):
+                        self._restore_upserts(pending, batch)
+                        self.stats['failed_flushes'] += 1
+                        return
+                    self._buffered -= len(batch)
+
+            self.stats['flushes'] += 1
+            self.stats['last_flush_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    def _restore_upserts(self, pending: "OrderedDict[Hashable, Tuple[dict, dict]]", batch):
+        for key, (filter, values) in reversed(batch):
+            if key in pending:
+                # Đã có update mới hơn trong lúc ghi: gộp, giá trị mới được ưu tiên
+                newer = pending[key][1]
+                pending[key] = (filter, {**values, **newer})
+                self._buffered -= 1
+            else:
+                pending[key] = (filter, values)
+            pending.move_to_end(key, last=False)
+
+    async def _write(self, collection_name: str, operations: list, write: Callable) -> bool:
+        """Write one batch. False means "keep it and retry later"; permanent errors drop the batch."""
+        delay = 0.5
+        for attempt in range(self.max_retries + 1):
+            try:
+                await write(collection_name, operations)
+                self.stats['written'] += len(operations)
+                return True
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                failed = [error for error in errors if error.get('code') != DUPLICATE_KEY]
+                # Lỗi duplicate key: bản ghi đã được ghi ở lần thử trước
+                self.stats['written'] += len(operations) - len(failed)
+                if failed:
+                    self.stats['dropped'] += len(failed)
+                    print(f"WriteBehindQueue: dropped {len(failed)} records for {collection_name}: {failed[0].get('errmsg')}")
+                return True
+            except TRANSIENT_ERRORS as e:
+                if attempt == self.max_retries:
+                    print(f"WriteBehindQueue: giving up on {collection_name} for now after {attempt + 1} attempts: {e}")
+                    return False
+                self.stats['retries'] += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10)
+            except Exception as e:
+                self.stats['dropped'] += len(operations)
+                print(f"WriteBehindQueue: dropped {len(operations)} records for {collection_name}: {e}")
+                return True
+        return False
+
+    def get_stats(self) -> dict:
+        stats = self.stats.copy()
+        stats['buffered'] = self._buffered
+        stats['max_buffered'] = self.max_buffered
+        return stats
+
+
+# Global write-behind queue instance
+_write_behind = None
+
+def get_write_behind():
+    global _write_behind
+    if _write_behind is None:
+        _write_behind = WriteBehindQueue(get_database())
+    return _write_behind
@@ -1,6 +1,9 @@
 import asyncio
+import heapq
+import itertools
 import logging
-from typing import Tuple  # Đã có trong Database
+import time
+from typing import Dict, List, Optional, Tuple  # Đã có trong Database
 from datetime import datetime  # Đã có trong Database
 
 # Import lớp Database và hàm get_database từ file của bạn
@@ -63,32 +66,12 @@ class FullRoad:
         self.road_name = road_name  # Thêm tên để logging dễ hiểu hơn
         self.db = db_instance
         self.is_auto_control_lights = is_auto_control_lights
-        self._auto_control_task: asyncio.Task | None = None
         # Các tham số có thể cấu hình cho mỗi road, hoặc lấy từ DB
         self.saturation_flow_ns = 1800.0  # xe/giờ
         self.saturation_flow_ew = 1800.0  # xe/giờ
         self.lost_time_per_phase = 4.0  # giây
 
-    async def _get_flow_rates(self) -> Tuple[float, float]:
-        try:
-            flow_data = await self.db.get_aggregated_counts_for_a_road_and_compute_vehicle_per_hour(self.road_id)
-            flow_ns_per_hour = flow_data.get("North-South", 0.0)
-            flow_ew_per_hour = flow_data.get("East-West", 0.0)
-
-            logger.warning(
-                f"Road [{self.road_name} ({self.road_id})]: Đang sử dụng flow rates giả định. Cần cập nhật _get_flow_rates() với logic DB thực tế.")
-            # Ví dụ ngẫu nhiên để thấy sự thay đổi
-            logger.info(
-                f"Road [{self.road_name} ({self.road_id})]: Lưu lượng giả định: NS={flow_ns_per_hour} veh/h, EW={flow_ew_per_hour} veh/h")
-            return float(flow_ns_per_hour), float(flow_ew_per_hour)
-
-        except Exception as e:
-            logger.error(f"Road [{self.road_name} ({self.road_id})]: Lỗi khi lấy flow rates: {e}", exc_info=True)
-            return 0.0, 0.0  # Trả về 0 nếu có lỗi
-
-    async def _calculate_and_apply_lights(self, mqtt_client: MQTTClient):
-        flow_ns, flow_ew = await self._get_flow_rates()
-
+    def compute_cycle(self, flow_ns: float, flow_ew: float) -> Tuple[int, int, int]:
         cycle_time, green_time_ns, green_time_ew = calculate_cycle_and_green_times_2_phase(
             flow_ns, flow_ew,
             self.saturation_flow_ns, self.saturation_flow_ew,
@@ -96,7 +79,10 @@ class FullRoad:
         )
         logger.info(
             f"Road [{self.road_name} ({self.road_id})]: Chu kỳ mới: C={cycle_time}s, G_NS={green_time_ns}s, G_EW={green_time_ew}s")
+        return cycle_time, green_time_ns, green_time_ew
 
+    def apply_cycle(self, mqtt_client: MQTTClient, cycle_time: int, green_time_ns: int):
+        """Publish the cycle of both lights: one MQTT message per light, sent back to back."""
         # TODO: Gửi thông tin chu kỳ và thời gian xanh đến thiết bị đèn thực tế
         yellow_time_ns = 3
         red_time_ns = cycle_time - yellow_time_ns - green_time_ns
@@ -105,51 +91,159 @@ class FullRoad:
         red_time_ew = yellow_time_ns + green_time_ns
         green_time_ew = cycle_time - red_time_ew - yellow_time_ew
 
-        message1 = f"1,{green_time_ns*1000},{yellow_time_ns*1000},{red_time_ns*1000}"
-        message2 = f"2,{green_time_ew*1000},{yellow_time_ew*1000},{red_time_ew*1000}"
-        mqtt_client.publish(settings.mqtt_topic_pub, message1)
-        mqtt_client.publish(settings.mqtt_topic_pub, message2)
+        mqtt_client.publish_cycles([
+            (1, green_time_ns*1000, yellow_time_ns*1000, red_time_ns*1000),
+            (2, green_time_ew*1000, yellow_time_ew*1000, red_time_ew*1000),
+        ])
 
         logger.info(f"Road [{self.road_name} ({self.road_id})]: Áp dụng (giả lập) cấu hình đèn mới.")
-        return cycle_time  # Trả về chu kỳ để biết sleep bao lâu
-
-    async def start_auto_control(self, mqtt_client: MQTTClient):
-        if not self.is_auto_control_lights:
-            logger.warning(
-                f"Road [{self.road_name} ({self.road_id})]: start_auto_control được gọi nhưng is_auto_control_lights là False.")
-            return
-
-        logger.info(f"Road [{self.road_name} ({self.road_id})]: Bắt đầu chế độ tự động.")
-        try:
-            while self.is_auto_control_lights:
-                cycle_time = await self._calculate_and_apply_lights(mqtt_client)
-
-                sleep_duration = max(10.0, float(cycle_time))  # Ngủ ít nhất 10s, hoặc theo chu kỳ
-                logger.info(
-                    f"Road [{self.road_name} ({self.road_id})]: Chờ {sleep_duration} giây trước khi tính toán lại...")
-                await asyncio.sleep(sleep_duration)
-        except asyncio.CancelledError:
-            logger.info(f"Road [{self.road_name} ({self.road_id})]: Chế độ tự động đã bị hủy.")
-        except Exception as e:
-            logger.error(f"Road [{self.road_name} ({self.road_id})]: Lỗi trong start_auto_control: {e}", exc_info=True)
-        finally:
-            logger.info(f"Road [{self.road_name} ({self.road_id})]: Kết thúc vòng lặp tự động.")
 
     def request_stop_auto_control(self):
         logger.info(f"Road [{self.road_name} ({self.road_id})]: Yêu cầu dừng chế độ tự động.")
+        # IntersectionScheduler bỏ road này ở lần chạy kế tiếp nếu RoadManager chưa unschedule
         self.is_auto_control_lights = False
-        if self._auto_control_task and not self._auto_control_task.done():
-            logger.info(f"Road [{self.road_name} ({self.road_id})]: Hủy task điều khiển tự động.")
-            self._auto_control_task.cancel()
-        else:
-            logger.info(
-                f"Road [{self.road_name} ({self.road_id})]: Không có task điều khiển tự động đang chạy hoặc đã xong.")
+
+
+class IntersectionScheduler:
+    """One task that drives the auto-control recomputation of every road.
+
+    Each auto road has a deadline in a heap. When the earliest deadline is
+    reached, every road due within `batch_window` seconds is handled
+    together: one aggregation fetches the flow of all of them, the new
+    cycles are computed and published back to back (one MQTT message per
+    light: the firmware reads one cycle per message), and each road is
+    rescheduled one cycle later. Scheduling lag (how late a road ran
+    compared to its deadline) is tracked per road.
+    """
+
+    def __init__(self, db_instance: Database, batch_window: Optional[float] = None, min_interval: float = 10.0):
+        self.db = db_instance
+        self.batch_window = settings.scheduler_batch_window if batch_window is None else batch_window
+        self.min_interval = min_interval
+        self._heap: List[Tuple[float, int, str]] = []  # (deadline, seq, road_id)
+        self._deadlines: Dict[str, float] = {}          # deadline hiện hành; mục cũ trong heap bị bỏ qua
+        self._roads: Dict[str, FullRoad] = {}
+        self._mqtt_clients: Dict[str, MQTTClient] = {}
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.lag: Dict[str, dict] = {}
+        self.stats = {'ticks': 0, 'roads_run': 0, 'max_batch': 0, 'last_tick_ms': 0.0}
+
+    def is_scheduled(self, road_id: str) -> bool:
+        return road_id in self._deadlines
+
+    def schedule(self, road: FullRoad, mqtt_client: MQTTClient, delay: float = 0.0):
+        """Add (or move) `road` so that it is recomputed in `delay` seconds."""
+        self._roads[road.road_id] = road
+        self._mqtt_clients[road.road_id] = mqtt_client
+        self._push(road.road_id, time.monotonic() + delay)
+        self._ensure_running()
+
+    def unschedule(self, road_id: str):
+        self._deadlines.pop(road_id, None)
+        self._roads.pop(road_id, None)
+        self._mqtt_clients.pop(road_id, None)
+
+    def _push(self, road_id: str, deadline: float):
+        self._deadlines[road_id] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), road_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    async def _run(self):
+        logger.info("IntersectionScheduler: bắt đầu.")
+        while True:
+            # Bỏ các mục đã bị huỷ/đổi lịch ở đầu heap
+            while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            timeout = self._heap[0][0] - time.monotonic()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = time.monotonic()
+            due: List[Tuple[str, float]] = []
+            while self._heap and self._heap[0][0] <= now + self.batch_window:
+                deadline, _, road_id = heapq.heappop(self._heap)
+                if self._deadlines.get(road_id) == deadline:
+                    due.append((road_id, deadline))
+            if due:
+                await self._run_due(due)
+
+    async def _run_due(self, due: List[Tuple[str, float]]):
+        started = time.monotonic()
+        road_ids = [road_id for road_id, _ in due]
+        try:
+            flows = await self.db.get_road_flow_rates(road_ids, window_minutes=settings.flow_window_minutes or None)
+        except Exception as e:
+            logger.error(f"IntersectionScheduler: Lỗi khi lấy flow rates cho {len(road_ids)} road: {e}", exc_info=True)
+            flows = {}
+
+        # Tính và publish chu kỳ của cả batch liên tiếp nhau, không await xen giữa
+        for road_id, deadline in due:
+            road = self._roads.get(road_id)
+            if road is None or not road.is_auto_control_lights:
+                self.unschedule(road_id)
+                continue
+            flow = flows.get(road_id, {})
+            cycle_time = None
+            try:
+                cycle_time, green_time_ns, _ = road.compute_cycle(
+                    float(flow.get("North-South", 0.0)), float(flow.get("East-West", 0.0)))
+                road.apply_cycle(self._mqtt_clients[road_id], cycle_time, green_time_ns)
+            except Exception as e:
+                logger.error(f"IntersectionScheduler: Lỗi khi áp dụng chu kỳ cho road {road_id}: {e}", exc_info=True)
+            self._record_lag(road_id, started - deadline)
+            self._push(road_id, started + max(self.min_interval, float(cycle_time or 0)))
+
+        self.stats['ticks'] += 1
+        self.stats['roads_run'] += len(due)
+        self.stats['max_batch'] = max(self.stats['max_batch'], len(due))
+        self.stats['last_tick_ms'] = round((time.monotonic() - started) * 1000, 1)
+
+    def _record_lag(self, road_id: str, lag: float):
+        lag_ms = max(0.0, lag * 1000)
+        entry = self.lag.setdefault(road_id, {'runs': 0, 'last_ms': 0.0, 'avg_ms': 0.0, 'max_ms': 0.0})
+        entry['runs'] += 1
+        entry['last_ms'] = round(lag_ms, 1)
+        entry['avg_ms'] = round(entry['avg_ms'] + (lag_ms - entry['avg_ms']) / entry['runs'], 1)
+        entry['max_ms'] = round(max(entry['max_ms'], lag_ms), 1)
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            'scheduled': len(self._deadlines),
+            'lag': {road_id: lag.copy() for road_id, lag in self.lag.items()},
+        }
 
 
 class RoadManager:
     def __init__(self, db_instance: Database):
         self.db = db_instance
         self.dict_road: dict[str, FullRoad] = {}
+        self.scheduler = IntersectionScheduler(db_instance)
 
     async def initialize_roads(self):
         logger.info("RoadManager: Khởi tạo danh sách các nút giao thông từ DB...")
@@ -189,32 +283,24 @@ class RoadManager:
             raise ValueError(f"Road ID {road_id} not found.")  # Sẽ thành HTTPException trong FastAPI
 
         road_obj = self.dict_road[road_id]
-        if road_obj.is_auto_control_lights and road_obj._auto_control_task and not road_obj._auto_control_task.done():
+        if road_obj.is_auto_control_lights and self.scheduler.is_scheduled(road_id):
             logger.info(
                 f"RoadManager: Chế độ tự động đã được kích hoạt và đang chạy cho {road_obj.road_name} ({road_id}).")
             return
 
-        # Hủy task cũ nếu có và chưa xong (dù hiếm khi xảy ra ở đây nếu logic đúng)
-        if road_obj._auto_control_task and not road_obj._auto_control_task.done():
-            logger.warning(f"RoadManager: Phát hiện task tự động cũ cho {road_obj.road_name} ({road_id}). Hủy bỏ...")
-            road_obj._auto_control_task.cancel()
-            try:
-                await road_obj._auto_control_task  # Chờ task cũ bị hủy
-            except asyncio.CancelledError:
-                pass  # Mong đợi
-
-        road_obj.is_auto_control_lights = True  # Đặt cờ TRƯỚC KHI tạo task mới
+        road_obj.is_auto_control_lights = True  # Đặt cờ TRƯỚC KHI đưa vào scheduler
         logger.info(f"RoadManager: Kích hoạt chế độ điều khiển tự động cho {road_obj.road_name} ({road_id}).")
         await self.db.change_mode_road(road_id=road_id, newMode="Auto")
-        road_obj._auto_control_task = asyncio.create_task(road_obj.start_auto_control(mqtt_client))
+        # Không tạo task riêng cho mỗi road: scheduler chung sẽ tính chu kỳ ở tick gần nhất
+        self.scheduler.schedule(road_obj, mqtt_client)
+
     async def invoke_manual_control(self, road_id: str):
         if road_id not in self.dict_road:
             logger.error(f"RoadManager: Không tìm thấy road_id: {road_id} để kích hoạt thủ công.")
             raise ValueError(f"Road ID {road_id} not found.")
 
         road_obj = self.dict_road[road_id]
-        if not road_obj.is_auto_control_lights and (
-                not road_obj._auto_control_task or road_obj._auto_control_task.done()):
+        if not road_obj.is_auto_control_lights and not self.scheduler.is_scheduled(road_id):
             logger.info(
                 f"RoadManager: Chế độ thủ công đã được kích hoạt (hoặc tự động chưa chạy/đã dừng) cho {road_obj.road_name} ({road_id}).")
             return
@@ -223,45 +309,19 @@ class RoadManager:
             f"RoadManager: Kích hoạt chế độ điều khiển thủ công cho {road_obj.road_name} ({road_id}). Dừng chế độ tự động...")
         await self.db.change_mode_road(road_id, "Manual")
         road_obj.request_stop_auto_control()
+        self.scheduler.unschedule(road_id)
 
-        if road_obj._auto_control_task:
-            try:
-                await asyncio.wait_for(road_obj._auto_control_task, timeout=10.0)  # Tăng timeout
-                logger.info(f"RoadManager: Task tự động cho {road_obj.road_name} ({road_id}) đã dừng thành công.")
-            except asyncio.CancelledError:
-                logger.info(
-                    f"RoadManager: Task tự động cho {road_obj.road_name} ({road_id}) đã được hủy (trong invoke_manual_control).")
-            except asyncio.TimeoutError:
-                logger.warning(
-                    f"RoadManager: Timeout khi chờ task tự động cho {road_obj.road_name} ({road_id}) dừng. Task có thể vẫn đang chạy ngầm nếu không xử lý CancelledError đúng cách.")
-            except Exception as e:
-                logger.error(f"RoadManager: Lỗi khi chờ task tự động cho {road_obj.road_name} ({road_id}) dừng: {e}",
-                             exc_info=True)
-            road_obj._auto_control_task = None
+    def get_scheduler_stats(self) -> dict:
+        return self.scheduler.get_stats()
 
     async def shutdown(self):
         logger.info("RoadManager: Bắt đầu quá trình tắt...")
-        tasks_to_wait = []
         for road_id, road_obj in self.dict_road.items():
-            if road_obj.is_auto_control_lights and road_obj._auto_control_task and not road_obj._auto_control_task.done():
+            if road_obj.is_auto_control_lights:
                 logger.info(f"RoadManager: Dừng điều khiển tự động cho {road_obj.road_name} ({road_id}) khi tắt.")
                 road_obj.request_stop_auto_control()
-                if road_obj._auto_control_task:
-                    tasks_to_wait.append(road_obj._auto_control_task)
-
-        if tasks_to_wait:
-            logger.info(f"RoadManager: Chờ {len(tasks_to_wait)} task điều khiển tự động hoàn tất...")
-            results = await asyncio.gather(*tasks_to_wait, return_exceptions=True)
-            for i, result in enumerate(results):
-                task_description = f"Task_{i}"  # Cần cách tốt hơn để xác định task nào
-                if hasattr(tasks_to_wait[i], 'get_coro') and hasattr(tasks_to_wait[i].get_coro(), '__qualname__'):
-                    task_description = tasks_to_wait[i].get_coro().__qualname__
-
-                if isinstance(result, asyncio.CancelledError):
-                    logger.info(f"RoadManager: {task_description} đã được hủy thành công khi tắt.")
-                elif isinstance(result, Exception):
-                    logger.error(f"RoadManager: {task_description} gặp lỗi khi tắt: {result}",
-                                 exc_info=isinstance(result, BaseException))
+                self.scheduler.unschedule(road_id)
+        await self.scheduler.stop()
         logger.info("RoadManager: Đã tắt.")
 
 
@@ -1,6 +1,5 @@
 import cv2
 import numpy as np
-from ultralytics import YOLO
 import supervision as sv
 import time
 from typing import Optional, Tuple, List, Dict, Set
@@ -11,21 +10,19 @@ import os
 from config import settings
 from database import get_database
 from models import VehicleCount
-import torch
+from model_loader import get_class_names, load_detector
+from persistence import get_write_behind
 
 class VideoProcessor:
     def __init__(self, stream_port: int = 8081):
         """Initialize the video processor with YOLO model and ByteTrack"""
         self.base_dir = os.path.dirname(os.path.abspath(__file__))
-        model_path = os.path.join(self.base_dir, 'yolov8n.pt')
-        self.model = YOLO(model_path)
-        device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        print(f"Using device: {device}")
-        self.model.to(device)
+        # Backend (torch/onnx/openvino) lấy từ settings.inference_backend
+        self.model = load_detector()
 
         # --- Class Information ---
         # Lấy danh sách tên lớp từ mô hình YOLO
-        self.class_names = dict(self.model.names)
+        self.class_names = get_class_names(self.model)
         # print("Class name",type(self.class_names))
         # Các lớp được coi là phương tiện giao thông (có thể tùy chỉnh dựa trên model của bạn)
         # Kiểm tra xem các class_id này có tồn tại trong self.class_names không
@@ -77,6 +74,21 @@ class VideoProcessor:
         self.stream_port = stream_port
         self.stream_url = None
         self.db = get_database()
+        # Hub WebSocket nhận số đếm mỗi khi có thay đổi (xem publish_stats_to)
+        self.stats_hub = None
+        self.stats_topic: Optional[str] = None
+        self._counts_dirty = False
+
+    def publish_stats_to(self, hub, topic: str):
+        """Push `get_counts()` to `topic` of a WebSocketManager whenever the counts change."""
+        self.stats_hub = hub
+        self.stats_topic = topic
+        self._counts_dirty = True
+
+    def _publish_counts(self):
+        if self._counts_dirty and self.stats_hub is not None:
+            self._counts_dirty = False
+            self.stats_hub.publish(self.stats_topic, self.counts)
 
     def detect_image(self, frame):
         frame = cv2.resize(frame, (settings.frame_width, settings.frame_height))
@@ -124,6 +136,7 @@ class VideoProcessor:
             'fps': self.fps # Giữ lại giá trị fps hiện tại
         }
         self.crossed_down_ids = set()
+        self._counts_dirty = True
         # Reset cả bộ đếm nội bộ của LineZone nếu muốn hiển thị của nó cũng reset
         if self.line_zone:
              # Không có phương thức reset công khai, tạo lại nếu cần
@@ -164,6 +177,7 @@ class VideoProcessor:
                         self.counts['down_by_class'][class_name] += 1
                         self.counts['total_down'] += 1
                         self.counts_all += 1
+                        self._counts_dirty = True
                         self.crossed_down_ids.add(tracker_id) # Đánh dấu ID này đã đi qua
                         current_crossed_ids_in_frame.add(tracker_id) # Đánh dấu ID vừa qua trong frame này
                         print(f"Vehicle crossed down: ID {tracker_id}, Type: {class_name}, Total Down: {self.counts['total_down']}") # Log
@@ -203,6 +217,7 @@ class VideoProcessor:
             if elapsed_time >= 1.0: # Cập nhật FPS mỗi giây
                 self.fps = self.frame_count / elapsed_time
                 self.counts['fps'] = round(self.fps, 1) # Cập nhật FPS vào dict counts
+                self._counts_dirty = True
                 self.frame_count = 0
                 self.start_time = current_time_fps
 
@@ -240,42 +255,36 @@ class VideoProcessor:
             await self._save_to_database()
             self.last_db_save_time = current_time_db
 
+        # Gửi số đếm tới các dashboard một lần cho mỗi thay đổi, không phụ thuộc số client
+        self._publish_counts()
+
         return annotated_frame
 
     async def _save_to_database(self):
-        """Save current counts per vehicle type to database."""
-        print(f"Saving counts to database at {datetime.now().isoformat()}...")
-        saved_items = 0
-        try:
-            timestamp = datetime.now()
-            for class_name, count in self.counts['down_by_class'].items():
-                # Chỉ lưu nếu có sự thay đổi hoặc luôn lưu giá trị hiện tại?
-                # Để đơn giản, luôn lưu giá trị hiện tại của các loại xe đã đếm được > 0
-                # Hoặc có thể lưu tất cả loại xe, kể cả count = 0
-                # if count > 0: # Chỉ lưu nếu có đếm
-                vehicle_count_data = VehicleCount(
-                    count=count,
-                    timestamp=timestamp,
-                    vehicle_type=class_name,
-                    direction="down" # Chỉ lưu hướng đi xuống
-                )
-                await self.db.save_vehicle_count(vehicle_count_data)
-                saved_items += 1
-
-            # Lưu tổng số lượng (tùy chọn)
-            total_count_data = VehicleCount(
-                count=self.counts['total_down'],
+        """Queue current counts per vehicle type; the write-behind queue writes them in bulk."""
+        timestamp = datetime.now()
+        records = [
+            VehicleCount(
+                count=count,
                 timestamp=timestamp,
-                vehicle_type="all_down", # Loại đặc biệt cho tổng số đi xuống
-                direction="down"
+                vehicle_type=class_name,
+                direction="down" # Chỉ lưu hướng đi xuống
             )
-            await self.db.save_vehicle_count(total_count_data)
-            saved_items += 1
-
-            print(f"Successfully saved {saved_items} count records to database.")
-
-        except Exception as e:
-            print(f"Error saving to database: {e}")
+            for class_name, count in self.counts['down_by_class'].items()
+        ]
+        # Lưu tổng số lượng (tùy chọn)
+        records.append(VehicleCount(
+            count=self.counts['total_down'],
+            timestamp=timestamp,
+            vehicle_type="all_down", # Loại đặc biệt cho tổng số đi xuống
+            direction="down"
+        ))
+
+        if get_write_behind().add_vehicle_counts(records):
+            print(f"Queued {len(records)} count records for saving at {timestamp.isoformat()}.")
+        else:
+            # Bộ đệm đầy (MongoDB chậm/mất kết nối): bỏ qua lần lưu này, số đếm là luỹ kế nên lần sau vẫn đủ
+            print("Write-behind buffer is full, skipping this count snapshot.")
 
     # Hàm start_stream, _process_stream, get_frame, generate_frames giữ nguyên
     async def start_stream(self, stream_url: str):
@@ -1,32 +1,53 @@
 import cv2
 import numpy as np
-from ultralytics import YOLO
 import supervision as sv
 import time
 from typing import Optional, Tuple, List, Dict, Set
 import asyncio
+import math
+from collections import OrderedDict
 from datetime import datetime
 import json
 import os
 from config import settings
 from database import get_database
 from models import VehicleCount, AggregatedVehicleCount
-import torch
+import multiprocessing
+import queue
+from inference_server import InferenceServer, VEHICLE_CLASS_NAMES
+from model_loader import get_class_names, load_class_names, load_detector
+from video_worker import run_video_worker
+from frame_grabber import FrameGrabber, is_file_source
+from motion_gate import MotionGate
+from line_counter import LineCrossingCounter
+from persistence import get_write_behind
+
+# Chu kỳ kiểm tra hàng đợi kết quả của worker (giây) khi hàng đợi rỗng
+WORKER_POLL_INTERVAL = 0.02
 
 class VideoProcessor:
-    def __init__(self,device_id, input_video_stream, direction_from, direction_to, is_tracking=False, stream_port: int = 8081):
+    def __init__(self,device_id, input_video_stream, direction_from, direction_to, is_tracking=False, stream_port: int = 8081,
+                 inference_server: Optional[InferenceServer] = None, execution_mode: Optional[str] = None):
         """Initialize the video processor with YOLO model and ByteTrack"""
         self.base_dir = os.path.dirname(os.path.abspath(__file__))
-        model_path = os.path.join(self.base_dir, 'yolov8n.pt')
-        self.model = YOLO(model_path)
-        device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        self.model.to(device)
+        self.execution_mode = execution_mode or settings.video_execution_mode
+        # Nếu có inference_server dùng chung thì không load model riêng cho camera này.
+        # Chế độ process: mỗi worker tự load một model, process cha chỉ cần tên lớp.
+        self.inference_server = inference_server if self.execution_mode != "process" else None
+        if self.execution_mode == "process":
+            self.model = None
+            self.class_names = load_class_names()
+        elif inference_server is not None:
+            self.model = None
+            self.class_names = dict(inference_server.class_names)
+        else:
+            self.model = load_detector()
+            self.class_names = get_class_names(self.model)
 
         # --- Class Information ---
-        self.class_names = dict(self.model.names)
         self.vehicle_class_ids = {
             k for k, v in self.class_names.items()
-            if v in ['car', 'motorcycle', 'bus', 'truck', 'bicycle'] # Thêm 'bicycle' nếu cần
+            if v in VEHICLE_CLASS_NAMES
         }
         print(f"Vehicle class IDs being tracked: {self.vehicle_class_ids}")
         print(f"Class names: {self.class_names}")
@@ -45,7 +66,11 @@ class VideoProcessor:
 
         self.line_zone: Optional[sv.LineZone] = None
         self.line_zone_annotator: Optional[sv.LineZoneAnnotator] = None
-        self.line_y: Optional[int] = None # Lưu tọa độ y của vạch đếm (giả sử là ngang)
+        self.line_counter: Optional[LineCrossingCounter] = None
+        self.line_y: Optional[int] = None # Toạ độ y của điểm đầu vạch đếm
+        self.line_y_span: Optional[Tuple[int, int]] = None # (y nhỏ nhất, y lớn nhất) của vạch đếm
+        self.roi_enabled = settings.roi_enabled
+        self.roi_band: Tuple[int, int] = (settings.roi_band_above, settings.roi_band_below)
 
         self.frame_count = 0
         self.start_time = None
@@ -56,9 +81,28 @@ class VideoProcessor:
         self.counts: Dict[str, any] = {
             'total_down': 0,
             'down_by_class': {self.class_names[cls_id]: 0 for cls_id in self.vehicle_class_ids if cls_id in self.class_names},
+            'total_up': 0,
+            'up_by_class': {self.class_names[cls_id]: 0 for cls_id in self.vehicle_class_ids if cls_id in self.class_names},
             'fps': 0.0 # Thêm FPS vào đây để gửi qua WebSocket
         }
-        self.crossed_down_ids: Set[int] = set() # Set để lưu tracker_id đã đi xuống
+
+        # --- Detection stride: chỉ chạy YOLO mỗi N frame, các frame giữa dự đoán box ---
+        self.detection_stride = max(1, settings.detection_stride)
+        self.max_detection_stride = max(self.detection_stride, settings.max_detection_stride)
+        self.adaptive_stride = settings.adaptive_stride
+        self.frames_predicted = 0
+        self._frames_since_detection = 0
+        self._frames_since_last_tracked = 0
+        self._last_tracked: Optional[sv.Detections] = None
+        self._track_velocity: Dict[int, np.ndarray] = {}
+        self._detect_cost: Optional[float] = None
+        self._predict_cost: Optional[float] = None
+        self._dropped_at_window_start = 0
+
+        # --- Motion gate: dùng lại detections cũ khi khung hình đứng yên ---
+        self.motion_gate: Optional[MotionGate] = MotionGate() if settings.motion_gate else None
+        self._last_raw_detections: Optional[sv.Detections] = None
+        self.frames_gated = 0
 
         self.last_count_time = time.time()
         self.last_db_save_time = time.time()
@@ -68,7 +112,22 @@ class VideoProcessor:
         self.is_running = False
         self.current_frame = None
         self.frame_lock = asyncio.Lock()
+        # Mỗi frame mới tăng frame_seq; client MJPEG chờ trên condition thay vì polling
+        self.frame_condition = asyncio.Condition(self.frame_lock)
+        self.frame_seq = 0
+        # Mỗi tier (width, quality) được encode tối đa một lần mỗi frame, dùng chung cho mọi client
+        self._encoded_tiers: "OrderedDict[Tuple[Optional[int], int], Tuple[int, Optional[bytes], Optional[bytes]]]" = OrderedDict()
+        self._decoded_cache: Tuple[int, Optional[np.ndarray]] = (-1, None) # (seq, frame) giải mã từ JPEG của worker
+        self.jpeg_quality = 85
+        self.stream_encodes = 0
+        self.stream_cache_hits = 0
+        # Số client MJPEG đang xem và số request snapshot đang chờ (dùng cho chế độ headless)
+        self.stream_clients = 0
+        self._snapshot_requests = 0
         self.cap = None
+        self.grabber: Optional[FrameGrabber] = None
+        self.frames_processed = 0
+        self.frames_dropped = 0
         self.stream_port = stream_port
         self.stream_url = input_video_stream
         self.db = get_database()
@@ -77,69 +136,293 @@ class VideoProcessor:
         self.direction_to = direction_to
         self.is_tracking = is_tracking
 
+        # --- Chế độ process: capture + inference + tracking chạy ở process con ---
+        self.current_frame_bytes: Optional[bytes] = None # JPEG đã encode sẵn từ worker
+        self._worker_process = None
+        self._worker_stop_event = None
+        self._worker_results = None
+        self._worker_viewers = None
+
     def set_counting_line(self, start: Tuple[int, int], end: Tuple[int, int]):
         """Set up the counting line."""
-        # Giả sử đường kẻ là ngang để đơn giản hóa việc xác định hướng đi xuống
-        # Nếu đường kẻ không ngang, logic kiểm tra vượt qua cần phức tạp hơn
-        if start[1] != end[1]:
-            print("Warning: Counting line is not horizontal. Downward counting logic assumes a horizontal line.")
-        self.line_y = start[1] # Lưu tọa độ y của đường kẻ
+        # Vạch có thể nghiêng: "down" là sang bên phải của hướng start -> end
+        self.line_y = start[1]
+        self.line_y_span = (min(start[1], end[1]), max(start[1], end[1]))
+        # Giữ trạng thái track lâu bằng lost_track_buffer của ByteTrack
+        self.line_counter = LineCrossingCounter(start, end, max_missing_frames=settings.track_buffer)
 
         self.line_zone = sv.LineZone(
             start=sv.Point(start[0], start[1]),
             end=sv.Point(end[0], end[1])
         )
         self.line_zone_annotator = sv.LineZoneAnnotator(thickness=2, text_thickness=0, text_scale=0)
-        print(f"Counting line set at Y = {self.line_y}")
+        print(f"Counting line set from {start} to {end}")
+        self._restart_worker_with_new_config()
+
+    def set_roi(self, enabled: bool, band_above: Optional[int] = None, band_below: Optional[int] = None):
+        """Enable/disable cropping the detector input to a band around the counting line."""
+        self.roi_enabled = enabled
+        self.roi_band = (
+            self.roi_band[0] if band_above is None else max(0, band_above),
+            self.roi_band[1] if band_below is None else max(0, band_below),
+        )
+        print(f"ROI {'enabled' if enabled else 'disabled'} for device {self.deviceid}: band {self.roi_band}")
+        self._restart_worker_with_new_config()
+
+    def _restart_worker_with_new_config(self):
+        if self._worker_stop_event is not None:
+            # Worker dừng, _consume_worker_results sẽ khởi động lại với cấu hình mới
+            self._worker_stop_event.set()
 
     def reset_counts(self):
-        """Resets the counters and the set of crossed IDs."""
+        """Resets the counters (tracks already counted stay counted)."""
         print("Resetting counts...")
         self.counts = {
             'total_down': 0,
             'down_by_class': {self.class_names[cls_id]: 0 for cls_id in self.vehicle_class_ids if cls_id in self.class_names},
+            'total_up': 0,
+            'up_by_class': {self.class_names[cls_id]: 0 for cls_id in self.vehicle_class_ids if cls_id in self.class_names},
             'fps': self.fps # Giữ lại giá trị fps hiện tại
         }
-        self.crossed_down_ids = set()
-        if self.line_zone:
-             start_pt = self.line_zone.vector.start
-             end_pt = self.line_zone.vector.end
-             self.line_zone = sv.LineZone(start=start_pt, end=end_pt)
+
+    def _roi_bounds(self, frame_height: int) -> Optional[Tuple[int, int]]:
+        """Rows (top, bottom) of the band around the counting line fed to the detector."""
+        if not self.roi_enabled or self.line_y is None:
+            return None
+        top = max(0, self.line_y_span[0] - self.roi_band[0])
+        bottom = min(frame_height, self.line_y_span[1] + self.roi_band[1])
+        if bottom <= top:
+            return None
+        return top, bottom
+
+    def _model_input(self, frame: np.ndarray) -> Tuple[np.ndarray, int]:
+        bounds = self._roi_bounds(frame.shape[0])
+        if bounds is None:
+            return frame, 0
+        return frame[bounds[0]:bounds[1]], bounds[0]
+
+    @staticmethod
+    def _to_frame_coords(detections: sv.Detections, offset_y: int) -> sv.Detections:
+        # Đưa box từ toạ độ vùng ROI về toạ độ khung hình để tracking/annotation
+        if offset_y and len(detections) > 0:
+            detections.xyxy[:, [1, 3]] += offset_y
+        return detections
+
+    def _run_model(self, frame: np.ndarray) -> sv.Detections:
+        model_input, offset_y = self._model_input(frame)
+        results = self.model(model_input, conf=settings.conf_thresh, iou=settings.iou_thresh, classes=list(self.vehicle_class_ids), verbose=False)[0]
+        return self._to_frame_coords(sv.Detections.from_ultralytics(results), offset_y)
+
+    def _detect_local(self, frame: np.ndarray) -> sv.Detections:
+        """Run the processor's own model on a frame (blocking), honouring the motion gate."""
+        gated = self._gated_detections(frame)
+        if gated is not None:
+            return gated
+        detections = self._run_model(frame)
+        self._last_raw_detections = detections
+        return detections
+
+    def _motion_band(self, frame_height: int) -> Optional[Tuple[int, int]]:
+        if settings.motion_band <= 0 or self.line_y is None:
+            return None
+        return max(0, self.line_y_span[0] - settings.motion_band), min(frame_height, self.line_y_span[1] + settings.motion_band)
+
+    def _gated_detections(self, frame: np.ndarray) -> Optional[sv.Detections]:
+        """Return the previous detections if the scene is static, else None (run the detector)."""
+        if self.motion_gate is None or self._last_raw_detections is None:
+            return None
+        if self.motion_gate.has_motion(frame, self._motion_band(frame.shape[0])):
+            return None
+        self.frames_gated += 1
+        return self._last_raw_detections
+
+    async def _detect(self, frame: np.ndarray) -> sv.Detections:
+        gated = self._gated_detections(frame)
+        if gated is not None:
+            return gated
+        if self.inference_server is not None:
+            model_input, offset_y = self._model_input(frame)
+            results = await self.inference_server.infer(model_input)
+            detections = self._to_frame_coords(sv.Detections.from_ultralytics(results), offset_y)
+        else:
+            detections = self._run_model(frame)
+        self._last_raw_detections = detections
+        return detections
 
     async def process_frame(self, frame: np.ndarray) -> Optional[np.ndarray]:
         """Process a single frame."""
         if frame is None or self.line_y is None: # Cần có đường kẻ mới xử lý
             return None
 
+        started = time.perf_counter()
         frame = cv2.resize(frame, (settings.frame_width2, settings.frame_height2))
-        results = self.model(frame, conf=settings.conf_thresh, iou=settings.iou_thresh, classes=list(self.vehicle_class_ids), verbose=False)[0]
-        detections = sv.Detections.from_ultralytics(results)
+        if self._should_detect():
+            detections = await self._detect(frame)
+            annotated_frame = self._track_count_annotate(frame, detections)
+            self._record_frame_cost(True, time.perf_counter() - started)
+        else:
+            annotated_frame = self._predict_and_annotate(frame)
+            self._record_frame_cost(False, time.perf_counter() - started)
 
-        detections = self.tracker.update_with_detections(detections)
+        current_time_db = time.time()
 
-        annotated_frame = frame.copy()
+        # Lưu vào DB
+        if current_time_db - self.last_db_save_time >= self.db_save_interval:
+            await self._save_to_database(datetime.fromtimestamp(current_time_db))
+            self.last_db_save_time = current_time_db
 
-        current_crossed_ids_in_frame = set()
-        if len(detections) > 0 and detections.tracker_id is not None:
-            for xyxy, confidence, class_id, tracker_id in zip(detections.xyxy, detections.confidence, detections.class_id, detections.tracker_id):
-                if tracker_id is None:
-                    continue
+        return annotated_frame
 
-                anchor_point_y = int(xyxy[3])
-
-                if anchor_point_y > self.line_y and tracker_id not in self.crossed_down_ids:
-                    if class_id in self.vehicle_class_ids and class_id in self.class_names:
-                        class_name = self.class_names[class_id]
-                        self.counts['down_by_class'][class_name] += 1
-                        self.counts['total_down'] += 1
-                        self.counts_all += 1
-                        self.crossed_down_ids.add(tracker_id) # Đánh dấu ID này đã đi qua
-                        current_crossed_ids_in_frame.add(tracker_id) # Đánh dấu ID vừa qua trong frame này
-                        print(f"Vehicle crossed down: ID {tracker_id}, Type: {class_name}, Total Down: {self.counts['total_down']}") # Log
-                    else:
-                         print(f"Ignoring cross for ID {tracker_id}, Class ID {class_id} (Valid vehicles: {self.vehicle_class_ids})")
-                         pass
+    def process_frame_sync(self, frame: np.ndarray) -> Optional[np.ndarray]:
+        """Blocking variant of process_frame without DB persistence (used by the worker process)."""
+        if frame is None or self.line_y is None:
+            return None
 
+        started = time.perf_counter()
+        frame = cv2.resize(frame, (settings.frame_width2, settings.frame_height2))
+        if self._should_detect():
+            annotated_frame = self._track_count_annotate(frame, self._detect_local(frame))
+            self._record_frame_cost(True, time.perf_counter() - started)
+        else:
+            annotated_frame = self._predict_and_annotate(frame)
+            self._record_frame_cost(False, time.perf_counter() - started)
+        return annotated_frame
+
+    # --- Detection stride ---
+    def _should_detect(self) -> bool:
+        """Decide whether this frame runs the detector or reuses predicted tracks."""
+        self._frames_since_detection += 1
+        if self._last_tracked is None or self._frames_since_detection >= self.detection_stride:
+            self._frames_since_detection = 0
+            return True
+        return False
+
+    def _record_frame_cost(self, detected: bool, cost: float):
+        # Trung bình trượt thời gian xử lý cho frame có/không chạy detector
+        if detected:
+            self._detect_cost = cost if self._detect_cost is None else 0.8 * self._detect_cost + 0.2 * cost
+        else:
+            self._predict_cost = cost if self._predict_cost is None else 0.8 * self._predict_cost + 0.2 * cost
+            self.frames_predicted += 1
+
+    def _adapt_stride(self, elapsed_time: float, frames_in_window: int):
+        """Pick the smallest stride whose average per-frame cost fits the frame budget.
+
+        The target rate is the incoming frame rate (processed + dropped),
+        capped at `settings.fps`, so a slow camera does not force skipping.
+        """
+        dropped_in_window = self.frames_dropped - self._dropped_at_window_start
+        self._dropped_at_window_start = self.frames_dropped
+        if not self.adaptive_stride or self._detect_cost is None:
+            return
+
+        input_fps = (frames_in_window + dropped_in_window) / elapsed_time
+        target_fps = min(settings.fps, input_fps) if input_fps > 0 else settings.fps
+        budget = 0.9 / target_fps
+        predict_cost = self._predict_cost if self._predict_cost is not None else 0.0
+
+        stride = 1
+        while stride < self.max_detection_stride and (self._detect_cost + (stride - 1) * predict_cost) / stride > budget:
+            stride += 1
+        if stride != self.detection_stride:
+            print(f"Device {self.deviceid}: detection stride {self.detection_stride} -> {stride} "
+                  f"(fps={self.fps:.1f}, target={target_fps:.1f})")
+            self.detection_stride = stride
+
+    def _update_track_motion(self, detections: sv.Detections):
+        """Remember the tracked boxes and their per-frame velocity for prediction."""
+        steps = max(1, self._frames_since_last_tracked)
+        velocities = {}
+        if self._last_tracked is not None and detections.tracker_id is not None and self._last_tracked.tracker_id is not None:
+            previous = {tid: xyxy for tid, xyxy in zip(self._last_tracked.tracker_id, self._last_tracked.xyxy)}
+            for tid, xyxy in zip(detections.tracker_id, detections.xyxy):
+                if tid in previous:
+                    velocities[tid] = (xyxy - previous[tid]) / steps
+        self._track_velocity = velocities
+        self._last_tracked = detections
+        self._frames_since_last_tracked = 0
+
+    def _predict_tracks(self) -> sv.Detections:
+        """Propagate the last tracked boxes with a constant-velocity model."""
+        self._frames_since_last_tracked += 1
+        last = self._last_tracked
+        if last is None or len(last) == 0 or last.tracker_id is None:
+            return sv.Detections.empty()
+
+        velocity = np.array([self._track_velocity.get(tid, np.zeros(4)) for tid in last.tracker_id], dtype=np.float32)
+        return sv.Detections(
+            xyxy=last.xyxy + velocity * self._frames_since_last_tracked,
+            confidence=last.confidence,
+            class_id=last.class_id,
+            tracker_id=last.tracker_id,
+        )
+
+    def _predict_and_annotate(self, frame: np.ndarray) -> Optional[np.ndarray]:
+        """Skipped-detection frame: no counting, only predicted boxes for display."""
+        self._update_fps()
+        if not self._should_annotate():
+            self._frames_since_last_tracked += 1
+            return None
+        detections = self._predict_tracks()
+        return self._annotate(frame, detections, set())
+
+    # --- Tracking, counting, annotation ---
+    def _should_annotate(self) -> bool:
+        """Headless mode: draw only when someone watches the stream or asked for a snapshot."""
+        if not settings.annotate_only_when_viewed:
+            return True
+        return self.stream_clients > 0 or self._snapshot_requests > 0
+
+    def _track_count_annotate(self, frame: np.ndarray, detections: sv.Detections) -> Optional[np.ndarray]:
+        """Update the tracker, count line crossings and draw the annotations (None when headless)."""
+        detections = self.tracker.update_with_detections(detections)
+        self._update_track_motion(detections)
+        current_crossed_ids_in_frame = self._count_crossings(detections)
+        self._update_fps()
+        if not self._should_annotate():
+            return None
+        return self._annotate(frame, detections, current_crossed_ids_in_frame)
+
+    def _count_crossings(self, detections: sv.Detections) -> Set[int]:
+        """Count line crossings of this frame's tracks in both directions; return the IDs that crossed."""
+        if len(detections) == 0 or detections.tracker_id is None:
+            self.line_counter.update(np.empty((0, 4)), np.empty(0, dtype=np.int64))
+            return set()
+
+        crossed_down, crossed_up = self.line_counter.update(detections.xyxy, detections.tracker_id)
+        is_vehicle = np.isin(detections.class_id, list(self.vehicle_class_ids))
+        for direction, crossed in (('down', crossed_down & is_vehicle), ('up', crossed_up & is_vehicle)):
+            if not crossed.any():
+                continue
+            class_ids, class_counts = np.unique(detections.class_id[crossed], return_counts=True)
+            by_class = self.counts[f'{direction}_by_class']
+            for class_id, count in zip(class_ids, class_counts):
+                class_name = self.class_names[class_id]
+                by_class[class_name] = by_class.get(class_name, 0) + int(count)
+            total = int(crossed.sum())
+            self.counts[f'total_{direction}'] += total
+            if direction == 'down':
+                self.counts_all += total
+
+        return set(detections.tracker_id[crossed_down | crossed_up].tolist())
+
+    def _update_fps(self):
+        # Tính FPS
+        current_time_fps = time.time()
+        if self.start_time is None:
+            self.start_time = current_time_fps
+        else:
+            self.frame_count += 1
+            elapsed_time = current_time_fps - self.start_time
+            if elapsed_time >= 1.0: # Cập nhật FPS mỗi giây
+                self.fps = self.frame_count / elapsed_time
+                self.counts['fps'] = round(self.fps, 1) # Cập nhật FPS vào dict counts
+                self._adapt_stride(elapsed_time, self.frame_count)
+                self.frame_count = 0
+                self.start_time = current_time_fps
+
+    def _annotate(self, frame: np.ndarray, detections: sv.Detections, current_crossed_ids_in_frame: Set[int]) -> np.ndarray:
+        annotated_frame = frame.copy()
 
         # --- Vẽ Annotation ---
         labels = []
@@ -157,23 +440,15 @@ class VideoProcessor:
             annotated_frame = self.box_annotator.annotate(scene=annotated_frame, detections=detections)
             annotated_frame = self.label_annotator.annotate(scene=annotated_frame, detections=detections, labels=labels)
 
+        # Vẽ vùng ROI đưa vào detector
+        roi_bounds = self._roi_bounds(annotated_frame.shape[0])
+        if roi_bounds is not None:
+            cv2.rectangle(annotated_frame, (0, roi_bounds[0]), (annotated_frame.shape[1] - 1, roi_bounds[1] - 1), (255, 0, 255), 1)
+
         # Vẽ đường kẻ (không cần hiển thị số đếm của LineZone nữa)
         if self.line_zone_annotator:
             annotated_frame = self.line_zone_annotator.annotate(annotated_frame, line_counter=self.line_zone) # Vẫn cần line_zone object
 
-        # Tính FPS
-        current_time_fps = time.time()
-        if self.start_time is None:
-            self.start_time = current_time_fps
-        else:
-            self.frame_count += 1
-            elapsed_time = current_time_fps - self.start_time
-            if elapsed_time >= 1.0: # Cập nhật FPS mỗi giây
-                self.fps = self.frame_count / elapsed_time
-                self.counts['fps'] = round(self.fps, 1) # Cập nhật FPS vào dict counts
-                self.frame_count = 0
-                self.start_time = current_time_fps
-
         # --- Hiển thị thông tin đếm mới ---
         cv2.putText(annotated_frame, f"FPS: {self.fps:.1f}", (10, 30),
                     cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
@@ -187,18 +462,10 @@ class VideoProcessor:
              cv2.putText(annotated_frame, text, (15, start_y + i * 25),
                          cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 0), 2)
 
-
-        current_time_db = time.time()
-
-        # Lưu vào DB
-        if current_time_db - self.last_db_save_time >= self.db_save_interval:
-            await self._save_to_database(datetime.fromtimestamp(current_time_db))
-            self.last_db_save_time = current_time_db
-
         return annotated_frame
 
     async def _save_to_database(self, current_time: datetime):
-        """Save current aggregated counts to database."""
+        """Queue the aggregated counts of the current interval for the write-behind queue."""
         data_to_save = AggregatedVehicleCount(
             deviceID=self.deviceid,
             timefrom=datetime.fromtimestamp(self.last_count_time),
@@ -210,13 +477,13 @@ class VideoProcessor:
             fps=self.counts.get('fps', 0.0)
         )
 
-        try:
-            await self.db.save_aggregated_vehicle_count(data_to_save)
+        # Không chờ MongoDB trong vòng xử lý frame: record được ghi theo batch ở background
+        if get_write_behind().add_aggregated_count(data_to_save):
             self.reset_counts()
-            print(f"Successfully saved aggregated count record to database for device {self.deviceid}.")
-
-        except Exception as e:
-            print(f"Error saving aggregated count to database for device {self.deviceid}: {e}")
+            self.last_count_time = current_time.timestamp()
+        else:
+            # Bộ đệm đầy: giữ nguyên số đếm, khoảng thời gian sẽ được gộp vào lần lưu sau
+            print(f"Write-behind buffer is full, keeping counts for device {self.deviceid} until the next save.")
 
     async def start_stream(self):
         """Start processing video stream"""
@@ -233,6 +500,13 @@ class VideoProcessor:
                  self.set_counting_line(default_start, default_end)
 
 
+            if self.execution_mode == "process":
+                self._start_worker()
+                self.is_running = True
+                print(f"Started worker process for stream: {self.stream_url}")
+                asyncio.create_task(self._consume_worker_results())
+                return
+
             self.cap = cv2.VideoCapture(self.stream_url)
             if not self.cap.isOpened():
                 raise Exception(f"Could not open video stream: {self.stream_url}")
@@ -285,11 +559,27 @@ class VideoProcessor:
                         break # Thoát vòng lặp
 
                 # --- Đọc frame ---
-                ret, frame = self.cap.read()
+                if settings.frame_grabber:
+                    if self.grabber is None or self.grabber.cap is not self.cap:
+                        self._start_grabber()
+                    frame, dropped = self.grabber.read_latest()
+                    self.frames_dropped += dropped
+                    if frame is None:
+                        if self.grabber.failed:
+                            print("Stream ended or connection lost. Attempting to reopen...")
+                            self._release_capture()
+                            reopen_attempts = 0
+                            await asyncio.sleep(2)
+                        else:
+                            await asyncio.sleep(0.005) # Chờ grabber đọc frame mới
+                        continue
+                    ret = True
+                else:
+                    ret, frame = self.cap.read()
 
                 if not ret:
                     print("End of stream or cannot read frame. Checking stream type...")
-                    is_file = not (self.stream_url and (self.stream_url.startswith(('http://', 'https://', 'rtsp://')) or self.stream_url.isdigit()))
+                    is_file = is_file_source(self.stream_url)
 
                     if is_file:
                         print("End of video file reached. Resetting to beginning.")
@@ -298,9 +588,7 @@ class VideoProcessor:
                         continue
                     else:
                         print("Stream ended or connection lost. Attempting to reopen...")
-                        if self.cap:
-                            self.cap.release()
-                        self.cap = None # Đặt là None để logic ở đầu vòng lặp thử mở lại
+                        self._release_capture() # cap = None để logic ở đầu vòng lặp thử mở lại
                         reopen_attempts = 0 # Reset để bắt đầu thử lại từ đầu
                         await asyncio.sleep(2) # Chờ trước khi thử mở lại
                         continue
@@ -314,13 +602,14 @@ class VideoProcessor:
                         await self._save_to_database(datetime.fromtimestamp(current_time_db))
                         self.last_db_save_time = current_time_db
 
+                self.frames_processed += 1
                 if processed_frame is not None:
-                    async with self.frame_lock:
-                        self.current_frame = processed_frame
+                    await self._publish_frame(frame=processed_frame)
                 else:
                     pass
 
-                await asyncio.sleep(0.01) # Delay cố định nhỏ
+                # Có grabber thì chỉ cần nhường event loop, không cần delay cố định
+                await asyncio.sleep(0 if settings.frame_grabber else 0.01)
 
             except Exception as e:
                 current_time = time.time()
@@ -333,42 +622,276 @@ class VideoProcessor:
         print("Stream processing loop finished.")
         if self.cap is not None:
             print("Releasing video capture...")
-            self.cap.release()
-            self.cap = None
+        self._release_capture()
         self.is_running = False
         print("VideoProcessor stopped.")
 
 
-    async def get_frame(self) -> Optional[bytes]:
-        """Get the current frame as JPEG bytes"""
-        frame_to_encode = None
-        async with self.frame_lock:
-             if self.current_frame is not None:
-                  frame_to_encode = self.current_frame.copy() # Tạo bản sao để tránh race condition
+    def _start_grabber(self):
+        self._stop_grabber()
+        self.grabber = FrameGrabber(self.cap, is_file=is_file_source(self.stream_url), name=f"grabber-{self.deviceid}")
+        self.grabber.start()
 
-        if frame_to_encode is not None:
-            try:
-                ret, buffer = cv2.imencode('.jpg', frame_to_encode, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                if ret:
-                    return buffer.tobytes()
-            except Exception as e:
-                 print(f"Error encoding frame: {e}")
-        return None # Trả về None nếu không có frame hoặc lỗi encode
+    def _stop_grabber(self):
+        if self.grabber is not None:
+            self.grabber.stop()
+            self.grabber = None
 
+    def _release_capture(self):
+        """Stop the grabber and release self.cap without pulling it from under a pending read."""
+        if self.grabber is not None and self.grabber.cap is self.cap:
+            # Grabber tự release cap nếu thread vẫn kẹt trong cap.read()
+            self.grabber.stop(release=True)
+            self.grabber = None
+        else:
+            self._stop_grabber()
+            if self.cap is not None:
+                self.cap.release()
+        self.cap = None
 
-    async def generate_frames(self):
-        """Generate MJPEG frames for streaming"""
+    def _start_worker(self):
+        """Spawn the capture/inference worker process for this camera."""
+        # spawn: an toàn với torch/CUDA và chạy giống nhau trên Windows/Linux
+        ctx = multiprocessing.get_context("spawn")
+        self._worker_results = ctx.Queue(maxsize=2)
+        self._worker_stop_event = ctx.Event()
+        self._worker_viewers = ctx.Value('i', self.stream_clients + self._snapshot_requests)
+        config = {
+            'device_id': self.deviceid,
+            'stream_url': self.stream_url,
+            'direction_from': self.direction_from,
+            'direction_to': self.direction_to,
+            'is_tracking': self.is_tracking,
+            'line_start': (int(self.line_zone.vector.start.x), int(self.line_zone.vector.start.y)),
+            'line_end': (int(self.line_zone.vector.end.x), int(self.line_zone.vector.end.y)),
+            'roi_enabled': self.roi_enabled,
+            'roi_band': self.roi_band,
+        }
+        self._worker_process = ctx.Process(
+            target=run_video_worker,
+            args=(config, self._worker_results, self._worker_stop_event, self._worker_viewers),
+            name=f"video-worker-{self.deviceid}",
+            daemon=True,
+        )
+        self._worker_process.start()
+
+    def _stop_worker(self):
+        if self._worker_stop_event is not None:
+            self._worker_stop_event.set()
+        if self._worker_process is not None:
+            self._worker_process.join(timeout=5)
+            if self._worker_process.is_alive():
+                print(f"Worker for {self.deviceid} did not stop in time. Terminating...")
+                self._worker_process.terminate()
+        self._worker_process = None
+        self._worker_stop_event = None
+        self._worker_results = None
+        self._worker_viewers = None
+
+    def _get_worker_result(self) -> Optional[dict]:
+        """Next result of the worker, or None right away if there is none yet."""
+        try:
+            return self._worker_results.get_nowait()
+        except queue.Empty:
+            return None
+
+    def _apply_worker_result(self, result: dict):
+        for direction, crossed_by_class in result['crossed'].items():
+            by_class = self.counts[f'{direction}_by_class']
+            for class_name, crossed in crossed_by_class.items():
+                by_class[class_name] = by_class.get(class_name, 0) + crossed
+                self.counts[f'total_{direction}'] += crossed
+                if direction == 'down':
+                    self.counts_all += crossed
+        self.fps = result['fps']
+        self.counts['fps'] = result['fps']
+        self.frames_processed = result['processed']
+        self.frames_dropped = result['dropped']
+        self.frames_predicted = result['predicted']
+        self.detection_stride = result['detection_stride']
+        self.frames_gated = result['gated']
+
+    async def _consume_worker_results(self):
+        """Receive results from the worker process; the event loop only applies them.
+
+        The results queue is polled without blocking, so cameras in process
+        mode do not hold threads of the default executor while they wait.
+        """
+        loop = asyncio.get_running_loop()
         while self.is_running:
-            frame_bytes = await self.get_frame()
-            if frame_bytes is not None:
+            try:
+                if self._worker_process is None or not self._worker_process.is_alive():
+                    print(f"Worker process for {self.deviceid} is not running. Restarting...")
+                    self._stop_worker()
+                    self._start_worker()
+                    await asyncio.sleep(2)
+                    continue
+
+                result = self._get_worker_result()
+                if result is None:
+                    await asyncio.sleep(WORKER_POLL_INTERVAL)
+                else:
+                    self._apply_worker_result(result)
+                    if result['jpeg'] is not None:
+                        await self._publish_frame(jpeg=result['jpeg'])
+                    await asyncio.sleep(0) # Nhường event loop khi worker gửi kết quả liên tục
+
+                current_time_db = time.time()
+                if current_time_db - self.last_db_save_time >= self.db_save_interval:
+                    await self._save_to_database(datetime.fromtimestamp(current_time_db))
+                    self.last_db_save_time = current_time_db
+            except Exception as e:
+                print(f"Error consuming worker results for {self.deviceid}: {e}")
+                await asyncio.sleep(2)
+
+        await loop.run_in_executor(None, self._stop_worker)
+        print(f"VideoProcessor {self.deviceid} (process mode) stopped.")
+
+    async def _publish_frame(self, frame: Optional[np.ndarray] = None, jpeg: Optional[bytes] = None):
+        """Store a new output frame (raw or already encoded) and wake up the stream clients."""
+        async with self.frame_condition:
+            if jpeg is not None:
+                self.current_frame_bytes = jpeg
+            else:
+                self.current_frame = frame
+            self.frame_seq += 1
+            self.frame_condition.notify_all()
+
+    @staticmethod
+    def _build_part(frame_bytes: bytes) -> bytes:
+        return (b'--boundary\r\n'
+                b'Content-Type: image/jpeg\r\n'
+                b'Content-Length: ' + str(len(frame_bytes)).encode() + b'\r\n\r\n' +
+                frame_bytes + b'\r\n')
+
+    def stream_tier(self, width: Optional[int] = None, quality: Optional[int] = None) -> Tuple[Optional[int], int]:
+        """Snap a requested width/quality to a cache tier: widths in steps of STREAM_WIDTH_STEP px, quality in steps of 10.
+
+        Width None (or >= the frame width) means full size; quality None or
+        equal to the processor's JPEG quality keeps that quality.
+        """
+        if quality is None or quality == self.jpeg_quality:
+            quality = self.jpeg_quality
+        else:
+            # Làm tròn nửa lên (round() của Python làm tròn về số chẵn: 85 -> 80)
+            quality = int(min(95, max(20, int(quality / 10 + 0.5) * 10)))
+        if width is not None:
+            step = settings.stream_width_step
+            width = int(math.ceil(max(width, step) / step) * step)
+            if width >= settings.frame_width2:
+                width = None
+        return width, quality
+
+    def _source_frame(self) -> Optional[np.ndarray]:
+        """Current output frame as an image (decoded once per frame in process mode)."""
+        if self.execution_mode != "process":
+            return self.current_frame
+        seq, frame = self._decoded_cache
+        if seq != self.frame_seq:
+            frame = None
+            if self.current_frame_bytes is not None:
+                frame = cv2.imdecode(np.frombuffer(self.current_frame_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+            self._decoded_cache = (self.frame_seq, frame)
+        return frame
+
+    async def get_encoded_frame(self, width: Optional[int] = None,
+                                quality: Optional[int] = None) -> Tuple[int, Optional[bytes], Optional[bytes]]:
+        """Return (seq, jpeg, multipart part) of the current frame for a tier, encoding it at most once per seq."""
+        tier = self.stream_tier(width, quality)
+        async with self.frame_lock:
+            cached = self._encoded_tiers.get(tier)
+            if cached is not None and cached[0] == self.frame_seq:
+                self._encoded_tiers.move_to_end(tier)
+                self.stream_cache_hits += 1
+                return cached
+
+            width, quality = tier
+            if self.execution_mode == "process" and width is None and quality == self.jpeg_quality:
+                jpeg = self.current_frame_bytes # Tier mặc định: dùng luôn JPEG worker đã encode
+            else:
+                frame = self._source_frame()
+                jpeg = None
+                if frame is not None:
+                    # current_frame luôn được thay bằng mảng mới nên không cần copy
+                    try:
+                        if width is not None:
+                            height = max(1, round(frame.shape[0] * width / frame.shape[1]))
+                            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+                        ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                        jpeg = buffer.tobytes() if ret else None
+                        self.stream_encodes += 1
+                    except Exception as e:
+                        print(f"Error encoding frame: {e}")
+
+            part = self._build_part(jpeg) if jpeg is not None else None
+            self._encoded_tiers[tier] = (self.frame_seq, jpeg, part)
+            self._encoded_tiers.move_to_end(tier)
+            while len(self._encoded_tiers) > settings.stream_max_tiers:
+                self._encoded_tiers.popitem(last=False)
+            return self._encoded_tiers[tier]
+
+    async def get_frame(self, width: Optional[int] = None, quality: Optional[int] = None) -> Optional[bytes]:
+        """Get the current frame as JPEG bytes"""
+        _, jpeg, _ = await self.get_encoded_frame(width, quality)
+        return jpeg # None nếu không có frame hoặc lỗi encode
+
+    def _sync_worker_viewers(self):
+        # Báo cho worker process biết có cần vẽ/encode frame hay không
+        if self._worker_viewers is not None:
+            self._worker_viewers.value = self.stream_clients + self._snapshot_requests
+
+    async def get_snapshot(self, timeout: float = 3.0, width: Optional[int] = None,
+                           quality: Optional[int] = None) -> Optional[bytes]:
+        """Annotated JPEG of the next processed frame, also when running headless."""
+        self._snapshot_requests += 1
+        self._sync_worker_viewers()
+        try:
+            async with self.frame_condition:
+                start_seq = self.frame_seq
                 try:
-                    yield (b'--boundary\r\n'
-                           b'Content-Type: image/jpeg\r\n'
-                           b'Content-Length: ' + str(len(frame_bytes)).encode() + b'\r\n\r\n' +
-                           frame_bytes + b'\r\n')
-                except Exception as e:
-                     print(f"Error yielding frame bytes: {e}")
-            await asyncio.sleep(1/30)
+                    await asyncio.wait_for(self.frame_condition.wait_for(lambda: self.frame_seq != start_seq), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._snapshot_requests -= 1
+            self._sync_worker_viewers()
+        return await self.get_frame(width, quality)
+
+    async def generate_frames(self, width: Optional[int] = None, quality: Optional[int] = None,
+                              fps: Optional[float] = None):
+        """Generate MJPEG frames for streaming.
+
+        `width`/`quality` select a shared encoding tier (see stream_tier) and
+        `fps` caps the frame rate of this client; frames in between are skipped.
+        """
+        last_seq = -1
+        interval = 1.0 / fps if fps else 0.0
+        loop = asyncio.get_running_loop()
+        next_send = loop.time()
+        self.stream_clients += 1
+        self._sync_worker_viewers()
+        try:
+            while self.is_running:
+                # Giới hạn fps của client: ngủ tới lượt gửi kế tiếp, các frame ở giữa bị bỏ qua
+                delay = next_send - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                # Chỉ gửi part mới khi frame_seq thay đổi
+                async with self.frame_condition:
+                    try:
+                        await asyncio.wait_for(self.frame_condition.wait_for(lambda: self.frame_seq != last_seq), timeout=1.0)
+                    except asyncio.TimeoutError:
+                        continue
+
+                seq, _, part = await self.get_encoded_frame(width, quality)
+                last_seq = seq
+                if part is not None:
+                    next_send = max(next_send + interval, loop.time()) if interval else next_send
+                    yield part
+        finally:
+            self.stream_clients -= 1
+            self._sync_worker_viewers()
 
 
     def stop(self):
@@ -378,7 +901,15 @@ class VideoProcessor:
 
     def get_counts(self) -> dict:
         """Get current counting statistics (new structure)"""
-        return self.counts.copy()
+        counts = self.counts.copy()
+        counts['frames_processed'] = self.frames_processed
+        counts['frames_dropped'] = self.frames_dropped
+        counts['frames_predicted'] = self.frames_predicted
+        counts['detection_stride'] = self.detection_stride
+        counts['frames_gated'] = self.frames_gated
+        counts['stream_encodes'] = self.stream_encodes
+        counts['stream_cache_hits'] = self.stream_cache_hits
+        return counts
 
     def get_count_history(self) -> List[dict]:
         """Get the history of counts (new structure)"""
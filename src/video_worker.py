@@ -0,0 +1,124 @@
+import queue
+import time
+from typing import Dict
+
+import cv2
+
+from config import settings
+from frame_grabber import FrameGrabber, is_file_source
+
+WORKER_JPEG_QUALITY = 85
+
+
+def run_video_worker(config: Dict, result_queue, stop_event, viewers):
+    """Entry point of a camera worker process.
+
+    Capture, detection, tracking and counting all run here, away from the
+    FastAPI event loop. Only small result messages go back to the parent:
+    the vehicles that crossed the line since the last message, the FPS and
+    the JPEG-encoded annotated frame. If the parent is slow, messages are
+    dropped rather than queued so the worker never falls behind. `viewers`
+    is a shared counter of stream clients/snapshot requests; in headless
+    mode frames are only drawn and encoded while it is non-zero.
+    """
+    # Import trong process con để tránh load model ở process cha
+    from video_processor_v2 import VideoProcessor
+
+    processor = VideoProcessor(
+        device_id=config['device_id'],
+        input_video_stream=config['stream_url'],
+        direction_from=config['direction_from'],
+        direction_to=config['direction_to'],
+        is_tracking=config['is_tracking'],
+        execution_mode="inline",
+    )
+    processor.set_counting_line(config['line_start'], config['line_end'])
+    processor.set_roi(config['roi_enabled'], *config['roi_band'])
+
+    stream_url = config['stream_url']
+    is_file = is_file_source(stream_url)
+    cap = cv2.VideoCapture(stream_url)
+    grabber = None
+    reported = {direction: dict(processor.counts[f'{direction}_by_class']) for direction in ('down', 'up')}
+
+    while not stop_event.is_set():
+        if cap is None or not cap.isOpened():
+            print(f"[worker {config['device_id']}] Reopening stream: {stream_url}")
+            cap = cv2.VideoCapture(stream_url)
+            if not cap.isOpened():
+                cap = None
+                time.sleep(3)
+                continue
+
+        if settings.frame_grabber:
+            if grabber is None or grabber.cap is not cap:
+                grabber = FrameGrabber(cap, is_file=is_file, name=f"grabber-{config['device_id']}")
+                grabber.start()
+            frame, grabber_dropped = grabber.read_latest()
+            processor.frames_dropped += grabber_dropped
+            if frame is None:
+                if grabber.failed:
+                    grabber.stop(release=True)
+                    grabber = None
+                    cap = None
+                    time.sleep(2)
+                else:
+                    time.sleep(0.005)
+                continue
+        else:
+            ret, frame = cap.read()
+            if not ret:
+                if is_file:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                else:
+                    cap.release()
+                    cap = None
+                    time.sleep(2)
+                continue
+
+        processor.stream_clients = viewers.value
+        try:
+            if processor.is_tracking:
+                output_frame = processor.process_frame_sync(frame)
+            else:
+                output_frame = frame if processor._should_annotate() else None
+        except Exception as e:
+            print(f"[worker {config['device_id']}] Error processing frame: {e}")
+            continue
+        processor.frames_processed += 1
+
+        crossed = {}
+        for direction in ('down', 'up'):
+            current = processor.counts[f'{direction}_by_class']
+            previous = reported[direction]
+            crossed[direction] = {name: count - previous.get(name, 0) for name, count in current.items() if count != previous.get(name, 0)}
+            reported[direction] = dict(current)
+
+        jpeg = None
+        if output_frame is not None:
+            ok, buffer = cv2.imencode('.jpg', output_frame, [cv2.IMWRITE_JPEG_QUALITY, WORKER_JPEG_QUALITY])
+            if ok:
+                jpeg = buffer.tobytes()
+
+        message = {'crossed': crossed, 'fps': processor.counts.get('fps', 0.0), 'jpeg': jpeg,
+                   'processed': processor.frames_processed, 'dropped': processor.frames_dropped,
+                   'predicted': processor.frames_predicted, 'detection_stride': processor.detection_stride,
+                   'gated': processor.frames_gated}
+        try:
+            result_queue.put_nowait(message)
+        except queue.Full:
+            # Parent chưa kịp đọc: bỏ frame nhưng giữ lại số xe đã đếm cho lần gửi sau
+            reported = {
+                direction: {name: count - crossed[direction].get(name, 0) for name, count in reported[direction].items()}
+                for direction in reported
+            }
+            processor.frames_dropped += 1
+
+    if grabber is not None and grabber.cap is cap:
+        grabber.stop(release=True) # Thread tự release cap nếu vẫn kẹt trong cap.read()
+    else:
+        if grabber is not None:
+            grabber.stop()
+        if cap is not None:
+            cap.release()
+    print(f"[worker {config['device_id']}] Stopped.")
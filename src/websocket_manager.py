@@ -1,40 +1,135 @@
-from fastapi import WebSocket
-from typing import List, Dict
+from fastapi import WebSocket, WebSocketDisconnect
+from typing import Callable, Iterable, List, Dict, Set, Deque, Optional, Tuple, Union
+from collections import deque
+import asyncio
 import json
+from config import settings
+
+
+class _Client:
+    """One connected socket with its own bounded send queue and sender task.
+
+    Entries are (key, payload). A payload with a key replaces a queued one
+    with the same key (state snapshots: only the newest matters); when the
+    queue is full the oldest entry is dropped.
+    """
+
+    def __init__(self, websocket: WebSocket, max_queue: int, stats: dict):
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.stats = stats # Bộ đếm dùng chung của WebSocketManager
+        self.queue: Deque[Tuple[Optional[str], str]] = deque()
+        self.ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def enqueue(self, payload: str, key: Optional[str] = None):
+        if key is not None:
+            for i, (queued_key, _) in enumerate(self.queue):
+                if queued_key == key:
+                    self.queue[i] = (key, payload)
+                    self.stats['coalesced'] += 1
+                    return
+        if len(self.queue) >= self.max_queue:
+            self.queue.popleft() # Client chậm: bỏ tin cũ nhất thay vì làm chậm các client khác
+            self.stats['dropped'] += 1
+        self.queue.append((key, payload))
+        self.ready.set()
+
 
 class WebSocketManager:
-    def __init__(self):
+    """Fan-out of JSON messages to WebSocket clients.
+
+    Every message is serialized once. Each client has a bounded queue
+    drained by its own sender task, so sends run concurrently and a slow
+    browser only delays (and loses the oldest of) its own messages. A
+    client whose send takes longer than `send_timeout` or fails is
+    disconnected and removed from every list it is in.
+    """
+
+    def __init__(self, max_queue: Optional[int] = None, send_timeout: Optional[float] = None):
         self.active_connections: List[WebSocket] = []
         self.list_channel: Dict[str, WebSocket] = {}
+        # Pub/sub: topic -> các client đã đăng ký, và payload JSON gần nhất theo key của mỗi topic
+        self.subscribers: Dict[str, Set[WebSocket]] = {}
+        self.last_payload: Dict[str, Dict[str, str]] = {}
+        self.max_queue = max(1, max_queue or settings.ws_queue_size)
+        self.send_timeout = send_timeout or settings.ws_send_timeout
+        self._clients: Dict[WebSocket, _Client] = {}
+        # prefix topic -> hàm tạo snapshot cho client mới đăng ký (thay cho payload đã cache)
+        self._snapshot_providers: Dict[str, Callable[[str], Optional[Dict]]] = {}
+        self.stats = {'published': 0, 'unchanged': 0, 'sent': 0, 'dropped': 0, 'coalesced': 0,
+                      'send_errors': 0, 'slow_disconnects': 0}
+
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
+        self._client(websocket)
         self.active_connections.append(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        """Forget `websocket` everywhere; safe to call more than once and from any task."""
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
+        for channel in [channel for channel, socket in self.list_channel.items() if socket is websocket]:
+            del self.list_channel[channel]
+        for topic in list(self.subscribers):
+            self.unsubscribe(topic, websocket)
+        client = self._clients.pop(websocket, None)
+        if client is not None and client.task is not None and client.task is not asyncio.current_task():
+            client.task.cancel()
+
+    def _client(self, websocket: WebSocket) -> _Client:
+        client = self._clients.get(websocket)
+        if client is None:
+            client = _Client(websocket, self.max_queue, self.stats)
+            client.task = asyncio.ensure_future(self._sender(client))
+            self._clients[websocket] = client
+        return client
+
+    async def _sender(self, client: _Client):
+        try:
+            while True:
+                await client.ready.wait()
+                while client.queue:
+                    _, payload = client.queue.popleft()
+                    await asyncio.wait_for(client.websocket.send_text(payload), self.send_timeout)
+                    self.stats['sent'] += 1
+                client.ready.clear()
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            self.stats['slow_disconnects'] += 1
+            print(f"WebSocket client too slow (> {self.send_timeout}s per message), disconnecting")
+            await self._close(client)
+        except Exception as e:
+            self.stats['send_errors'] += 1
+            print(f"Error sending to WebSocket client: {e}")
+            await self._close(client)
+
+    async def _close(self, client: _Client):
+        self.disconnect(client.websocket)
+        try:
+            await client.websocket.close(code=1011)
+        except Exception:
+            pass # Socket đã đóng
+
+    @staticmethod
+    def _serialize(message: Dict) -> str:
+        return json.dumps(message, separators=(",", ":"), default=str)
 
     async def broadcast(self, message: Dict):
-        if(not self.active_connections):
+        """Queue `message` for every connection; returns without waiting for the sends."""
+        if not self.active_connections:
             return
-        for connection in self.active_connections:
-            try:
-                # print("check connections")
-                await connection.send_json(message)
-            except Exception as e:
-                print(f"Error broadcasting to client: {e}")
-                await self.disconnect(connection)
+        payload = self._serialize(message)
+        for connection in list(self.active_connections):
+            self._client(connection).enqueue(payload)
 
     async def broadcastMQTT(self, channel: str, message: Dict):
         webSocket = self.list_channel.get(channel)
         if not webSocket:
             print(f"Channel '{channel}' not found")
             return
-
-        try:
-            await webSocket.send_json(message)
-        except Exception as e:
-            print(f"Error broadcasting to client: {e}")
-            await self.disconnect(webSocket)
+        self._client(webSocket).enqueue(self._serialize(message))
 
     async def broadcast_count_update(self, count: int, vehicle_type: str, direction: str):
         message = {
@@ -45,4 +140,106 @@ class WebSocketManager:
                 "direction": direction
             }
         }
-        await self.broadcast(message) 
\ No newline at end of file
+        await self.broadcast(message)
+
+    # --- Pub/sub ---
+    def set_snapshot_provider(self, prefix: str, provider: Callable[[str], Optional[Dict]]):
+        """Build the message sent to new subscribers of `prefix` and `prefix/...` with `provider(topic)`."""
+        self._snapshot_providers[prefix] = provider
+
+    def _snapshot_provider(self, topic: str) -> Optional[Callable[[str], Optional[Dict]]]:
+        for prefix, provider in self._snapshot_providers.items():
+            if topic == prefix or topic.startswith(prefix + "/"):
+                return provider
+        return None
+
+    async def subscribe(self, topic: str, websocket: WebSocket):
+        """Register `websocket` for `topic` and send it a snapshot of the topic.
+
+        The snapshot comes from the topic's snapshot provider if one is set,
+        otherwise it is the latest payload of each key of the topic.
+        """
+        self.subscribers.setdefault(topic, set()).add(websocket)
+        client = self._client(websocket)
+        provider = self._snapshot_provider(topic)
+        if provider is not None:
+            message = provider(topic)
+            if message is not None:
+                client.enqueue(self._serialize(message))
+            return
+        for key, payload in self.last_payload.get(topic, {}).items():
+            client.enqueue(payload, key=key)
+
+    def unsubscribe(self, topic: str, websocket: WebSocket):
+        subscribers = self.subscribers.get(topic)
+        if subscribers is not None:
+            subscribers.discard(websocket)
+            if not subscribers:
+                del self.subscribers[topic]
+
+    def publish(self, topics: Union[str, Iterable[str]], message: Dict, key: Optional[str] = None) -> bool:
+        """Serialize `message` once and queue it for every subscriber of `topics`.
+
+        `key` (default: the topic) identifies the state the message replaces:
+        it is not resent if equal to the previous payload with the same key,
+        a subscriber that has not yet received the previous one gets only the
+        newest, and new subscribers get the latest payload of every key. A
+        client subscribed to several of `topics` receives the message once.
+        Returns True if the message was new for at least one topic.
+        """
+        if isinstance(topics, str):
+            topics = (topics,)
+        payload = self._serialize(message)
+        changed = False
+        targets: Dict[WebSocket, str] = {}
+        for topic in topics:
+            topic_key = key or topic
+            latest = self.last_payload.setdefault(topic, {})
+            if latest.get(topic_key) == payload:
+                continue
+            latest[topic_key] = payload
+            changed = True
+            for websocket in self.subscribers.get(topic, ()):
+                targets.setdefault(websocket, topic_key)
+        if not changed:
+            self.stats['unchanged'] += 1
+            return False
+        self.stats['published'] += 1
+        for websocket, topic_key in targets.items():
+            self._client(websocket).enqueue(payload, key=topic_key)
+        return True
+
+    async def serve(self, topic: str, websocket: WebSocket):
+        """Accept `websocket`, subscribe it to `topic` and keep it until the client leaves.
+
+        The client may change its subscriptions on the same socket by sending
+        {"subscribe": [topics]} or {"unsubscribe": [topics]}.
+        """
+        await websocket.accept()
+        await self.subscribe(topic, websocket)
+        try:
+            while True:
+                await self._handle_client_message(websocket, await websocket.receive_text())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.disconnect(websocket)
+
+    async def _handle_client_message(self, websocket: WebSocket, text: str):
+        try:
+            request = json.loads(text)
+        except ValueError:
+            return # Tin không phải JSON (ping của client cũ): bỏ qua
+        if not isinstance(request, dict):
+            return
+        for topic in request.get("subscribe") or ():
+            await self.subscribe(str(topic), websocket)
+        for topic in request.get("unsubscribe") or ():
+            self.unsubscribe(str(topic), websocket)
+
+    def get_stats(self) -> dict:
+        stats = self.stats.copy()
+        stats['clients'] = len(self._clients)
+        stats['queued'] = sum(len(client.queue) for client in self._clients.values())
+        stats['topics'] = {topic: len(subscribers) for topic, subscribers in self.subscribers.items()}
+        return stats
@@ -0,0 +1,106 @@
+"""Load test cho WebSocketManager (không cần chạy server).
+
+Tạo hàng trăm client giả lập trên cùng một WebSocketManager: phần lớn nhận
+nhanh, một phần gửi chậm (slow) và một phần treo hẳn (stalled, lâu hơn
+send_timeout). Script publish/broadcast với tần số cố định rồi in ra thời
+gian mỗi lần publish, số tin mỗi nhóm client nhận được và thống kê của
+manager (dropped, coalesced, slow_disconnects).
+
+    python test/websocket_load.py --clients 500 --slow 0.1 --stalled 0.02 --messages 200 --rate 50
+    python test/websocket_load.py --mode broadcast
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from websocket_manager import WebSocketManager  # noqa: E402
+
+TOPIC = "stats/1"
+
+
+class FakeWebSocket:
+    """Client giả lập: mỗi lần gửi mất `delay` giây."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.received = 0
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, payload: str):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.received += 1
+
+    async def close(self, code: int = 1000):
+        self.closed = True
+
+
+def summary(clients):
+    if not clients:
+        return "-"
+    received = [client.received for client in clients]
+    closed = sum(client.closed for client in clients)
+    return f"{len(clients)} clients, received min={min(received)} avg={statistics.mean(received):.1f} max={max(received)}, closed={closed}"
+
+
+async def run(args):
+    manager = WebSocketManager(max_queue=args.queue, send_timeout=args.send_timeout)
+    n_stalled = int(args.clients * args.stalled)
+    n_slow = int(args.clients * args.slow)
+    stalled = [FakeWebSocket(args.send_timeout * 2) for _ in range(n_stalled)]
+    slow = [FakeWebSocket(args.slow_delay) for _ in range(n_slow)]
+    fast = [FakeWebSocket(0) for _ in range(args.clients - n_stalled - n_slow)]
+
+    for websocket in stalled + slow + fast:
+        await manager.connect(websocket)
+        await manager.subscribe(TOPIC, websocket)
+
+    publish_ms = []
+    interval = 1 / args.rate
+    started = time.perf_counter()
+    for i in range(args.messages):
+        t0 = time.perf_counter()
+        if args.mode == "publish":
+            manager.publish(TOPIC, {"total_down": i, "down_by_class": {"car": i}, "fps": 25.0})
+        else:
+            await manager.broadcast({"type": "mqtt_update", "seq": i})
+        publish_ms.append((time.perf_counter() - t0) * 1000)
+        await asyncio.sleep(interval)
+    elapsed = time.perf_counter() - started
+
+    # Chờ các hàng đợi gửi hết (client treo sẽ bị ngắt sau send_timeout)
+    await asyncio.sleep(args.drain)
+
+    print(f"mode={args.mode} clients={args.clients} messages={args.messages} rate={args.rate}/s queue={args.queue}")
+    print(f"publish: avg={statistics.mean(publish_ms):.3f} ms  p99={sorted(publish_ms)[int(len(publish_ms) * 0.99) - 1]:.3f} ms"
+          f"  max={max(publish_ms):.3f} ms  (loop {elapsed:.2f}s, target {args.messages * interval:.2f}s)")
+    print(f"fast:    {summary(fast)}")
+    print(f"slow:    {summary(slow)}")
+    print(f"stalled: {summary(stalled)}")
+    print(f"manager: {manager.get_stats()}")
+
+    for websocket in list(manager.active_connections):
+        manager.disconnect(websocket)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test WebSocketManager fan-out")
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--slow", type=float, default=0.1, help="tỉ lệ client chậm")
+    parser.add_argument("--slow-delay", type=float, default=0.2, help="thời gian mỗi lần gửi của client chậm (s)")
+    parser.add_argument("--stalled", type=float, default=0.02, help="tỉ lệ client treo (> send_timeout)")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=50, help="số message mỗi giây")
+    parser.add_argument("--queue", type=int, default=64, help="kích thước hàng đợi mỗi client")
+    parser.add_argument("--send-timeout", type=float, default=1.0)
+    parser.add_argument("--drain", type=float, default=3.0, help="thời gian chờ gửi hết sau khi publish (s)")
+    parser.add_argument("--mode", choices=("publish", "broadcast"), default="publish")
+    asyncio.run(run(parser.parse_args()))